@@ -0,0 +1,52 @@
+""" Per-memo cost of decrypting incoming memos from a set of recurring
+    counterparties, with and without the shared secret cache.
+
+    .. code-block:: bash
+
+        python benchmarks/memo_shared_secret.py --memos 2000 --counterparties 20
+"""
+import argparse
+import time
+
+from bitsharesbase import memo as BtsMemo
+from bitsharesbase.account import PrivateKey
+
+from bexi.shared_secret_cache import SharedSecretCache
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memos", type=int, default=2000)
+    parser.add_argument("--counterparties", type=int, default=20)
+    args = parser.parse_args()
+
+    exchange_wif = str(PrivateKey())
+    exchange = PrivateKey(exchange_wif)
+    counterparties = [PrivateKey() for _ in range(args.counterparties)]
+
+    memos = []
+    for i in range(args.memos):
+        sender = counterparties[i % len(counterparties)]
+        nonce = str(i)
+        memos.append((sender.pubkey, nonce,
+                      BtsMemo.encode_memo(sender, exchange.pubkey, nonce, "customer_" + str(i))))
+
+    # what bitshares.memo.Memo.decrypt does for every memo
+    start = time.perf_counter()
+    for pubkey, nonce, message in memos:
+        BtsMemo.decode_memo(PrivateKey(exchange_wif), pubkey, nonce, message)
+    uncached = (time.perf_counter() - start) / len(memos)
+
+    cache = SharedSecretCache()
+    start = time.perf_counter()
+    for pubkey, nonce, message in memos:
+        cache.decode_memo(cache.get_private_key(exchange_wif), pubkey, nonce, message)
+    cached = (time.perf_counter() - start) / len(memos)
+
+    print("memos: {}, counterparties: {}".format(len(memos), len(counterparties)))
+    print("without cache: {:8.1f} us/memo".format(uncached * 1e6))
+    print("with cache:    {:8.1f} us/memo ({})".format(cached * 1e6, cache.get_statistics()))
+
+
+if __name__ == "__main__":
+    main()
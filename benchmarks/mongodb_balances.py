@@ -0,0 +1,113 @@
+""" Cost of computing the balances of a page of addresses in MongoDB: one find
+    per address folded in Python (get_balances before the balance ledger), one
+    aggregation for the whole page, and reading the balance ledger.
+
+    Runs against the ``mongodbtest`` storage configured in
+    config_operation_storage.yaml, which is purged.
+
+    .. code-block:: bash
+
+        python benchmarks/mongodb_balances.py --addresses 1000 --operations 100
+"""
+import argparse
+import time
+
+from bexi import Config
+from bexi.addresses import DELIMITER, split_unique_address
+from bexi.factory import get_operation_storage
+
+
+def get_balances_by_find(storage, addresses):
+    """ get_balances as it was before the balance ledger
+    """
+    address_balances = {}
+    for address in addresses:
+        addrs = split_unique_address(address)
+        balances = {}
+        for operation in storage.get_operations_completed(
+                filter_by={"customer_id": addrs["customer_id"]}):
+            if addrs["account_id"] == operation["from"]:
+                balances[operation["amount_asset_id"]] = balances.get(
+                    operation["amount_asset_id"], 0) - operation["amount_value"]
+                balances[operation["fee_asset_id"]] = balances.get(
+                    operation["fee_asset_id"], 0) - operation["fee_value"]
+            elif addrs["account_id"] == operation["to"]:
+                balances[operation["amount_asset_id"]] = balances.get(
+                    operation["amount_asset_id"], 0) + operation["amount_value"]
+            balances["block_num"] = max(balances.get("block_num", 0), operation["block_num"])
+        address_balances[address] = balances
+    return address_balances
+
+
+def get_balances_by_aggregation(storage, addresses):
+    ledger = storage._aggregate_balance_ledger(
+        [split_unique_address(address)["customer_id"] for address in addresses])
+
+    address_balances = {address: {} for address in addresses}
+    for (address, asset_id), entry in ledger.items():
+        if address in address_balances:
+            address_balances[address][asset_id] = entry["balance"]
+            address_balances[address]["block_num"] = max(
+                address_balances[address].get("block_num", 0),
+                entry["block_num"])
+    return address_balances
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--addresses", type=int, default=1000)
+    parser.add_argument("--operations", type=int, default=100,
+                        help="completed operations per address")
+    args = parser.parse_args()
+
+    Config.load(["config_bitshares.yaml", "config_operation_storage.yaml"])
+    storage = get_operation_storage("mongodbtest")
+
+    exchange_account_id = "1.2.20477"
+    addresses = []
+    for i in range(args.addresses):
+        customer_id = "customer_" + str(i)
+        addresses.append(exchange_account_id + DELIMITER + customer_id)
+        operations = []
+        for j in range(args.operations):
+            operation = {
+                "status": "completed",
+                "block_num": 1000 + j,
+                "customer_id": customer_id,
+                "chain_identifier": customer_id + ":" + str(j),
+                "amount_value": 1000 + j,
+                "amount_asset_id": "1.3.0",
+                "fee_value": 10,
+                "fee_asset_id": "1.3.0",
+                # every fifth operation is a withdrawal
+                "from": exchange_account_id if j % 5 == 0 else "1.2.1",
+                "to": "1.2.1" if j % 5 == 0 else exchange_account_id
+            }
+            operations.append(operation)
+        storage._operations_storage.insert_many(operations)
+        storage.track_address(addresses[-1])
+    storage.rebuild_balances()
+
+    start = time.perf_counter()
+    by_find = get_balances_by_find(storage, addresses)
+    find_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    by_aggregation = get_balances_by_aggregation(storage, addresses)
+    aggregation_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    by_ledger = storage.get_balances(len(addresses))
+    ledger_time = time.perf_counter() - start
+    by_ledger.pop("continuation", None)
+
+    assert by_find == by_aggregation == by_ledger
+
+    print("addresses: {}, operations per address: {}".format(args.addresses, args.operations))
+    print("find per address: {:8.3f} s".format(find_time))
+    print("aggregation:      {:8.3f} s".format(aggregation_time))
+    print("balance ledger:   {:8.3f} s".format(ledger_time))
+
+
+if __name__ == "__main__":
+    main()
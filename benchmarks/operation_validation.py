@@ -0,0 +1,80 @@
+""" Cost of validating an operation against operation_schema.json: with
+    ``jsonschema.validate`` per call (validate_operation before the compiled
+    validator), and validate_operation in the full, fast and sampled modes.
+
+    .. code-block:: bash
+
+        python benchmarks/operation_validation.py --operations 100000
+"""
+import argparse
+import io
+import json
+import os
+import time
+
+import jsonschema
+
+from bexi import Config
+from bexi.operation_storage import operation_formatter
+from bexi.utils import date_to_string
+
+
+def validate_per_call(operation):
+    """ validate_operation as it was before the compiled validator
+    """
+    schema_file = os.path.join(
+        os.path.dirname(os.path.realpath(operation_formatter.__file__)),
+        "operation_schema.json"
+    )
+    if not hasattr(validate_per_call, "schema"):
+        validate_per_call.schema = json.loads(io.open(schema_file).read())
+    jsonschema.validate(operation,
+                        validate_per_call.schema,
+                        format_checker=jsonschema.FormatChecker())
+
+
+def measure(validate, operations):
+    start = time.perf_counter()
+    for operation in operations:
+        validate(operation)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--operations", type=int, default=100000)
+    args = parser.parse_args()
+
+    Config.load(["config_bitshares.yaml", "config_operation_storage.yaml"])
+
+    operations = []
+    for i in range(args.operations):
+        operations.append({
+            "status": "completed",
+            "block_num": 1000 + i,
+            "customer_id": "customer_" + str(i % 1000),
+            "chain_identifier": "1.11." + str(i) + ":0",
+            "incident_id": "1.11." + str(i) + ":0",
+            "amount_value": 1000 + i,
+            "amount_asset_id": "1.3.0",
+            "fee_value": 10,
+            "fee_asset_id": "1.3.0",
+            "from": "1.2.1",
+            "to": "1.2.20477",
+            "memo": "\"unknown\"",
+            "expiration": 1514764800.0,
+            "timestamp": date_to_string()
+        })
+
+    print("operations: {}".format(args.operations))
+    print("jsonschema.validate per call: {:8.3f} s".format(
+        measure(validate_per_call, operations)))
+    for mode in ["full", "fast", "sampled"]:
+        print("{:29s} {:8.3f} s".format(
+            mode + ":",
+            measure(lambda operation: operation_formatter.validate_operation(operation, mode=mode),
+                    operations)))
+
+
+if __name__ == "__main__":
+    main()
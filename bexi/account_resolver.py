@@ -0,0 +1,253 @@
+import atexit
+import collections
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+from bitshares.exceptions import AccountDoesNotExistsException
+
+from . import Config
+from .connection import requires_blockchain
+
+
+@requires_blockchain
+def _get_accounts_by_id(account_ids, bitshares_instance):
+    return bitshares_instance.rpc.get_objects(account_ids)
+
+
+@requires_blockchain
+def _get_accounts_by_name(account_names, bitshares_instance):
+    return bitshares_instance.rpc.lookup_account_names(account_names)
+
+
+class AccountResolver(object):
+    """ Resolves account ids into account names and vice versa, keeping the
+        most recently used accounts in memory.
+
+        :param int size: maximum number of accounts that are kept
+        :param int ttl_in_sec: seconds an account is kept before it is
+            obtained from the blockchain again
+        :param str snapshot_file: (optional) file the resolved accounts are
+            written to with :func:`AccountResolver.save_snapshot` and read from
+            on creation, so that a restart starts warm
+
+        Unknown accounts are obtained in batches (``get_objects`` for ids,
+        ``lookup_account_names`` for names). Accounts that do not exist are
+        not cached.
+
+        .. code-block:: python
+
+            resolver = AccountResolver(size=1000, ttl_in_sec=3600)
+            resolver.get_name("1.2.20137")
+            resolver.get_ids(["lykke-test", "lykke-customer"])
+            resolver.get_statistics()
+    """
+
+    def __init__(self, size=10000, ttl_in_sec=86400, snapshot_file=None):
+        self.size = size
+        self.ttl_in_sec = ttl_in_sec
+        self.snapshot_file = snapshot_file
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # account id -> (account name, expires at), least recently used first
+        self._names = collections.OrderedDict()
+        # account name -> account id
+        self._ids = {}
+
+        if self.snapshot_file:
+            self.load_snapshot()
+
+    def _add(self, account_id, account_name, expires_at):
+        self._names[account_id] = (account_name, expires_at)
+        self._names.move_to_end(account_id)
+        self._ids[account_name] = account_id
+        while len(self._names) > self.size:
+            _, (evicted_name, _) = self._names.popitem(last=False)
+            self._ids.pop(evicted_name, None)
+
+    def _get_cached_name(self, account_id, now):
+        entry = self._names.get(account_id)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            self._names.pop(account_id)
+            self._ids.pop(entry[0], None)
+            return None
+        self._names.move_to_end(account_id)
+        return entry[0]
+
+    def _resolve(self, keys, get_cached, fetch):
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        now = time.time()
+        resolved = {}
+        with self._lock:
+            for key in keys:
+                resolved[key] = get_cached(key, now)
+            missing = [key for key in keys if resolved[key] is None]
+            self.hits = self.hits + len(keys) - len(missing)
+            self.misses = self.misses + len(missing)
+
+        if not missing:
+            return resolved
+
+        accounts = fetch(missing)
+        with self._lock:
+            for key, account in zip(missing, accounts):
+                if account:
+                    self._add(account["id"],
+                              account["name"],
+                              now + self.ttl_in_sec)
+                    resolved[key] = account
+        return resolved
+
+    def get_names(self, account_ids):
+        """ Resolves the given account ids with at most one call to the
+            blockchain
+
+            :param account_ids: account ids in the format 1.2.XXX
+            :type account_ids: list of str
+            :returns: dict account id -> account name, None if the account
+                does not exist
+        """
+        resolved = self._resolve(
+            account_ids,
+            self._get_cached_name,
+            _get_accounts_by_id)
+        for key, value in resolved.items():
+            if isinstance(value, dict):
+                resolved[key] = value["name"]
+        return resolved
+
+    def get_ids(self, account_names):
+        """ Resolves the given account names with at most one call to the
+            blockchain
+
+            :param account_names: account names
+            :type account_names: list of str
+            :returns: dict account name -> account id, None if the account
+                does not exist
+        """
+        def get_cached_id(account_name, now):
+            account_id = self._ids.get(account_name)
+            if account_id is None:
+                return None
+            if self._get_cached_name(account_id, now) is None:
+                return None
+            return account_id
+
+        resolved = self._resolve(
+            account_names,
+            get_cached_id,
+            _get_accounts_by_name)
+        for key, value in resolved.items():
+            if isinstance(value, dict):
+                resolved[key] = value["id"]
+        return resolved
+
+    def get_name(self, account_id):
+        """ Returns the name of the given account id
+
+            :param str account_id: account id in the format 1.2.XXX
+            :raises: AccountDoesNotExistsException: if the account does not exist
+        """
+        name = self.get_names([account_id])[account_id]
+        if name is None:
+            raise AccountDoesNotExistsException(account_id)
+        return name
+
+    def get_id(self, account_name):
+        """ Returns the id of the given account name
+
+            :param str account_name: account name
+            :raises: AccountDoesNotExistsException: if the account does not exist
+        """
+        account_id = self.get_ids([account_name])[account_name]
+        if account_id is None:
+            raise AccountDoesNotExistsException(account_name)
+        return account_id
+
+    def get_statistics(self):
+        """ Returns hit and miss counters and the number of cached accounts
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._names)
+        }
+
+    def clear(self):
+        """ Removes all accounts and resets the counters
+        """
+        with self._lock:
+            self._names.clear()
+            self._ids.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def load_snapshot(self):
+        """ Reads the accounts from ``snapshot_file``, expired entries are
+            skipped
+        """
+        if not os.path.isfile(self.snapshot_file):
+            return
+        try:
+            with io.open(self.snapshot_file, "r", encoding="utf-8") as stream:
+                accounts = json.load(stream)["accounts"]
+        except (ValueError, KeyError) as e:
+            logging.getLogger(__name__).warning("Account snapshot " + self.snapshot_file + " ignored: " + str(e))
+            return
+
+        now = time.time()
+        with self._lock:
+            for account_id, account_name, expires_at in accounts:
+                if expires_at > now:
+                    self._add(account_id, account_name, expires_at)
+
+    def save_snapshot(self):
+        """ Writes all cached accounts to ``snapshot_file``
+        """
+        with self._lock:
+            accounts = [[account_id, name, expires_at] for
+                        account_id, (name, expires_at) in self._names.items()]
+
+        folder = os.path.dirname(self.snapshot_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_file = self.snapshot_file + ".tmp"
+        with io.open(tmp_file, "w", encoding="utf-8") as stream:
+            json.dump({"accounts": accounts}, stream)
+        os.replace(tmp_file, self.snapshot_file)
+
+
+account_resolver = None
+
+
+def get_account_resolver():
+    """ Returns the account resolver that is shared within this process,
+        configured by ``bitshares.account_resolver``
+    """
+    global account_resolver
+    if not account_resolver:
+        config = Config.get("bitshares", "account_resolver", {})
+
+        snapshot_file = config.get("snapshot_file")
+        if snapshot_file:
+            snapshot_file = os.path.join(
+                Config.get("dump_folder", default="dump"),
+                snapshot_file)
+
+        account_resolver = AccountResolver(
+            size=config.get("size", 10000),
+            ttl_in_sec=config.get("ttl_in_sec", 86400),
+            snapshot_file=snapshot_file)
+
+        if snapshot_file:
+            atexit.register(account_resolver.save_snapshot)
+
+    return account_resolver
@@ -1,7 +1,6 @@
 import uuid
 from . import utils
-from .connection import requires_blockchain
-from bitshares.account import Account
+from .account_resolver import get_account_resolver
 
 
 DELIMITER = ":"
@@ -72,14 +71,38 @@ def get_address_from_operation(operation):
     raise Exception("No operaton concerning this exchange")
 
 
-@requires_blockchain
-def _account_name_to_id(account_name, bitshares_instance):
-    return Account(account_name, bitshares_instance=bitshares_instance)["id"]
+def _account_name_to_id(account_name):
+    return get_account_resolver().get_id(account_name)
 
 
-@requires_blockchain
-def _account_id_to_name(account_id, bitshares_instance):
-    return Account(account_id, bitshares_instance=bitshares_instance)["name"]
+def _account_id_to_name(account_id):
+    return get_account_resolver().get_name(account_id)
+
+
+def prefetch_accounts(account_ids_or_names):
+    """ Resolves all given accounts with at most two calls to the blockchain,
+        so that following calls of :func:`ensure_account_name` and
+        :func:`ensure_account_id` for those accounts are served from the
+        account resolver. Accounts that don't exist are ignored here
+
+        :param account_ids_or_names: account ids (format 1.2.XXX) or names
+        :type account_ids_or_names: iterable of str
+    """
+    exchange_account = (utils.get_exchange_account_id(),
+                        utils.get_exchange_account_name())
+    account_ids = set()
+    account_names = set()
+    for account_id_or_name in account_ids_or_names:
+        if account_id_or_name in exchange_account:
+            continue
+        if account_id_or_name.startswith("1.2."):
+            account_ids.add(account_id_or_name)
+        else:
+            account_names.add(account_id_or_name)
+    if account_ids:
+        get_account_resolver().get_names(account_ids)
+    if account_names:
+        get_account_resolver().get_ids(account_names)
 
 
 def ensure_account_name(account_id_or_name):
@@ -1,16 +1,22 @@
-from ..operation_storage.exceptions import DuplicateOperationException
 from ..factory import get_operation_storage
+from ..operation_storage import operation_formatter
 from ..connection import requires_blockchain
 from .. import Config
+from ..account_resolver import get_account_resolver
+from .prefetch import BlockPrefetcher, get_block
+from .notification import PollingBlockNotifier, SubscriptionBlockNotifier
+from .memo_decryption import MemoDecryptionPool
+from ..shared_secret_cache import decrypt_memo
 
 from bitshares.account import Account
 from bitshares.blockchain import Blockchain
 from bitshares.exceptions import WalletLocked, MissingKeyError
 from bitshares.instance import shared_bitshares_instance
-from bitshares.memo import Memo
-from bitsharesbase.operationids import getOperationNameForId
+from bitsharesbase.operationids import getOperationNameForId, operations
 from bitsharesbase.signedtransactions import Signed_Transaction
+import collections
 import logging
+import time
 
 
 class BlockchainMonitor(object):
@@ -86,6 +92,53 @@ class BlockchainMonitor(object):
         self.watch_mode = self.config["bitshares"].get(
             "watch_mode", "irreversible")
 
+        # polling or subscription, tells how the monitor learns about new
+        # blocks
+        self.block_notification = self.config["bitshares"].get(
+            "block_notification", "polling")
+
+        # Number of blocks that are fetched concurrently while catching up,
+        # 1 disables prefetching
+        self.prefetch_window = self.config["bitshares"].get(
+            "prefetch_window", 1)
+
+        # How often a block that is not yet available on the node is
+        # requested again, once per second, before the monitor gives up
+        self.max_block_wait_repetition = self.config["bitshares"].get(
+            "max_block_wait_repetition", 12)
+
+        # Optional worker processes that decrypt the memos of all matched
+        # operations of a block in parallel, 0 decrypts inline
+        self.memo_pool = None
+        memo_decryption_workers = self.config["bitshares"].get(
+            "memo_decryption_workers", 0)
+        if memo_decryption_workers > 0:
+            self.memo_pool = MemoDecryptionPool(
+                memo_decryption_workers,
+                [memo_key],
+                self.bitshares.prefix)
+        # matched operations that wait for their memo to be decrypted
+        self._pending_operations = []
+
+        # Operations of up to commit_batch.blocks blocks, or of the blocks
+        # processed within commit_batch.interval_in_ms, are written with one
+        # bulk write, followed by one update of the last processed block
+        commit_batch = self.config["bitshares"].get("commit_batch", {})
+        self.commit_batch_blocks = commit_batch.get("blocks", 1)
+        self.commit_batch_interval_in_ms = commit_batch.get("interval_in_ms", 0)
+        self._uncommitted_operations = []
+        self._uncommitted_blocks = 0
+        self._uncommitted_block_num = None
+        self._batch_started = None
+
+        # In head mode, the last rollback_buffer_size blocks are kept with
+        # the operations they produced, so that the operations can be
+        # reverted if the blocks are forked out
+        self._rollback_buffer = None
+        if self.watch_mode in ["head", "dual"]:
+            self._rollback_buffer = collections.deque(
+                maxlen=self.config["bitshares"].get("rollback_buffer_size", 30))
+
         # Storage factory
         self.storage = kwargs.pop("storage", None)
         if not self.storage:
@@ -107,12 +160,25 @@ class BlockchainMonitor(object):
                 self.config["bitshares"]["exchange_account_id"]
             )
         )
+        self.my_account_id = self.my_account["id"]
+
+        # Dispatch table of the operations we are interested in, keyed by the
+        # raw operation id. A matcher obtains the raw operation payload and
+        # decides if the operation is sent to post processing. Operation ids
+        # without a matcher are skipped right away
+        self.operation_matchers = {
+            operations["transfer"]: self.transfer_matches
+        }
 
         # More (optional) parameters provided on instantiation
         self.start_block = kwargs.pop("start_block", None)
         self.stop_block = kwargs.pop("stop_block", None)
 
         last_block = self.storage.get_last_head_block_num()
+        self._last_committed_block_num = last_block
+        # dual mode, pending operations up to this block are completed. After
+        # a restart all left over pending operations are promoted
+        self._last_promoted_block_num = 0
 
         logging.getLogger(__name__).debug("Init with start=" + str(self.start_block) + " stop=" + str(self.stop_block) + " last=" + str(last_block))
 
@@ -134,20 +200,270 @@ class BlockchainMonitor(object):
                 configuration, the listen method has slightly different
                 behavior. Namely, we here have the choice between "head" (the
                 last block) and "irreversible" (the block that is confirmed by
-                2/3 of all block producers and is thus irreversible)
+                2/3 of all block producers and is thus irreversible). With
+                "dual" the monitor follows the head and stores the operations
+                as pending, they are promoted to completed once their block is
+                irreversible (see :func:`BlockchainMonitor.promote_irreversible`)
+
+            .. note:: If ``prefetch_window`` is configured larger than 1, the
+                monitor first catches up to the current block by fetching up
+                to ``prefetch_window`` blocks concurrently, see
+                :class:`.prefetch.BlockPrefetcher`
+
+            .. note:: While catching up, the blocks are committed in batches
+                (see :func:`BlockchainMonitor.commit`). Once caught up, every
+                block is committed right away
+
+            .. note:: With ``block_notification: subscription`` the monitor
+                is woken up as soon as the node pushes a new block instead of
+                polling, see :class:`.notification.SubscriptionBlockNotifier`
         """
-        for block in Blockchain(
-            mode=self.watch_mode,
-            max_block_wait_repetition=12,
+        blockchain = Blockchain(
+            mode="head" if self.watch_mode == "dual" else self.watch_mode,
             bitshares_instance=self.bitshares
-        ).blocks(
-            start=self.start_block,
-            stop=self.stop_block
-        ):
-            logging.getLogger(__name__).debug("Processing block " + str(block["block_num"]))
+        )
+        notifier = self.get_block_notifier(blockchain)
+
+        try:
+            start_block = self.start_block
+            if start_block and self.prefetch_window > 1:
+                start_block = self.catch_up(notifier, start_block)
+            if not start_block:
+                start_block = notifier.get_current_block_num()
+
+            while not self.stop_block or start_block <= self.stop_block:
+                last_block = notifier.wait_for_block(start_block)
+                if self.stop_block:
+                    last_block = min(last_block, self.stop_block)
+
+                block_num = start_block
+                while block_num <= last_block:
+                    block_num = self._process_and_store_block(
+                        self.get_block(block_num))
+                self.commit()
+                start_block = block_num
+        finally:
+            notifier.close()
+            self.close()
+
+    def close(self):
+        """ Stops the memo decryption workers, called when
+            :func:`BlockchainMonitor.listen` returns. Memos of a later
+            :func:`BlockchainMonitor.process_block` are decrypted inline
+        """
+        if self.memo_pool:
+            self.memo_pool.close()
+            self.memo_pool = None
+
+    def get_block_notifier(self, blockchain):
+        """ Returns the notifier that tells :func:`BlockchainMonitor.listen`
+            when new blocks exist, as configured by ``block_notification``
+
+            :param bitshares.blockchain.Blockchain blockchain: blockchain in
+                the configured watch mode
+        """
+        if self.block_notification == "subscription":
+            return SubscriptionBlockNotifier(blockchain)
+        return PollingBlockNotifier(blockchain)
+
+    def get_block(self, block_num):
+        """ Obtains the block from the blockchain, the block must exist in the
+            configured watch mode
+
+            :param int block_num: number of the block
+        """
+        return get_block(
+            self.bitshares.rpc, block_num, self.max_block_wait_repetition)
+
+    def catch_up(self, notifier, start_block):
+        """ Processes all blocks from ``start_block`` up to the current block
+            using the prefetcher. Returns the next block that needs to be
+            processed, once the remaining distance is smaller than the
+            prefetch window
+
+            :param notifier: block notifier, see
+                :func:`BlockchainMonitor.get_block_notifier`
+            :param int start_block: first block to process
+        """
+        prefetcher = BlockPrefetcher(
+            self.prefetch_window,
+            max_retries=self.max_block_wait_repetition)
+        try:
+            while True:
+                last_block = notifier.get_current_block_num()
+                if self.stop_block:
+                    last_block = min(last_block, self.stop_block)
+                if last_block - start_block < self.prefetch_window:
+                    return start_block
+
+                logging.getLogger(__name__).debug("Catching up from block " + str(start_block) + " to " + str(last_block))
+
+                next_block_num = last_block + 1
+                for block in prefetcher.blocks(start_block, last_block):
+                    next_block_num = self._process_and_store_block(block)
+                    if next_block_num != block["block_num"] + 1:
+                        # forked, start over with the new branch
+                        break
+                self.commit()
+                start_block = next_block_num
+        finally:
+            prefetcher.close()
+
+    def _process_and_store_block(self, block):
+        """ Processes the block and commits once the batch is full, see
+            :func:`BlockchainMonitor.commit`. Returns the number of the block
+            that is processed next, which is the first forked out block if
+            the given block is on a new branch (see
+            :func:`BlockchainMonitor.rollback_fork`)
+        """
+        fork_block_num = self.rollback_fork(block)
+        if fork_block_num is not None:
+            return fork_block_num
+
+        logging.getLogger(__name__).debug("Processing block " + str(block["block_num"]))
+
+        first_operation = len(self._uncommitted_operations)
+        self.process_block(block)
+
+        if self._rollback_buffer is not None:
+            self._rollback_buffer.append({
+                "block_num": block["block_num"],
+                "block_id": block.get("block_id"),
+                "operations": self._uncommitted_operations[first_operation:],
+                # the storage results, known after the next commit
+                "results": None
+            })
+
+        if not self._uncommitted_blocks:
+            self._batch_started = time.time()
+        self._uncommitted_blocks += 1
+        self._uncommitted_block_num = block["block_num"]
+
+        if self._uncommitted_blocks >= self.commit_batch_blocks or\
+                (time.time() - self._batch_started) * 1000 >= self.commit_batch_interval_in_ms:
+            self.commit()
+
+        return block["block_num"] + 1
+
+    def commit(self):
+        """ Writes the operations of all processed but uncommitted blocks with
+            one bulk write and advances the last processed block in the
+            storage afterwards.
+
+            If the monitor stops in between, it starts over with the first
+            uncommitted block. Operations that were already written are then
+            reported as duplicates by the storage and skipped
+        """
+        if not self._uncommitted_blocks:
+            return
+
+        results = []
+        if self._uncommitted_operations:
+            logging.getLogger(__name__).debug("Committing " + str(len(self._uncommitted_operations)) + " operations up to block " + str(self._uncommitted_block_num))
+            results = self.storage.insert_or_update_operations(self._uncommitted_operations)
+            for operation, result in zip(self._uncommitted_operations, results):
+                if result == "invalid":
+                    logging.getLogger(__name__).warning("Skipping invalid operation in block " + str(operation.get("block_num")) + ": " + str(operation))
+
+        # blocks that are processed again after a fork are committed already
+        if self._uncommitted_block_num > self._last_committed_block_num:
+            self.checkpoint(self._uncommitted_block_num)
+            self._last_committed_block_num = self._uncommitted_block_num
+
+        if self.watch_mode == "dual":
+            self.promote_irreversible()
+
+        if self._rollback_buffer is not None:
+            # the uncommitted blocks are the last ones in the buffer
+            for entry in reversed(self._rollback_buffer):
+                if entry["results"] is not None:
+                    break
+                entry["results"] = results[len(results) - len(entry["operations"]):]
+                results = results[:len(results) - len(entry["operations"])]
+
+        self._uncommitted_operations = []
+        self._uncommitted_blocks = 0
+
+    def checkpoint(self, block_num):
+        """ Stores that all blocks up to ``block_num`` are processed, the
+            monitor starts with the following block after a restart
+
+            :param int block_num: last committed block
+        """
+        self.storage.set_last_head_block_num(block_num)
+
+    def promote_irreversible(self):
+        """ Promotes the pending operations of all committed blocks that are
+            irreversible by now to completed, used in dual mode
+        """
+        irreversible_block_num = self.bitshares.rpc.get_dynamic_global_properties()[
+            "last_irreversible_block_num"]
+        end_block = min(irreversible_block_num, self._last_committed_block_num)
+        if end_block <= self._last_promoted_block_num:
+            return
+
+        promoted = self.storage.promote_pending_operations(
+            self._last_promoted_block_num + 1, end_block)
+        if promoted:
+            logging.getLogger(__name__).debug("Promoted " + str(promoted) + " operations up to block " + str(end_block))
+        self._last_promoted_block_num = end_block
+
+    def rollback_fork(self, block):
+        """ Checks if the block is the successor of the last processed block.
+            If not, the last processed blocks are reverted until the new
+            branch is found and the number of the first reverted block is
+            returned, otherwise None.
 
-            self.process_block(block)
-            self.storage.set_last_head_block_num(block["block_num"])
+            Only used in head mode. Reverting operations that were inserted
+            deletes them, operations that were completed by the block are in
+            progress again, see :func:`BlockchainMonitor.revert_block`
+
+            .. note:: Forks are detected with the ``block_id`` that the node
+                returns with every block
+
+            :param dict block: block as dictionary
+        """
+        if not self._rollback_buffer:
+            return None
+        last_entry = self._rollback_buffer[-1]
+        if last_entry["block_num"] != block["block_num"] - 1 or\
+                last_entry["block_id"] is None or\
+                last_entry["block_id"] == block["previous"]:
+            return None
+
+        logging.getLogger(__name__).warning("Block " + str(block["block_num"]) + " does not succeed " + last_entry["block_id"] + ", rolling back")
+
+        self.commit()
+
+        previous = block["previous"]
+        fork_block_num = block["block_num"]
+        while self._rollback_buffer and\
+                self._rollback_buffer[-1]["block_id"] != previous:
+            entry = self._rollback_buffer.pop()
+            self.revert_block(entry)
+            fork_block_num = entry["block_num"]
+            previous = self.get_block(fork_block_num)["previous"]
+
+        if not self._rollback_buffer:
+            logging.getLogger(__name__).error("Fork is deeper than the rollback buffer, continuing with block " + str(fork_block_num))
+
+        return fork_block_num
+
+    def revert_block(self, entry):
+        """ Reverts the operations that a forked out block produced in the
+            storage
+
+            :param dict entry: entry of the rollback buffer
+        """
+        logging.getLogger(__name__).warning("Reverting block " + str(entry["block_num"]) + " (" + str(entry["block_id"]) + ")")
+
+        for operation, result in reversed(list(zip(entry["operations"], entry["results"]))):
+            if result == "inserted":
+                operation = operation_formatter.decode_operation(operation)
+                operation.setdefault("status", "completed")
+                self.storage.delete_operation(operation)
+            elif result == "updated":
+                self.storage.revert_operation_completed(operation)
 
     def process_block(self, block):
         """ Process block and send transactions to
@@ -166,6 +482,8 @@ class BlockchainMonitor(object):
             })
             self.process_transaction(transaction)
 
+        self.flush_operations()
+
     def process_transaction(self, transaction):
         """ Process transaction and send operations to
             :func:`BlockchainMonitor.process_operation`
@@ -173,8 +491,8 @@ class BlockchainMonitor(object):
             :param dict transaction: Individual transaction as dictionary
 
             This method takes a transaction (appends transaction-specific
-            informations) and sends all operations in it to operation
-            processing
+            informations) and sends all operations in it that pass the
+            matchers in ``operation_matchers`` to operation processing
         """
         def get_tx_id(transaction):
             """ This method is used as a *getter* that is handed over as lambda function
@@ -189,6 +507,13 @@ class BlockchainMonitor(object):
             return tx.id
 
         for op_in_tx, operation in enumerate(transaction.get("operations", [])):
+            # Fast path: reject on the raw operation id and payload before
+            # anything is allocated, which is the case for almost all
+            # operations in a block
+            matcher = self.operation_matchers.get(operation[0])
+            if matcher is None or not matcher(operation[1]):
+                continue
+
             # op_in_tx tells us which operation in the transaction we are
             # talking about. Technically, multiple deposits could be made in a
             # single transaction. This is why we need to ensure we can
@@ -213,20 +538,25 @@ class BlockchainMonitor(object):
                 tx_id_getter=(lambda: get_tx_id(transaction))
             )
 
+    def transfer_matches(self, payload):
+        """ Matcher for transfers (operation id 0), which are of interest if
+            the exchange account is sender or receiver
+
+            :param dict payload: raw operation payload
+        """
+        return payload["from"] == self.my_account_id or\
+            payload["to"] == self.my_account_id
+
     def operation_matches(self, operation):
         """ This method defines the conditions that need to be met so we send
-            an operation forward to the post processing
+            an operation forward to the post processing. The conditions per
+            operation type are given by ``operation_matchers``
         """
-        operation_type = operation["op"][0]
-        payload = operation["op"][1]
-        if (
-            operation_type == "transfer" and (
-                payload["from"] == self.my_account["id"] or
-                payload["to"] == self.my_account["id"]
-            )
-        ):
-            return True
-        return False
+        matcher = self.operation_matchers.get(
+            operations.get(operation["op"][0]))
+        if matcher is None:
+            return False
+        return matcher(operation["op"][1])
 
     def decode_memo(self, payload):
         """ This method decodes the memo for us.
@@ -240,9 +570,10 @@ class BlockchainMonitor(object):
 
         """
         try:
-            decoded_memo = Memo(
-                bitshares_instance=self.bitshares
-            ).decrypt(payload["memo"])
+            decoded_memo = decrypt_memo(
+                self.bitshares.wallet,
+                self.bitshares.prefix,
+                payload["memo"])
         except MissingKeyError:
             decoded_memo = "memo_key_missing"
         except KeyError:
@@ -280,24 +611,53 @@ class BlockchainMonitor(object):
             It tries to decode the memo and sends all the relevant information
             to the storage for insertion into the database.
 
+            If a memo decryption pool is configured, the operation is kept
+            until the block is processed, see
+            :func:`BlockchainMonitor.flush_operations`
+
             :param dict operation: operation as dictionary
         """
         payload = operation["op"][1]
+        account_names = get_account_resolver().get_names(
+            [payload["from"], payload["to"]])
         operation.update({
-            "from_name": Account(
-                payload["from"],
-                bitshares_instance=self.bitshares
-            )["name"],
-            "to_name": Account(
-                payload["to"],
-                bitshares_instance=self.bitshares
-            )["name"],
-            "decoded_memo": self.decode_memo(payload),
+            "from_name": account_names[payload["from"]],
+            "to_name": account_names[payload["to"]],
         })
 
+        if self.memo_pool:
+            self._pending_operations.append(operation)
+        else:
+            operation["decoded_memo"] = self.decode_memo(payload)
+            self.store_operation(operation)
+
+    def flush_operations(self):
+        """ Decrypts the memos of all pending operations in parallel and
+            stores the operations. The order of insertion is the order in
+            which the operations were matched, which is (block, transaction,
+            op_in_tx)
+        """
+        if not self._pending_operations:
+            return
+
+        operations, self._pending_operations = self._pending_operations, []
+        decoded_memos = self.memo_pool.decrypt(
+            [operation["op"][1] for operation in operations])
+        for operation, decoded_memo in zip(operations, decoded_memos):
+            operation["decoded_memo"] = decoded_memo
+            self.store_operation(operation)
+
+    def store_operation(self, operation):
+        """ Queues the operation for insertion into the storage with the next
+            commit, or for an update if it was inserted before (e.g. when
+            broadcasted)
+
+            :param dict operation: operation as dictionary
+        """
         logging.getLogger(__name__).debug("Recognized accounts, inserting transfer " + str(operation["transaction_id"]))
 
-        try:
-            self.storage.insert_or_update_operation(operation)
-        except DuplicateOperationException:
-            pass
+        if self.watch_mode == "dual":
+            # completed once the block is irreversible
+            operation["status"] = "pending"
+
+        self._uncommitted_operations.append(operation)
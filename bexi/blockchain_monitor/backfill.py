@@ -0,0 +1,154 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .. import connection
+from ..connection import requires_blockchain
+from . import BlockchainMonitor
+
+
+def split_range(start_block, stop_block, shards):
+    """ Splits the blocks from ``start_block`` to ``stop_block`` (both
+        inclusive) into consecutive ranges of (nearly) equal size. The same
+        arguments always give the same ranges, which is what allows resuming
+        an interrupted backfill per shard
+
+        :param int start_block: first block
+        :param int stop_block: last block
+        :param int shards: number of ranges, less are returned if the range
+            has less blocks
+    """
+    if stop_block < start_block:
+        raise ValueError("stop_block must not be smaller than start_block")
+    blocks = stop_block - start_block + 1
+    shards = max(1, min(shards, blocks))
+
+    ranges = []
+    shard_start = start_block
+    for index in range(shards):
+        # the first blocks % shards ranges are one block larger
+        size = blocks // shards + (1 if index < blocks % shards else 0)
+        ranges.append((shard_start, shard_start + size - 1))
+        shard_start = shard_start + size
+    return ranges
+
+
+def get_shard_name(start_block, stop_block):
+    """ Returns the name the progress of the given range is stored with
+    """
+    return str(start_block) + "-" + str(stop_block)
+
+
+class BackfillMonitor(BlockchainMonitor):
+    """ Processes a fixed range of irreversible blocks (a shard of a backfill)
+        with the same matching pipeline as the :class:`BlockchainMonitor`.
+
+        The progress is stored per shard (see
+        :func:`bexi.operation_storage.interface.IOperationStorage.set_last_backfill_block_num`)
+        instead of the last head block num, so that backfills run next to the
+        monitor and resume with the first uncommitted block of the shard.
+        Operations that already exist are reported as duplicates by the
+        storage and skipped, which makes processing a block again harmless.
+
+        :param int start_block: first block of the shard
+        :param int stop_block: last block of the shard
+    """
+
+    @requires_blockchain
+    def __init__(self, start_block, stop_block, bitshares_instance=None, **kwargs):
+        super(BackfillMonitor, self).__init__(
+            bitshares_instance=bitshares_instance,
+            start_block=start_block,
+            stop_block=stop_block,
+            **kwargs)
+
+        # historic blocks are irreversible, no rollback and no pending
+        # operations needed
+        self.watch_mode = "irreversible"
+        self._rollback_buffer = None
+        # the shard never waits for new blocks
+        self.block_notification = "polling"
+
+        self.shard = get_shard_name(start_block, stop_block)
+        self._last_committed_block_num = self.storage.get_last_backfill_block_num(self.shard)
+        self.start_block = max(start_block, self._last_committed_block_num + 1)
+
+        logging.getLogger(__name__).debug("Backfill shard " + self.shard + " starts with block " + str(self.start_block))
+
+    def is_done(self):
+        """ Returns True if all blocks of the shard are committed
+        """
+        return self.start_block > self.stop_block
+
+    def listen(self):
+        """ Processes all remaining blocks of the shard, see
+            :func:`BlockchainMonitor.listen`
+        """
+        if self.is_done():
+            return
+        super(BackfillMonitor, self).listen()
+        self.start_block = self._last_committed_block_num + 1
+
+    def checkpoint(self, block_num):
+        self.storage.set_last_backfill_block_num(self.shard, block_num)
+
+
+def backfill_shard(start_block, stop_block):
+    """ Processes one shard, runs within the worker processes. Returns the
+        name of the shard
+
+        :param int start_block: first block of the shard
+        :param int stop_block: last block of the shard
+    """
+    # every worker opens its own connection instead of sharing the one of
+    # the parent process
+    connection.reset()
+    monitor = BackfillMonitor(start_block, stop_block)
+    monitor.listen()
+    return monitor.shard
+
+
+def get_backfill_progress(storage, start_block, stop_block, shards):
+    """ Returns the progress of all shards of the backfill as list of dicts
+        with the keys ``shard``, ``start_block``, ``stop_block`` and
+        ``last_block_num``
+
+        :param storage: operation storage the backfill writes to
+        :param int start_block: first block of the backfill
+        :param int stop_block: last block of the backfill
+        :param int shards: number of shards
+    """
+    return [{"shard": get_shard_name(shard_start, shard_stop),
+             "start_block": shard_start,
+             "stop_block": shard_stop,
+             "last_block_num": storage.get_last_backfill_block_num(
+                 get_shard_name(shard_start, shard_stop))}
+            for shard_start, shard_stop in split_range(start_block, stop_block, shards)]
+
+
+def backfill(start_block, stop_block, workers):
+    """ Processes the blocks from ``start_block`` to ``stop_block`` (both
+        inclusive) in ``workers`` shards, each in its own worker process.
+        Running the same backfill again resumes every shard where it stopped.
+
+        Returns the names of the shards that failed, the errors are logged
+
+        :param int start_block: first block
+        :param int stop_block: last block, must be irreversible
+        :param int workers: number of worker processes and shards
+    """
+    ranges = split_range(start_block, stop_block, workers)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = {executor.submit(backfill_shard, shard_start, shard_stop):
+                   get_shard_name(shard_start, shard_stop)
+                   for shard_start, shard_stop in ranges}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                future.result()
+                logging.getLogger(__name__).info("Backfill shard " + shard + " done")
+            except Exception as e:
+                logging.getLogger(__name__).exception("Backfill shard " + shard + " failed: " + str(e))
+                failed.append(shard)
+    return failed
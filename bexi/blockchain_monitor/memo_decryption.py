@@ -0,0 +1,97 @@
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from bitsharesbase.account import PrivateKey, PublicKey
+
+from ..shared_secret_cache import SharedSecretCache
+
+
+# per worker process: (wifs, prefix) -> {public key: private key}
+_private_keys = {}
+# per worker process, the shared secrets of the counterparties
+_shared_secrets = SharedSecretCache()
+
+
+def _get_private_keys(wifs, prefix):
+    if (wifs, prefix) not in _private_keys:
+        keys = {}
+        for wif in wifs:
+            private_key = PrivateKey(wif)
+            keys[format(private_key.pubkey, prefix)] = private_key
+        _private_keys[(wifs, prefix)] = keys
+    return _private_keys[(wifs, prefix)]
+
+
+def decrypt_memo(wifs, prefix, memo):
+    """ Decrypts a single memo, runs within the worker processes.
+
+        The key lookup follows ``bitshares.memo.Memo.decrypt`` with the keys
+        set in the wallet: if there is no key for the receiver and only one
+        key is given, that one is used.
+
+        :param tuple wifs: memo private keys in wif format
+        :param str prefix: public key prefix of the network
+        :param dict memo: encrypted memo as contained in the operation
+    """
+    keys = _get_private_keys(wifs, prefix)
+
+    if memo["to"] in keys:
+        private_key, public_key = keys[memo["to"]], memo["from"]
+    elif len(keys) == 1:
+        private_key, public_key = list(keys.values())[0], memo["from"]
+    elif memo["from"] in keys:
+        private_key, public_key = keys[memo["from"]], memo["to"]
+    else:
+        return "memo_key_missing"
+
+    try:
+        return _shared_secrets.decode_memo(
+            private_key,
+            PublicKey(public_key, prefix=prefix),
+            memo.get("nonce"),
+            memo.get("message"))
+    except ValueError:
+        return "decoding_not_possible"
+
+
+class MemoDecryptionPool(object):
+    """ Decrypts the memos of a batch of operations in parallel worker
+        processes.
+
+        :param int workers: number of worker processes
+        :param list wifs: memo private keys in wif format
+        :param str prefix: public key prefix of the network
+
+        The decoded memos follow the semantics of
+        :func:`bexi.blockchain_monitor.BlockchainMonitor.decode_memo`.
+    """
+
+    def __init__(self, workers, wifs, prefix):
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._decrypt = functools.partial(decrypt_memo, tuple(wifs), prefix)
+
+    def decrypt(self, payloads):
+        """ Returns the decoded memos of the given operation payloads, in the
+            same order as the payloads
+
+            :param list payloads: operation payloads (``operation["op"][1]``)
+        """
+        memos = [payload.get("memo") for payload in payloads]
+        decoded = iter(self._executor.map(
+            self._decrypt,
+            [memo for memo in memos if memo]))
+
+        decoded_memos = []
+        for payload, memo in zip(payloads, memos):
+            if "memo" not in payload:
+                decoded_memos.append("")
+            elif not memo:
+                decoded_memos.append(None)
+            else:
+                decoded_memos.append(next(decoded))
+        return decoded_memos
+
+    def close(self):
+        """ Stops the worker processes
+        """
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+
+from bitsharesapi.websocket import BitSharesWebsocket
+
+from .. import Config
+
+
+class PollingBlockNotifier(object):
+    """ Tells the monitor when a new block exists by polling the current block
+        and sleeping one block interval in between
+
+        :param bitshares.blockchain.Blockchain blockchain: blockchain in the
+            configured watch mode
+    """
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self._block_interval = None
+
+    @property
+    def block_interval(self):
+        if self._block_interval is None:
+            self._block_interval = self.blockchain.chainParameters().get(
+                "block_interval")
+        return self._block_interval
+
+    def get_current_block_num(self):
+        """ Returns the current block in the watch mode of the blockchain
+        """
+        return self.blockchain.get_current_block_num()
+
+    def wait_for_block(self, block_num):
+        """ Waits until the given block exists in the watch mode and returns
+            the current block, which is ``block_num`` or later
+
+            :param int block_num: number of the block to wait for
+        """
+        while True:
+            current_block_num = self.get_current_block_num()
+            if current_block_num >= block_num:
+                return current_block_num
+            time.sleep(self.block_interval)
+
+    def close(self):
+        pass
+
+
+class _GlobalPropertiesWebsocket(BitSharesWebsocket):
+    """ Keeps everything that depends on the websocket of python-bitshares
+        in one place, only its public interface is used
+    """
+
+    def on_open(self, ws):
+        super(_GlobalPropertiesWebsocket, self).on_open(ws)
+        # the node only pushes changes of objects that were requested once
+        self.get_objects(["2.1.0"])
+
+    def close(self):
+        try:
+            super(_GlobalPropertiesWebsocket, self).close()
+        except AttributeError:
+            # never connected, the reconnect loop is stopped before the
+            # missing connection is closed
+            logging.getLogger(__name__).debug("Closed block notification before connecting")
+
+
+def subscribe_to_global_properties(on_global_properties):
+    """ Subscribes to the dynamic global properties (object 2.1.0) of the
+        configured nodes in a background thread, ``on_global_properties`` is
+        called with every update, which is once per block. Returns the
+        subscription, which is stopped with ``close()``
+
+        :param func on_global_properties: called with the properties as dict
+    """
+    network = Config.get("network_type")
+    connection = Config.get("bitshares", "connection", network)
+
+    websocket = _GlobalPropertiesWebsocket(
+        connection["node"],
+        objects=["2.1.0"],
+        on_object=on_global_properties)
+    thread = threading.Thread(target=websocket.run_forever, daemon=True)
+    thread.start()
+    return websocket
+
+
+class SubscriptionBlockNotifier(PollingBlockNotifier):
+    """ Tells the monitor when a new block exists as soon as the node pushes
+        the new dynamic global properties, instead of polling.
+
+        :param bitshares.blockchain.Blockchain blockchain: blockchain in the
+            configured watch mode
+        :param func subscribe: (optional) subscribes the given callback to the
+            dynamic global properties, defaults to
+            :func:`subscribe_to_global_properties`
+        :param float fallback_after_in_sec: (optional) if no notification
+            arrives within this time, the current block is polled, so that
+            a lost subscription does not stall the monitor. Defaults to two
+            block intervals
+    """
+
+    def __init__(self, blockchain, subscribe=None, fallback_after_in_sec=None):
+        super(SubscriptionBlockNotifier, self).__init__(blockchain)
+        self.fallback_after_in_sec = fallback_after_in_sec
+
+        self._condition = threading.Condition()
+        self._current_block_num = 0
+
+        subscribe = subscribe or subscribe_to_global_properties
+        self._subscription = subscribe(self.on_global_properties)
+
+    def on_global_properties(self, properties):
+        """ Callback of the subscription, wakes up all waiting consumers
+
+            :param dict properties: dynamic global properties
+        """
+        block_num = properties.get(self.blockchain.mode)
+        if block_num is None:
+            return
+        self._set_current_block_num(block_num)
+
+    def _set_current_block_num(self, block_num):
+        with self._condition:
+            if block_num > self._current_block_num:
+                self._current_block_num = block_num
+                self._condition.notify_all()
+
+    def wait_for_block(self, block_num):
+        fallback_after_in_sec = self.fallback_after_in_sec or 2 * self.block_interval
+        while True:
+            with self._condition:
+                if self._condition.wait_for(
+                        lambda: self._current_block_num >= block_num,
+                        timeout=fallback_after_in_sec):
+                    return self._current_block_num
+
+            # no notification in time, the subscription might be lost
+            logging.getLogger(__name__).debug("No block notification within " + str(fallback_after_in_sec) + "s, polling")
+            self._set_current_block_num(self.get_current_block_num())
+            with self._condition:
+                if self._current_block_num >= block_num:
+                    return self._current_block_num
+
+    def close(self):
+        """ Stops the subscription
+        """
+        self._subscription.close()
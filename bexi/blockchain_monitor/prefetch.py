@@ -0,0 +1,103 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..connection import get_node_rpc
+
+
+def get_block(rpc, block_num, max_retries=3):
+    """ Fetches the block and sets its ``block_num``. A block that is not
+        (yet) known to the node is requested again once per second
+
+        :param rpc: node connection
+        :param int block_num: number of the block
+        :param int max_retries: how often the block is requested again before
+            giving up
+    """
+    block = rpc.get_block(block_num)
+    repetition = 0
+    while not block:
+        repetition += 1
+        if repetition > max_retries:
+            raise Exception("Block " + str(block_num) + " not available, aborting")
+        time.sleep(1)
+        block = rpc.get_block(block_num)
+    block["block_num"] = block_num
+    return block
+
+
+class BlockPrefetcher(object):
+    """ Fetches blocks ahead of processing so that catching up is not bound by
+        one RPC round-trip per block.
+
+        :param int window: number of blocks that are requested concurrently
+        :param func rpc_factory: (optional) returns a new RPC connection, each
+            worker thread opens its own. Defaults to
+            :func:`bexi.connection.get_node_rpc`
+        :param int max_retries: how often a block that is not (yet) known to
+            the node is requested again before giving up
+
+        Blocks are always yielded strictly in order, no matter in which order
+        the requests return.
+
+        .. code-block:: python
+
+            prefetcher = BlockPrefetcher(20)
+            for block in prefetcher.blocks(1000, 2000):
+                print(block["block_num"])
+            prefetcher.close()
+    """
+
+    def __init__(self, window, rpc_factory=None, max_retries=3):
+        self.window = window
+        self.max_retries = max_retries
+        self._rpc_factory = rpc_factory or get_node_rpc
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=window)
+
+    def _get_rpc(self):
+        rpc = getattr(self._local, "rpc", None)
+        if rpc is None:
+            rpc = self._rpc_factory()
+            self._local.rpc = rpc
+        return rpc
+
+    def get_block(self, block_num):
+        """ Fetches a single block using the connection of the calling thread
+
+            :param int block_num: number of the block
+        """
+        return get_block(self._get_rpc(), block_num, self.max_retries)
+
+    def blocks(self, start, stop):
+        """ Yields the blocks from ``start`` to ``stop`` (both inclusive),
+            keeping up to ``window`` requests in flight
+
+            :param int start: first block
+            :param int stop: last block, must already exist on the chain
+        """
+        pending = collections.deque()
+        next_block_num = start
+
+        def fill():
+            nonlocal next_block_num
+            while next_block_num <= stop and len(pending) < self.window:
+                pending.append(self._executor.submit(self.get_block, next_block_num))
+                next_block_num += 1
+
+        fill()
+        try:
+            while pending:
+                block = pending.popleft().result()
+                fill()
+                yield block
+        finally:
+            # the consumer stopped early, don't fetch what nobody processes
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """ Stops the worker threads
+        """
+        self._executor.shutdown(wait=False)
@@ -3,6 +3,7 @@ import logging
 from inspect import signature
 
 from bitshares.instance import set_shared_bitshares_instance, SharedInstance
+from bitsharesapi.bitsharesnoderpc import BitSharesNodeRPC
 import bitshares
 from . import Config
 
@@ -36,6 +37,17 @@ def _get_configured_instance():
     return bitshares.BitShares(**connection)
 
 
+def get_node_rpc():
+    """
+    Opens a new RPC connection to the configured nodes. The shared instance
+    can only serve one request at a time, use this for workers that query the
+    blockchain concurrently (one connection per worker)
+    """
+    network = Config.get("network_type")
+    connection = Config.get("bitshares", "connection", network)
+    return BitSharesNodeRPC(connection["node"])
+
+
 def requires_blockchain(func):
     """
     This decorator allows lazy loading of the bitshares instance with the
@@ -5,18 +5,26 @@ import pprint
 from . import Config
 from .operation_storage.mongodb_storage import MongoDBOperationsStorage
 from .operation_storage.azure_storage import AzureOperationsStorage
+from .operation_storage.inmemory_storage import InMemoryOperationsStorage
+from .operation_storage.sqlite_storage import SQLiteOperationsStorage
+from .operation_storage.caching_storage import CachingOperationStorage
 
 
 def get_operation_storage(use=None, purge=None):
     """ This factory initializes an IOperationStorage object specified by use.
-        If necessary, the database is purged before use.
+        If necessary, the database is purged before use. If enabled in
+        operation_storage.cache, it is wrapped in a
+        :class:`.operation_storage.caching_storage.CachingOperationStorage`
 
         :param use: Indicates which implementation of IOperationStorage will be used
                     Available:
                         azure
                         azuretest
+                        inmemory
                         mongodb
                         mongodbtest
+                        sqlite
+                        sqlitetest
                     Default: as configured in config.yaml
         :type use: String
         :param purge: Indicates if the database should be purged
@@ -48,6 +56,8 @@ def get_operation_storage(use=None, purge=None):
                                              ].drop()
             mongodb_client[use_config["db"]][use_config["address_collection"]
                                              ].drop()
+            mongodb_client[use_config["db"]][use_config["balance_collection"]
+                                             ].drop()
 
         return MongoDBOperationsStorage(mongodb_config=use_config, mongodb_client=mongodb_client)
 
@@ -60,6 +70,19 @@ def get_operation_storage(use=None, purge=None):
         else:
             return AzureOperationsStorage(azure_config=use_config, purge=purge)
 
+    def get_inmemory(use_config):
+        # nothing to purge without a snapshot, a snapshot is only purged on request
+        return InMemoryOperationsStorage(inmemory_config=use_config, purge=bool(purge))
+
+    def get_sqlite(use_config):
+        return SQLiteOperationsStorage(sqlite_config=use_config)
+
+    def get_sqlite_test(use_config):
+        if purge is None:
+            return SQLiteOperationsStorage(sqlite_config=use_config, purge=True)
+        else:
+            return SQLiteOperationsStorage(sqlite_config=use_config, purge=purge)
+
     config = Config.get("operation_storage")
     use_config = config[use]
 
@@ -67,10 +90,19 @@ def get_operation_storage(use=None, purge=None):
         "mongodb": lambda: get_mongodb(use_config),
         "mongodbtest": lambda: get_mongodb_test(use_config),
         "azure": lambda: get_azure(use_config),
-        "azuretest": lambda: get_azure_test(use_config)
+        "azuretest": lambda: get_azure_test(use_config),
+        "inmemory": lambda: get_inmemory(use_config),
+        "sqlite": lambda: get_sqlite(use_config),
+        "sqlitetest": lambda: get_sqlite_test(use_config)
     }
 
     if printConfig:
         logging.getLogger(__name__).debug("Operation storage initialized with use=" + use)
 
-    return use_choice[use]()
+    storage = use_choice[use]()
+
+    cache_config = Config.get("operation_storage", "cache", {})
+    if cache_config.get("enabled", False):
+        storage = CachingOperationStorage(storage, cache_config=cache_config)
+
+    return storage
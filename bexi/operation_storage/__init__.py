@@ -1,6 +1,9 @@
 __all__ = [
     "azure_storage",
+    "caching_storage",
+    "inmemory_storage",
     "interface",
     "mongodb_storage",
-    "operation_formatter"
+    "operation_formatter",
+    "sqlite_storage"
 ]
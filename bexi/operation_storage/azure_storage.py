@@ -1,12 +1,17 @@
 import time
 import collections
+import functools
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError,\
     AzureHttpError
+from azure.cosmosdb.table import AzureBatchOperationError, TableBatch
 from azure.cosmosdb.table.tableservice import TableService
 from urllib3.exceptions import NewConnectionError
 import hashlib
 
-from ..addresses import split_unique_address
+from ..addresses import split_unique_address, DELIMITER
 from .exceptions import (
     AddressNotTrackedException,
     AddressAlreadyTrackedException,
@@ -17,12 +22,32 @@ from .exceptions import (
     OperationStorageException)
 from .interface import (
     retry_auto_reconnect,
-    BasicOperationStorage)
+    BasicOperationStorage,
+    BALANCE_FIELDS)
 from bexi import Config
 import json
 from json.decoder import JSONDecodeError
 
 
+# maximum number of entities in an entity group transaction
+MAX_BATCH_SIZE = 100
+
+
+def get_partition_key(value, partitions):
+    """
+    Returns the partition of the given row key in tables that are partitioned by hash.
+    Unlike the built-in hash, which is randomized per process, the digest is the same in
+    every process
+
+    :param value: row key
+    :type value: str
+    :param partitions: number of partitions
+    :type partitions: int
+    """
+    digest = hashlib.sha256(value.encode("utf-8")).hexdigest()
+    return str(int(digest[:16], 16) % partitions)
+
+
 class AzureOperationsStorage(BasicOperationStorage):
     """
         Implementation of :class:`.interface.IOperationStorage` with Azure Table Storage using the
@@ -33,7 +58,9 @@ class AzureOperationsStorage(BasicOperationStorage):
         Table creation can take a while with Azure Table Storage.
 
         As Azure Table Storage only supports two indices, the operations are inserted multiple times in different
-        tables to enable multi-index queries.
+        tables to enable multi-index queries. The writes to the variant tables are issued concurrently
+        on a bounded thread pool (``write_workers`` in the configuration) and grouped into entity group
+        transactions where they share a partition. If one of them fails, the others are undone.
     """
 
     def get_retry_exceptions(self):
@@ -53,11 +80,17 @@ class AzureOperationsStorage(BasicOperationStorage):
             raise Exception("Please include the azure account key in the config")
 
         self._service = TableService(account_name=self._azure_config["account"], account_key=self._azure_config["key"])
+        self._executor = ThreadPoolExecutor(max_workers=self._azure_config.get("write_workers", 8))
 
         # if tables doesnt exist, create it
         self._create_operations_storage(purge)
         self._create_status_storage(purge)
         self._create_address_storage(purge)
+        if self._create_balance_storage(purge) and\
+                next(self.iter_operations_completed(projection=["RowKey"], batch_size=1), None) is not None:
+            # existing deployment without a ledger yet, get_balances reads only the ledger
+            logging.getLogger(__name__).info("Building the balance ledger from the completed operations")
+            self._rebuild_balances()
 
     def _debug_print(self, operation):
         from pprint import pprint
@@ -83,6 +116,24 @@ class AzureOperationsStorage(BasicOperationStorage):
                 self._service.create_table(tablename)
                 time.sleep(0.1)
 
+    def _create_balance_storage(self, purge):
+        tablename = self._azure_config["balance_table"]
+        if purge:
+            try:
+                for item in self._service.query_entities(tablename):
+                    self._service.delete_entity(
+                        tablename,
+                        item["PartitionKey"],
+                        item["RowKey"])
+            except AzureMissingResourceHttpError:
+                pass
+        created = False
+        while not self._service.exists(tablename):
+            self._service.create_table(tablename)
+            created = True
+            time.sleep(0.1)
+        return created
+
     def _create_status_storage(self, purge):
         if purge:
             try:
@@ -99,7 +150,8 @@ class AzureOperationsStorage(BasicOperationStorage):
             time.sleep(0.1)
 
     def _create_operations_storage(self, purge):
-        self._operation_varients = ["incident", "status"]  #  "customer"
+        # status and customer variants are the indices of the queries
+        self._operation_varients = ["incident", "status", "customer"]
         self._operation_tables = {}
         for variant in self._operation_varients:
             self._operation_tables[variant] = self._azure_config["operation_table"] + variant
@@ -139,7 +191,161 @@ class AzureOperationsStorage(BasicOperationStorage):
         return with_ck
 
     def _short_digit_hash(self, value):
-        return str(abs(hash(value)) % (10 ** Config.get("operation_storage", "short_hash_digits", 3)))
+        return get_partition_key(value, Config.get("operation_storage", "partitions", 1000))
+
+    def _get_hash_partitioned_tables(self):
+        return [self._operation_tables["incident"]] + [
+            self._azure_config["address_table"] + usage
+            for usage in ["balance", "historyfrom", "historyto"]]
+
+    def _repartition(self, tablename, entity):
+        """
+        Moves the given entity to the partition of its row key if it is stored in another
+        one. Returns True if it was moved
+
+        :param tablename: table partitioned by :func:`get_partition_key`
+        :type tablename: str
+        :param entity: entity as read from the table
+        :type entity: dict
+        """
+        partition_key = self._short_digit_hash(entity["RowKey"])
+        if entity["PartitionKey"] == partition_key:
+            return False
+        moved = {key: value for key, value in entity.items()
+                 if key not in ["PartitionKey", "Timestamp", "etag"]}
+        moved["PartitionKey"] = partition_key
+        # copy first, the entity is found in either partition at any time
+        self._service.insert_or_replace_entity(tablename, moved)
+        try:
+            self._service.delete_entity(
+                tablename,
+                entity["PartitionKey"],
+                entity["RowKey"],
+                if_match=entity.get("etag", "*"))
+        except AzureMissingResourceHttpError:
+            # moved in between
+            pass
+        return True
+
+    def _repartition_legacy(self, tablename, row_key):
+        """
+        While a migration of the partitions runs (``partition_fallback`` in the configuration),
+        a lookup that misses searches the row key in all partitions and moves the entity.
+        Returns True if an entity was moved
+
+        :param tablename: table partitioned by :func:`get_partition_key`
+        :type tablename: str
+        :param row_key: row key that was not found in its partition
+        :type row_key: str
+        """
+        if not self._azure_config.get("partition_fallback", False):
+            return False
+        for entity in self._service.query_entities(
+                tablename,
+                "RowKey eq '" + row_key.replace("'", "''") + "'"):
+            if self._repartition(tablename, entity):
+                return True
+        return False
+
+    def migrate_partitions(self, batch_size=None, on_progress=None):
+        """
+        Moves all entities of the hash partitioned tables (operations by incident id and
+        addresses) to the partitions of the current partition scheme while the services keep
+        running. The progress is checkpointed per table in the status table after every
+        page, an interrupted migration resumes there. Returns the number of moved
+        entities per table
+
+        :param batch_size: entities per page, default operation_storage.batch_size
+        :type batch_size: int
+        :param on_progress: called after every page with the table name and the number of
+            entities moved in the table so far
+        :type on_progress: func
+        """
+        if batch_size is None:
+            batch_size = Config.get("operation_storage", "batch_size", 1000)
+        partitions = Config.get("operation_storage", "partitions", 1000)
+
+        moved = {}
+        for tablename in self._get_hash_partitioned_tables():
+            try:
+                checkpoint = self._service.get_entity(
+                    self._azure_config["status_table"],
+                    "partition_migration",
+                    tablename)
+                if checkpoint["partitions"] != partitions:
+                    # the partition scheme changed again, start over
+                    checkpoint = None
+            except AzureMissingResourceHttpError:
+                checkpoint = None
+
+            if checkpoint is None:
+                checkpoint = {"PartitionKey": "partition_migration",
+                              "RowKey": tablename,
+                              "partitions": partitions,
+                              "marker": None,
+                              "moved": 0,
+                              "done": False}
+            else:
+                checkpoint = {key: value for key, value in checkpoint.items()
+                              if key not in ["Timestamp", "etag"]}
+
+            while not checkpoint["done"]:
+                entities = self._service.query_entities(
+                    tablename,
+                    num_results=batch_size,
+                    # null properties are not stored
+                    marker=json.loads(checkpoint["marker"]) if checkpoint.get("marker") else None)
+                for entity in entities:
+                    if self._repartition(tablename, entity):
+                        checkpoint["moved"] = checkpoint["moved"] + 1
+
+                if entities.next_marker:
+                    checkpoint["marker"] = json.dumps(entities.next_marker)
+                else:
+                    checkpoint["marker"] = None
+                    checkpoint["done"] = True
+                self._service.insert_or_replace_entity(
+                    self._azure_config["status_table"],
+                    checkpoint)
+                if on_progress:
+                    on_progress(tablename, checkpoint["moved"])
+            moved[tablename] = checkpoint["moved"]
+        return moved
+
+    def _index_customer(self, operation):
+        try:
+            self._service.insert_entity(
+                self._operation_tables["customer"],
+                self._get_with_ck("customer", operation))
+            return True
+        except AzureConflictHttpError:
+            # written by the services in between, which is the newer copy
+            return False
+
+    def build_customer_index(self, batch_size=None):
+        """
+        Writes all operations into the customer table that are not in it yet, which are
+        the ones stored before the customer table existed. Can run while the services are
+        running and again. Returns the number of added operations
+
+        :param batch_size: operations per page, default operation_storage.batch_size
+        :type batch_size: int
+        """
+        if batch_size is None:
+            batch_size = Config.get("operation_storage", "batch_size", 1000)
+
+        added = 0
+        for status in ["in_progress", "pending", "completed", "failed"]:
+            page = []
+            for operation in itertools.chain(self._iter_operations(status, None, None, batch_size), [None]):
+                if operation is not None:
+                    for key in ["PartitionKey", "RowKey", "Timestamp", "etag"]:
+                        operation.pop(key, None)
+                    page.append(operation)
+                if page and (operation is None or len(page) == batch_size):
+                    added = added + sum(self._executor.map(self._index_customer, page))
+                    page = []
+        return added
 
     @retry_auto_reconnect
     def track_address(self, address, usage="balance"):
@@ -165,62 +371,314 @@ class AzureOperationsStorage(BasicOperationStorage):
                 self._short_digit_hash(address),
                 address)
         except AzureMissingResourceHttpError:
+            if self._repartition_legacy(self._azure_config["address_table"] + usage, address):
+                return self.untrack_address(address, usage)
             raise AddressNotTrackedException()
 
-    def _update(self, operation, status=None):
-        try:
-            for variant in self._operation_varients:
-                operation = self._get_with_ck(variant, operation)
-                new_operation = operation.copy()
-                if status:
-                    tmp = self.get_operation(operation["incident_id"])
-                    new_operation["timestamp"] = tmp["timestamp"]
-                    new_operation["status"] = status
-                    new_operation = self._get_with_ck(variant, new_operation)
-                if variant == "status":
-                    # needs delete and insert
+    def _add_to_balances(self, operation):
+        """
+        Adds the given completed operation to the balance ledger. Table storage has no
+        increment, the balance is updated optimistically with the etag of the read
+
+        :param operation: completed operation struct
+        :type operation: dict
+        """
+        tablename = self._azure_config["balance_table"]
+        for address, asset_id, amount in self._get_balance_changes(operation):
+            while True:
+                try:
+                    balance = self._service.get_entity(tablename, address, asset_id)
+                except AzureMissingResourceHttpError:
+                    balance = None
+                try:
+                    if balance is None:
+                        self._service.insert_entity(
+                            tablename,
+                            {"PartitionKey": address,
+                             "RowKey": asset_id,
+                             "customer_id": operation["customer_id"],
+                             "balance": amount,
+                             "block_num": operation["block_num"]})
+                    else:
+                        self._service.merge_entity(
+                            tablename,
+                            {"PartitionKey": address,
+                             "RowKey": asset_id,
+                             "balance": balance["balance"] + amount,
+                             "block_num": max(balance["block_num"], operation["block_num"])},
+                            if_match=balance["etag"])
+                    break
+                except AzureConflictHttpError:
+                    # inserted in between
+                    continue
+                except AzureHttpError as e:
+                    if e.status_code != 412:
+                        raise
+                    # changed in between
+
+    def _rebuild_balances(self, customer_ids=None):
+        """
+        Recomputes the balance ledger from the completed operations, of the given
+        customers or of all. Returns the number of (address, asset) balances
+
+        :param customer_ids: customers whose balances are recomputed, default all
+        :type customer_ids: list of str
+        """
+        tablename = self._azure_config["balance_table"]
+        if customer_ids is None:
+            operations = self.iter_operations_completed(projection=BALANCE_FIELDS)
+            balances = self._service.query_entities(tablename)
+        else:
+            operations = itertools.chain.from_iterable(
+                self.iter_operations_completed(
+                    filter_by={"customer_id": customer_id},
+                    projection=BALANCE_FIELDS)
+                for customer_id in set(customer_ids))
+            balances = itertools.chain.from_iterable(
+                self._service.query_entities(
+                    tablename,
+                    "customer_id eq '" + customer_id + "'")
+                for customer_id in set(customer_ids))
+
+        ledger = self._get_balance_ledger(operations)
+        balances = list(balances)
+
+        # replaced per (address, asset) and stale balances deleted afterwards, so that
+        # concurrent ledger updates never see a missing balance
+        for (address, asset_id), entry in ledger.items():
+            self._service.insert_or_replace_entity(
+                tablename,
+                {"PartitionKey": address,
+                 "RowKey": asset_id,
+                 "customer_id": split_unique_address(address)["customer_id"],
+                 "balance": entry["balance"],
+                 "block_num": entry["block_num"]})
+        for balance in balances:
+            if (balance["PartitionKey"], balance["RowKey"]) not in ledger:
+                try:
                     self._service.delete_entity(
-                        self._operation_tables[variant],
-                        operation["PartitionKey"],
-                        operation["RowKey"])
-                    self._service.insert_entity(
-                        self._operation_tables[variant],
-                        new_operation)
-                else:
-                    self._service.update_entity(
-                        self._operation_tables[variant],
-                        new_operation)
+                        tablename,
+                        balance["PartitionKey"],
+                        balance["RowKey"])
+                except AzureMissingResourceHttpError:
+                    pass
+        return len(ledger)
+
+    @retry_auto_reconnect
+    def rebuild_balances(self):
+        return self._rebuild_balances()
+
+    def _get_batches(self, variant, action, entities, compensation, compensation_entities=None):
+        """
+        Groups the writes of the given entities into entity group transactions, which
+        are atomic and need a single round-trip for up to 100 entities that share a partition.
+        Returns a list of (commit, compensate) callables, compensate undoes its commit
+
+        :param variant: operation variant the entities belong to
+        :type variant: str
+        :param action: write of the entities, one of the entity writes of the table service,
+            updates, merges and deletes are conditional on the etag of an entity if given
+        :type action: str
+        :param entities: entities to write
+        :type entities: list of dict
+        :param compensation: write that undoes the action
+        :type compensation: str
+        :param compensation_entities: entities the compensation writes, in the same order as
+            entities, default are the entities themselves
+        :type compensation_entities: list of dict
+        """
+        tablename = self._operation_tables[variant]
+        if compensation_entities is None:
+            compensation_entities = entities
+
+        partitions = collections.OrderedDict()
+        for entity, compensation_entity in zip(entities, compensation_entities):
+            partitions.setdefault(entity["PartitionKey"], []).append((entity, compensation_entity))
+
+        batches = []
+        for pairs in partitions.values():
+            for index in range(0, len(pairs), MAX_BATCH_SIZE):
+                chunk = pairs[index:index + MAX_BATCH_SIZE]
+                batches.append((
+                    functools.partial(self._commit_batch, tablename, action, [x[0] for x in chunk]),
+                    functools.partial(self._commit_batch, tablename, compensation, [x[1] for x in chunk])))
+        return batches
+
+    def _commit_batch(self, tablename, action, entities):
+        if len(entities) == 1:
+            # no need for the overhead of a transaction
+            entity = entities[0].copy()
+            if_match = entity.pop("etag", "*")
+            if action == "delete_entity":
+                self._service.delete_entity(
+                    tablename, entity["PartitionKey"], entity["RowKey"], if_match=if_match)
+            elif action.startswith("insert"):
+                getattr(self._service, action)(tablename, entity)
+            else:
+                getattr(self._service, action)(tablename, entity, if_match=if_match)
+            return
+
+        batch = TableBatch()
+        for entity in entities:
+            entity = entity.copy()
+            if_match = entity.pop("etag", "*")
+            if action == "delete_entity":
+                batch.delete_entity(entity["PartitionKey"], entity["RowKey"], if_match=if_match)
+            elif action.startswith("insert"):
+                getattr(batch, action)(entity)
+            else:
+                getattr(batch, action)(entity, if_match=if_match)
+        try:
+            self._service.commit_batch(tablename, batch)
+        except AzureBatchOperationError as e:
+            # raise as the same exception as the single entity write
+            raise AzureHttpError(str(e), e.status_code)
+
+    def _write(self, batches):
+        """
+        Commits the given batches concurrently, so that the writes to all variant tables
+        take the latency of one round-trip. If a batch fails, the committed ones are
+        compensated to keep the variant tables consistent and the error is raised
+
+        :param batches: list of (commit, compensate) as returned by :func:`_get_batches`
+        :type batches: list
+        """
+        if len(batches) == 1:
+            batches[0][0]()
+            return
+
+        futures = [(self._executor.submit(commit), compensate) for commit, compensate in batches]
+        committed = []
+        errors = []
+        for future, compensate in futures:
+            try:
+                future.result()
+                committed.append(compensate)
+            except Exception as e:
+                errors.append(e)
+        if not errors:
+            return
+
+        for compensate in committed:
+            try:
+                compensate()
+            except Exception as e:
+                logging.getLogger(__name__).error(
+                    "Compensating a partially failed write failed, variant tables are inconsistent: " + str(e))
+        raise errors[0]
+
+    def _update(self, operation, status, from_status=None, changes=None, remove=None):
+        """
+        Changes the status of the given operation. The incident variant is read once,
+        all other fields (e.g. the timestamp) are kept as stored. The write of the
+        incident variant is conditional on the etag of that read, a concurrent change
+        fails it and the writes of the other variants are compensated with what was
+        stored. The status variant is partitioned by status, the entity is moved to the
+        new partition. Returns the updated operation
+
+        :param operation: operation to update, identified by its incident_id
+        :type operation: dict
+        :param status: new status
+        :type status: str
+        :param from_status: statuses the stored operation may have, default any
+        :type from_status: list of str
+        :param changes: fields to set besides the status, e.g. the block_num
+        :type changes: dict
+        :param remove: fields to remove from the stored operation, merging can not remove
+            fields, the variants are then replaced
+        :type remove: list of str
+        """
+        try:
+            stored = self._service.get_entity(
+                self._operation_tables["incident"],
+                self._short_digit_hash(operation["incident_id"]),
+                operation["incident_id"])
+        except AzureMissingResourceHttpError:
+            if self._repartition_legacy(self._operation_tables["incident"], operation["incident_id"]):
+                return self._update(operation, status, from_status, changes, remove)
+            raise OperationNotFoundException()
+        etag = stored.pop("etag")
+        for key in ["PartitionKey", "RowKey", "Timestamp"]:
+            stored.pop(key)
+        if stored["chain_identifier"] != operation["chain_identifier"] or\
+                (from_status is not None and stored["status"] not in from_status):
+            raise OperationNotFoundException()
+
+        # only what changes is written, merging keeps the other fields
+        merged = dict(changes or {}, status=status)
+        new_operation = stored.copy()
+        new_operation.update(merged)
+        for key in remove or []:
+            new_operation.pop(key, None)
+
+        if remove:
+            incident_entity = self._get_with_ck("incident", new_operation)
+        else:
+            incident_entity = dict(merged, **self._operation_prep["incident"](stored))
+        incident_entity["etag"] = etag
+        batches = self._get_batches(
+            "incident", "update_entity" if remove else "merge_entity", [incident_entity],
+            "update_entity", [self._get_with_ck("incident", stored)])
+        # operations stored before the customer table are only in it after
+        # build_customer_index, written completely the update adds them
+        batches.extend(self._get_batches(
+            "customer", "insert_or_replace_entity" if remove else "insert_or_merge_entity",
+            [self._get_with_ck("customer", new_operation)],
+            "insert_or_replace_entity", [self._get_with_ck("customer", stored)]))
+
+        old_status_entity = self._get_with_ck("status", stored)
+        new_status_entity = self._get_with_ck("status", new_operation)
+        if old_status_entity["PartitionKey"] != new_status_entity["PartitionKey"]:
+            batches.extend(self._get_batches(
+                "status", "delete_entity", [old_status_entity], "insert_entity"))
+            batches.extend(self._get_batches(
+                "status", "insert_entity", [new_status_entity], "delete_entity"))
+        else:
+            batches.extend(self._get_batches(
+                "status", "update_entity", [new_status_entity], "update_entity", [old_status_entity]))
+
+        try:
+            self._write(batches)
         except AzureMissingResourceHttpError:
             raise OperationNotFoundException()
         except AzureConflictHttpError:
             raise DuplicateOperationException()
+        except AzureHttpError as e:
+            if e.status_code == 412:
+                # changed in between
+                raise DuplicateOperationException()
+            raise
+        return new_operation
 
     def _insert(self, operation):
         try:
+            batches = []
             for variant in self._operation_varients:
                 to_insert = operation.copy()
                 to_insert.update(self._operation_prep[variant](to_insert))
-                if not to_insert["PartitionKey"]:
+                # operations without customer are valid, but need an incident and a status
+                if not to_insert["PartitionKey"] and variant != "customer":
                     raise AzureMissingResourceHttpError()
                 if not to_insert["RowKey"]:
                     raise AzureMissingResourceHttpError()
-                self._service.insert_entity(
-                    self._operation_tables[variant],
-                    to_insert
-                )
+                batches.extend(self._get_batches(
+                    variant, "insert_entity", [to_insert], "delete_entity"))
+            self._write(batches)
         except AzureConflictHttpError:
             raise DuplicateOperationException()
 
     def _delete(self, operation):
         try:
+            batches = []
             for variant in self._operation_varients:
                 to_delete = operation.copy()
                 to_delete.update(self._operation_prep[variant](to_delete))
-                self._service.delete_entity(
-                    self._operation_tables[variant],
-                    to_delete["PartitionKey"],
-                    to_delete["RowKey"])
+                batches.extend(self._get_batches(
+                    variant, "delete_entity", [to_delete], "insert_entity"))
+            self._write(batches)
         except AzureMissingResourceHttpError:
+            if self._repartition_legacy(self._operation_tables["incident"], operation["incident_id"]):
+                return self._delete(operation)
             raise OperationNotFoundException()
 
     @retry_auto_reconnect
@@ -228,14 +686,84 @@ class AzureOperationsStorage(BasicOperationStorage):
         # do basics
         operation = super(AzureOperationsStorage, self).flag_operation_completed(operation)
 
-        self._update(operation, status="completed")
+        self._add_to_balances(self._update(
+            operation, "completed",
+            from_status=["in_progress", "pending"],
+            changes={"block_num": operation["block_num"]}))
+
+    @retry_auto_reconnect
+    def flag_operation_pending(self, operation):
+        # do basics
+        operation = super(AzureOperationsStorage, self).flag_operation_pending(operation)
+
+        self._update(
+            operation, "pending",
+            from_status=["in_progress"],
+            changes={"block_num": operation["block_num"]})
+
+    @retry_auto_reconnect
+    def promote_pending_operations(self, start_block, end_block):
+        pending = list(self._service.query_entities(
+            self._operation_tables["status"],
+            "PartitionKey eq 'pending' and block_num ge " + str(start_block) +
+            " and block_num le " + str(end_block)))
+        if not pending:
+            return 0
+
+        completed = []
+        for operation in pending:
+            operation.pop("PartitionKey")
+            operation.pop("RowKey")
+            operation.pop("Timestamp")
+            operation.pop("etag")
+            completed.append(dict(operation, status="completed"))
+
+        # all pending operations share the partition in the status table, same
+        # for the completed ones, the customer table is partitioned by customer
+        # and the incident table by hash
+        batches = self._get_batches(
+            "status", "delete_entity",
+            [self._get_with_ck("status", x) for x in pending], "insert_entity")
+        batches.extend(self._get_batches(
+            "status", "insert_entity",
+            [self._get_with_ck("status", x) for x in completed], "delete_entity"))
+        batches.extend(self._get_batches(
+            "incident", "update_entity",
+            [self._get_with_ck("incident", x) for x in completed], "update_entity",
+            [self._get_with_ck("incident", x) for x in pending]))
+        # see _update, the operation might not be in the customer table yet
+        batches.extend(self._get_batches(
+            "customer", "insert_or_replace_entity",
+            [self._get_with_ck("customer", x) for x in completed], "insert_or_replace_entity",
+            [self._get_with_ck("customer", x) for x in pending]))
+        try:
+            self._write(batches)
+        except AzureMissingResourceHttpError:
+            raise OperationNotFoundException()
+        except AzureConflictHttpError:
+            raise DuplicateOperationException()
+
+        for operation in completed:
+            self._add_to_balances(operation)
+        return len(completed)
+
+    @retry_auto_reconnect
+    def revert_operation_completed(self, operation):
+        # do basics
+        operation = super(AzureOperationsStorage, self).revert_operation_completed(operation)
+
+        self._update(
+            operation, "in_progress",
+            from_status=[operation["status"]],
+            remove=["block_num"])
+        if operation["status"] == "completed":
+            self._rebuild_balances([operation["customer_id"]])
 
     @retry_auto_reconnect
     def flag_operation_failed(self, operation, message=None):
         # do basics
         operation = super(AzureOperationsStorage, self).flag_operation_failed(operation)
-        operation["message"] = message
-        self._update(operation, status="failed")
+        self._update(operation, "failed", changes={"message": message})
 
     @retry_auto_reconnect
     def insert_operation(self, operation):
@@ -243,6 +771,8 @@ class AzureOperationsStorage(BasicOperationStorage):
         operation = super(AzureOperationsStorage, self).insert_operation(operation)
 
         self._insert(operation)
+        if operation["status"] == "completed":
+            self._add_to_balances(operation)
 
     @retry_auto_reconnect
     def insert_or_update_operation(self, operation):
@@ -251,17 +781,138 @@ class AzureOperationsStorage(BasicOperationStorage):
 
         try:
             self._insert(operation)
+            if operation["status"] == "completed":
+                self._add_to_balances(operation)
         except DuplicateOperationException as ex:
-            # could be an update to completed ...
+            # could be an update to completed or pending ...
             if operation.get("block_num"):
                 try:
-                    operation.pop("status")
-                    self.flag_operation_completed(operation)
+                    if operation.pop("status") == "pending":
+                        self.flag_operation_pending(operation)
+                    else:
+                        self.flag_operation_completed(operation)
                 except OperationNotFoundException:
                     raise ex
             else:
                 raise ex
 
+    def _insert_variant(self, variant, operations):
+        """
+        Inserts the given operations into the table of the variant with entity group
+        transactions. A transaction with an entity that exists already is rolled back
+        as a whole, its entities are then inserted one by one. Returns the indices of
+        the operations that exist already
+
+        :param variant: operation variant
+        :type variant: str
+        :param operations: operations to insert
+        :type operations: list of dict
+        """
+        tablename = self._operation_tables[variant]
+
+        partitions = collections.OrderedDict()
+        for index, operation in enumerate(operations):
+            entity = self._get_with_ck(variant, operation)
+            partitions.setdefault(entity["PartitionKey"], []).append((index, entity))
+        chunks = [pairs[start:start + MAX_BATCH_SIZE]
+                  for pairs in partitions.values()
+                  for start in range(0, len(pairs), MAX_BATCH_SIZE)]
+
+        def insert(chunk):
+            try:
+                self._commit_batch(tablename, "insert_entity", [entity for _, entity in chunk])
+                return []
+            except AzureConflictHttpError:
+                if len(chunk) == 1:
+                    return [chunk[0][0]]
+                return [index for pair in chunk for index in insert([pair])]
+
+        return set(itertools.chain.from_iterable(self._executor.map(insert, chunks)))
+
+    def _bulk_insert(self, operations):
+        """
+        Inserts the given operations with entity group transactions per variant table,
+        returns the indices of the ones that exist already or earlier in the list
+
+        :param operations: operations as returned by :func:`_prepare_operations`
+        :type operations: list of dict
+        """
+        duplicates = set()
+        keys = set()
+        for index, operation in enumerate(operations):
+            # the same row key twice fails the whole transaction
+            if operation["incident_id"] in keys or operation["chain_identifier"] in keys:
+                duplicates.add(index)
+            keys.update([operation["incident_id"], operation["chain_identifier"]])
+
+        # the incident variant decides which operations are new, only those are
+        # written to the other variants
+        remaining = [index for index in range(len(operations)) if index not in duplicates]
+        existing = self._insert_variant("incident", [operations[index] for index in remaining])
+        inserted = [index for position, index in enumerate(remaining) if position not in existing]
+        duplicates.update(remaining[position] for position in existing)
+
+        conflicts = {}
+        for variant in self._operation_varients:
+            if variant == "incident":
+                continue
+            conflicts[variant] = set(
+                inserted[position] for position in
+                self._insert_variant(variant, [operations[index] for index in inserted]))
+
+        # stored with another incident id, undo what was written for these
+        failed = set(itertools.chain.from_iterable(conflicts.values()))
+        for index in failed:
+            for variant in self._operation_varients:
+                if index in conflicts.get(variant, set()):
+                    continue
+                entity = self._get_with_ck(variant, operations[index])
+                self._service.delete_entity(
+                    self._operation_tables[variant],
+                    entity["PartitionKey"],
+                    entity["RowKey"])
+        return sorted(duplicates | failed)
+
+    @retry_auto_reconnect
+    def insert_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = ["invalid" if operation is None else "inserted" for operation in operations]
+        indices = [index for index, operation in enumerate(operations) if operation is not None]
+
+        for index in self._bulk_insert([operations[index] for index in indices]):
+            results[indices[index]] = "duplicate"
+
+        for operation, result in zip(operations, results):
+            if result == "inserted" and operation["status"] == "completed":
+                self._add_to_balances(operation)
+        return results
+
+    @retry_auto_reconnect
+    def insert_or_update_operations(self, operations):
+        results = self.insert_operations(operations)
+
+        for index, result in enumerate(results):
+            if result != "duplicate":
+                continue
+            operation = operations[index]
+            if operation.get("op"):
+                operation = self._decode_operation(operation)
+            else:
+                operation = operation.copy()
+            # could be an update to completed or pending ...
+            if not operation.get("block_num"):
+                continue
+            try:
+                if operation.pop("status", None) == "pending":
+                    self.flag_operation_pending(operation)
+                else:
+                    self.flag_operation_completed(operation)
+                results[index] = "updated"
+            except (OperationNotFoundException, DuplicateOperationException):
+                pass
+        return results
+
     @retry_auto_reconnect
     def delete_operation(self, operation_or_incident_id):
         # do basics
@@ -272,6 +923,8 @@ class AzureOperationsStorage(BasicOperationStorage):
         else:
             operation = operation_or_incident_id
         self._delete(operation)
+        if operation["status"] == "completed":
+            self._rebuild_balances([operation["customer_id"]])
 
     @retry_auto_reconnect
     def get_operation(self, incident_id):
@@ -285,6 +938,8 @@ class AzureOperationsStorage(BasicOperationStorage):
             operation.pop("Timestamp")
             operation.pop("etag")
         except AzureMissingResourceHttpError:
+            if self._repartition_legacy(self._operation_tables["incident"], incident_id):
+                return self.get_operation(incident_id)
             raise OperationNotFoundException()
         return operation
 
@@ -318,37 +973,14 @@ class AzureOperationsStorage(BasicOperationStorage):
 
         for address in addresses:
             addrs = split_unique_address(address)
-            max_block_number = 0
-            for operation in self.get_operations_completed(
-                    filter_by={
-                        "customer_id": addrs["customer_id"]
-                    }):
-                this_block_num = operation["block_num"]
-                asset_id = operation["amount_asset_id"]
-                if addrs["account_id"] == operation["from"]:
-                    # negative
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance - operation["amount_value"]
-
-                    # fee as well
-                    asset_id = operation["fee_asset_id"]
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance - operation["fee_value"]
-                elif addrs["account_id"] == operation["to"]:
-                    # positive
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance + operation["amount_value"]
-                else:
-                    raise InvalidOperationException()
-                max_block_number = max(max_block_number, this_block_num)
-            if max_block_number > 0:
-                address_balances[address]["block_num"] = max_block_number
+            # one partition per address in the ledger
+            for balance in self._service.query_entities(
+                    self._azure_config["balance_table"],
+                    "PartitionKey eq '" + addrs["account_id"] + DELIMITER + addrs["customer_id"] + "'"):
+                address_balances[address][balance["RowKey"]] = balance["balance"]
+                address_balances[address]["block_num"] = max(
+                    address_balances[address].get("block_num", 0),
+                    balance["block_num"])
 
         # do not return default dicts
         for key, value in address_balances.items():
@@ -367,44 +999,70 @@ class AzureOperationsStorage(BasicOperationStorage):
                 raise Exception("Filter not supported")
         return {}
 
-    @retry_auto_reconnect
-    def get_operations_in_progress(self, filter_by=None):
-        filter_dict = {"status": "in_progress"}
+    def _iter_operations(self, status, filter_by, projection, batch_size):
+        filter_dict = {"status": status}
         filter_dict.update(self._parse_filter(filter_by))
 
-        filter_str = "PartitionKey eq '" + filter_dict.get("status") + "'"
         if filter_dict.get("customer_id"):
-            filter_str = filter_str + " and customer_id eq '" + str(filter_dict.get("customer_id")) + "'"
+            # only the partition of the customer instead of all operations with the status
+            tablename = self._operation_tables["customer"]
+            filter_str = "PartitionKey eq '" + str(filter_dict.get("customer_id")) + "'" +\
+                " and status eq '" + filter_dict.get("status") + "'"
+        else:
+            tablename = self._operation_tables["status"]
+            filter_str = "PartitionKey eq '" + filter_dict.get("status") + "'"
 
-        return list(self._service.query_entities(
-            self._operation_tables["status"],
-            filter_str))
+        select = None
+        if projection:
+            select = ",".join(projection)
+
+        # the generator of query_entities follows the continuation itself, but
+        # only takes the number of results in total
+        marker = None
+        while True:
+            entities = self._service.query_entities(
+                tablename,
+                filter_str,
+                select=select,
+                num_results=batch_size,
+                marker=marker)
+            for entity in entities:
+                yield entity
+            marker = entities.next_marker
+            if not batch_size or not marker:
+                return
 
     @retry_auto_reconnect
-    def get_operations_completed(self, filter_by=None):
-        filter_dict = {"status": "completed"}
-        filter_dict.update(self._parse_filter(filter_by))
+    def get_operations_in_progress(self, filter_by=None):
+        return list(self._iter_operations("in_progress", filter_by, None, None))
 
-        filter_str = "PartitionKey eq '" + filter_dict.get("status") + "'"
-        if filter_dict.get("customer_id"):
-            filter_str = filter_str + " and customer_id eq '" + str(filter_dict.get("customer_id")) + "'"
+    @retry_auto_reconnect
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("in_progress", filter_by, projection, batch_size)
 
-        return list(self._service.query_entities(
-            self._operation_tables["status"],
-            filter_str))
+    @retry_auto_reconnect
+    def get_operations_pending(self, filter_by=None):
+        return list(self._iter_operations("pending", filter_by, None, None))
 
     @retry_auto_reconnect
-    def get_operations_failed(self, filter_by=None):
-        filter_dict = {"status": "failed"}
-        filter_dict.update(self._parse_filter(filter_by))
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("pending", filter_by, projection, batch_size)
 
-        filter_str = "PartitionKey eq '" + filter_dict.get("status") + "'"
-        if filter_dict.get("customer_id"):
-            filter_str = filter_str + " and customer_id eq '" + str(filter_dict.get("customer_id")) + "'"
+    @retry_auto_reconnect
+    def get_operations_completed(self, filter_by=None):
+        return list(self._iter_operations("completed", filter_by, None, None))
 
-        return list(self._service.query_entities(
-            self._operation_tables["status"],
-            filter_str))
+    @retry_auto_reconnect
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("completed", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_operations_failed(self, filter_by=None):
+        return list(self._iter_operations("failed", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("failed", filter_by, projection, batch_size)
 
     @retry_auto_reconnect
     def get_last_head_block_num(self):
@@ -427,3 +1085,25 @@ class AzureOperationsStorage(BasicOperationStorage):
             {"PartitionKey": "head_block_num",
              "RowKey": "last",
              "last_head_block_num": head_block_num})
+
+    @retry_auto_reconnect
+    def get_last_backfill_block_num(self, shard):
+        try:
+            document = self._service.get_entity(
+                self._azure_config["status_table"],
+                "backfill",
+                shard)
+            return document["last_block_num"]
+        except AzureMissingResourceHttpError:
+            return 0
+
+    @retry_auto_reconnect
+    def set_last_backfill_block_num(self, shard, block_num):
+        if self.get_last_backfill_block_num(shard) >= block_num:
+            # shards are processed again after an interruption
+            return
+        self._service.insert_or_replace_entity(
+            self._azure_config["status_table"],
+            {"PartitionKey": "backfill",
+             "RowKey": shard,
+             "last_block_num": block_num})
@@ -0,0 +1,259 @@
+import collections
+import threading
+import time
+
+from .interface import IAddressOperationStorage
+from . import operation_formatter
+
+
+class CachingOperationStorage(IAddressOperationStorage):
+    """
+    Read-through cache in front of any :class:`.interface.IOperationStorage`, for the
+    reads that clients poll: :func:`get_operation` is kept in a bounded LRU cache,
+    :func:`get_last_head_block_num` for a short time. Everything else is passed to the
+    wrapped storage, including methods that are specific to it.
+
+    The mutators of this wrapper invalidate what they change. Writes of other processes,
+    e.g. the blockchain monitor completing an operation the manage service caches, are
+    seen after ``operation_ttl_in_sec``
+
+    :param storage: the wrapped storage
+    :type storage: :class:`.interface.IOperationStorage`
+    :param cache_config: ``operation_storage.cache`` of the configuration, with the keys
+                         ``operation_size``, ``operation_ttl_in_sec`` and
+                         ``head_block_ttl_in_sec``
+    :type cache_config: dict
+    """
+
+    def __init__(self, storage, cache_config=None):
+        super(CachingOperationStorage, self).__init__()
+
+        cache_config = cache_config or {}
+        self._storage = storage
+        self._operation_size = cache_config.get("operation_size", 10000)
+        self._operation_ttl_in_sec = cache_config.get("operation_ttl_in_sec", 2)
+        self._head_block_ttl_in_sec = cache_config.get("head_block_ttl_in_sec", 1)
+
+        self._lock = threading.Lock()
+        # incident_id -> (expires, operation), least recently used first
+        self._operations = collections.OrderedDict()
+        # chain_identifier -> incident_id of the cached operations
+        self._incident_ids = {}
+        # increased with every invalidation, reads that started before don't fill the cache
+        self._generation = 0
+        # (expires, head block num)
+        self._head_block_num = None
+        self._statistics = {
+            "operation": {"hits": 0, "misses": 0, "evictions": 0},
+            "head_block_num": {"hits": 0, "misses": 0}
+        }
+
+    def __getattr__(self, name):
+        # e.g. reconcile_indexes or migrate_partitions of the wrapped storage
+        if name == "_storage":
+            raise AttributeError(name)
+        return getattr(self._storage, name)
+
+    def get_statistics(self):
+        """
+        Returns the hits and misses of both caches, the evictions and the size of the
+        operation cache
+        """
+        with self._lock:
+            statistics = {key: value.copy() for key, value in self._statistics.items()}
+            statistics["operation"]["size"] = len(self._operations)
+        return statistics
+
+    def clear(self):
+        """
+        Empties both caches, e.g. after the storage was changed by another process
+        """
+        with self._lock:
+            self._generation = self._generation + 1
+            self._operations.clear()
+            self._incident_ids.clear()
+            self._head_block_num = None
+
+    def _uncache(self, incident_id):
+        expires, operation = self._operations.pop(incident_id)
+        self._incident_ids.pop(operation["chain_identifier"], None)
+
+    def _invalidate(self, operations):
+        """
+        Removes the given operations from the cache, by incident_id or chain_identifier
+
+        :param operations: operations structs, in any format the storage accepts, or incident ids
+        :type operations: list
+        """
+        with self._lock:
+            self._generation = self._generation + 1
+            for operation in operations:
+                if type(operation) == str:
+                    incident_ids = [operation]
+                else:
+                    if operation.get("op"):
+                        operation = operation_formatter.decode_operation(operation)
+                    incident_ids = [operation.get("incident_id"),
+                                    self._incident_ids.get(operation.get("chain_identifier"))]
+                for incident_id in incident_ids:
+                    if incident_id in self._operations:
+                        self._uncache(incident_id)
+
+    def get_operation(self, incident_id):
+        with self._lock:
+            cached = self._operations.get(incident_id)
+            if cached is not None and cached[0] > time.monotonic():
+                self._operations.move_to_end(incident_id)
+                self._statistics["operation"]["hits"] += 1
+                return cached[1].copy()
+            self._statistics["operation"]["misses"] += 1
+            generation = self._generation
+
+        operation = self._storage.get_operation(incident_id)
+
+        with self._lock:
+            if generation == self._generation:
+                if incident_id in self._operations:
+                    self._uncache(incident_id)
+                self._operations[incident_id] = (
+                    time.monotonic() + self._operation_ttl_in_sec,
+                    operation.copy())
+                self._incident_ids[operation["chain_identifier"]] = incident_id
+                while len(self._operations) > self._operation_size:
+                    self._uncache(next(iter(self._operations)))
+                    self._statistics["operation"]["evictions"] += 1
+        return operation
+
+    def get_last_head_block_num(self):
+        with self._lock:
+            if self._head_block_num is not None and self._head_block_num[0] > time.monotonic():
+                self._statistics["head_block_num"]["hits"] += 1
+                return self._head_block_num[1]
+            self._statistics["head_block_num"]["misses"] += 1
+
+        head_block_num = self._storage.get_last_head_block_num()
+
+        with self._lock:
+            self._head_block_num = (
+                time.monotonic() + self._head_block_ttl_in_sec,
+                head_block_num)
+        return head_block_num
+
+    def set_last_head_block_num(self, head_block_num):
+        try:
+            self._storage.set_last_head_block_num(head_block_num)
+        except Exception:
+            with self._lock:
+                self._head_block_num = None
+            raise
+        with self._lock:
+            self._head_block_num = (
+                time.monotonic() + self._head_block_ttl_in_sec,
+                head_block_num)
+
+    def flag_operation_completed(self, operation):
+        try:
+            return self._storage.flag_operation_completed(operation)
+        finally:
+            self._invalidate([operation])
+
+    def flag_operation_pending(self, operation):
+        try:
+            return self._storage.flag_operation_pending(operation)
+        finally:
+            self._invalidate([operation])
+
+    def promote_pending_operations(self, start_block, end_block):
+        try:
+            return self._storage.promote_pending_operations(start_block, end_block)
+        finally:
+            with self._lock:
+                self._generation = self._generation + 1
+                for incident_id, (expires, operation) in list(self._operations.items()):
+                    if operation["status"] == "pending" and\
+                            start_block <= operation["block_num"] <= end_block:
+                        self._uncache(incident_id)
+
+    def revert_operation_completed(self, operation):
+        try:
+            return self._storage.revert_operation_completed(operation)
+        finally:
+            self._invalidate([operation])
+
+    def flag_operation_failed(self, operation, message=None):
+        try:
+            return self._storage.flag_operation_failed(operation, message)
+        finally:
+            self._invalidate([operation])
+
+    def insert_operation(self, operation):
+        try:
+            return self._storage.insert_operation(operation)
+        finally:
+            self._invalidate([operation])
+
+    def insert_or_update_operation(self, operation):
+        try:
+            return self._storage.insert_or_update_operation(operation)
+        finally:
+            self._invalidate([operation])
+
+    def insert_operations(self, operations):
+        try:
+            return self._storage.insert_operations(operations)
+        finally:
+            self._invalidate(operations)
+
+    def insert_or_update_operations(self, operations):
+        try:
+            return self._storage.insert_or_update_operations(operations)
+        finally:
+            self._invalidate(operations)
+
+    def delete_operation(self, operation_or_incident_id):
+        try:
+            return self._storage.delete_operation(operation_or_incident_id)
+        finally:
+            self._invalidate([operation_or_incident_id])
+
+    def get_operations_in_progress(self, filter_by=None):
+        return self._storage.get_operations_in_progress(filter_by)
+
+    def get_operations_pending(self, filter_by=None):
+        return self._storage.get_operations_pending(filter_by)
+
+    def get_operations_completed(self, filter_by=None):
+        return self._storage.get_operations_completed(filter_by)
+
+    def get_operations_failed(self, filter_by=None):
+        return self._storage.get_operations_failed(filter_by)
+
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        return self._storage.iter_operations_in_progress(filter_by, projection, batch_size)
+
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        return self._storage.iter_operations_pending(filter_by, projection, batch_size)
+
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        return self._storage.iter_operations_completed(filter_by, projection, batch_size)
+
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        return self._storage.iter_operations_failed(filter_by, projection, batch_size)
+
+    def get_last_backfill_block_num(self, shard):
+        return self._storage.get_last_backfill_block_num(shard)
+
+    def set_last_backfill_block_num(self, shard, block_num):
+        return self._storage.set_last_backfill_block_num(shard, block_num)
+
+    def track_address(self, address, usage="balance"):
+        return self._storage.track_address(address, usage)
+
+    def untrack_address(self, address, usage="balance"):
+        return self._storage.untrack_address(address, usage)
+
+    def get_balances(self, take, continuation=None, addresses=None):
+        return self._storage.get_balances(take, continuation, addresses)
+
+    def rebuild_balances(self):
+        return self._storage.rebuild_balances()
@@ -0,0 +1,527 @@
+import atexit
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+
+from ..addresses import split_unique_address, DELIMITER
+from .interface import BasicOperationStorage
+from .exceptions import (
+    AddressNotTrackedException,
+    AddressAlreadyTrackedException,
+    InputInvalidException,
+    OperationNotFoundException,
+    DuplicateOperationException,
+    OperationStorageException)
+
+
+def _locked(func):
+    """
+    Runs the decorated method of the storage while holding its lock, the indexes are
+    only consistent between two calls
+    """
+    @functools.wraps(func)
+    def f_locked(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return f_locked
+
+
+class InMemoryOperationsStorage(BasicOperationStorage):
+    """
+    Implementation of :class:`.interface.IOperationStorage` and the address
+    specific :class:`.interface.IAddressOperationStorage` in the memory of the
+    process, using the default implementation :class:`.interface.BasicOperationStorage`
+
+    The operations are kept by chain_identifier, with hash indexes on incident_id,
+    customer_id and status, which serve the same lookups as the indexes of
+    :data:`.mongodb_storage.INDEXES`. Needs no service, e.g. to run the manage
+    service, the monitor and the benchmarks offline.
+
+    If a ``snapshot_file`` is configured, the storage is loaded from it on creating
+    an instance and written to it with :func:`snapshot`, :func:`close` and on exit.
+    """
+
+    def get_retry_exceptions(self):
+        # nothing that could be lost
+        return ()
+
+    def __init__(self, inmemory_config=None, purge=False):
+        super(InMemoryOperationsStorage, self).__init__()
+
+        self._inmemory_config = inmemory_config or {}
+        self._lock = threading.RLock()
+        self._clear()
+
+        snapshot_file = self._inmemory_config.get("snapshot_file")
+        if snapshot_file:
+            if not purge and os.path.exists(snapshot_file):
+                self._load(snapshot_file)
+            atexit.register(self.snapshot)
+
+    def _clear(self):
+        # chain_identifier -> operation, in insertion order
+        self._operations = {}
+        # incident_id -> chain_identifier
+        self._incident_index = {}
+        # customer_id -> chain_identifiers, status -> chain_identifiers, dicts are
+        # used as sets that keep the insertion order
+        self._customer_index = collections.defaultdict(dict)
+        self._status_index = collections.defaultdict(dict)
+        # address -> (sequence, usage), the sequence orders the pages of get_balances
+        self._addresses = {}
+        self._address_sequence = 0
+        # customer_id -> address -> asset_id -> {"balance": .., "block_num": ..}
+        self._balances = collections.defaultdict(dict)
+        self._last_head_block_num = 0
+        self._backfill_block_nums = {}
+
+    def _load(self, snapshot_file):
+        with open(snapshot_file, "r") as f:
+            snapshot = json.load(f)
+        for operation in snapshot["operations"]:
+            self._add_operation(operation)
+        for sequence, address, usage in snapshot["addresses"]:
+            self._addresses[address] = (sequence, usage)
+            self._address_sequence = max(self._address_sequence, sequence)
+        self._last_head_block_num = snapshot["last_head_block_num"]
+        self._backfill_block_nums = snapshot["backfill_block_nums"]
+        # the balance ledger is derived from the operations
+        self._rebuild_balances()
+        logging.getLogger(__name__).info("Loaded " + str(len(self._operations)) + " operations from " + snapshot_file)
+
+    @_locked
+    def snapshot(self):
+        """
+        Writes the whole storage to the configured ``snapshot_file``. The file is
+        replaced at once, an interrupted snapshot leaves the previous one. Returns the
+        number of written operations, None if no file is configured
+        """
+        snapshot_file = self._inmemory_config.get("snapshot_file")
+        if not snapshot_file:
+            return None
+        snapshot = {
+            "operations": list(self._operations.values()),
+            "addresses": [[sequence, address, usage]
+                          for address, (sequence, usage) in self._addresses.items()],
+            "last_head_block_num": self._last_head_block_num,
+            "backfill_block_nums": self._backfill_block_nums,
+        }
+        with open(snapshot_file + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(snapshot_file + ".tmp", snapshot_file)
+        return len(snapshot["operations"])
+
+    def close(self):
+        """
+        Writes the snapshot, if a ``snapshot_file`` is configured, and no further one on
+        exit
+        """
+        atexit.unregister(self.snapshot)
+        self.snapshot()
+
+    def _add_operation(self, operation):
+        chain_identifier = operation["chain_identifier"]
+        self._operations[chain_identifier] = operation
+        if operation.get("incident_id") is not None:
+            self._incident_index[operation["incident_id"]] = chain_identifier
+        self._customer_index[operation["customer_id"]][chain_identifier] = None
+        self._status_index[operation["status"]][chain_identifier] = None
+
+    def _remove_operation(self, operation):
+        chain_identifier = operation["chain_identifier"]
+        del self._operations[chain_identifier]
+        if operation.get("incident_id") is not None:
+            del self._incident_index[operation["incident_id"]]
+        self._customer_index[operation["customer_id"]].pop(chain_identifier)
+        if not self._customer_index[operation["customer_id"]]:
+            del self._customer_index[operation["customer_id"]]
+        self._status_index[operation["status"]].pop(chain_identifier)
+
+    def _set_status(self, operation, status):
+        self._status_index[operation["status"]].pop(operation["chain_identifier"])
+        operation["status"] = status
+        self._status_index[status][operation["chain_identifier"]] = None
+
+    def _find(self, operation, status=None):
+        """
+        Returns the stored operation with the chain_identifier of the given operation,
+        if it has one of the given statuses
+
+        :param operation: operations struct as defined in :func:`interface.IOperationStorage.insert_operation`.
+        :type operation: dict
+        :param status: allowed statuses, default all
+        :type status: list of str
+        """
+        stored = self._operations.get(operation["chain_identifier"])
+        if stored is None or (status is not None and stored["status"] not in status):
+            return None
+        return stored
+
+    def _insert(self, operation):
+        if operation["chain_identifier"] in self._operations or\
+                (operation.get("incident_id") is not None and
+                 operation["incident_id"] in self._incident_index):
+            raise DuplicateOperationException()
+        self._add_operation(operation)
+        if operation["status"] == "completed":
+            self._add_to_balances([operation])
+
+    def _add_to_balances(self, operations):
+        """
+        Adds the given completed operations to the balance ledger
+
+        :param operations: completed operations structs
+        :type operations: list of dict
+        """
+        for operation in operations:
+            addresses = self._balances[operation["customer_id"]]
+            for address, asset_id, amount in self._get_balance_changes(operation):
+                entry = addresses.setdefault(address, {}).setdefault(
+                    asset_id,
+                    {"balance": 0, "block_num": 0})
+                entry["balance"] = entry["balance"] + amount
+                entry["block_num"] = max(entry["block_num"], operation["block_num"])
+
+    def _rebuild_balances(self, customer_ids=None):
+        """
+        Recomputes the balance ledger from the completed operations, of the given
+        customers or of all. Returns the number of (address, asset) balances
+
+        :param customer_ids: customers whose balances are recomputed, default all
+        :type customer_ids: list of str
+        """
+        if customer_ids is None:
+            self._balances.clear()
+            customer_ids = list(self._customer_index.keys())
+
+        count = 0
+        for customer_id in set(customer_ids):
+            self._balances.pop(customer_id, None)
+            ledger = self._get_balance_ledger(
+                self._operations[chain_identifier]
+                for chain_identifier in self._customer_index.get(customer_id, {})
+                if chain_identifier in self._status_index["completed"])
+            for (address, asset_id), entry in ledger.items():
+                self._balances[customer_id].setdefault(address, {})[asset_id] = entry
+            count = count + len(ledger)
+        return count
+
+    @_locked
+    def rebuild_balances(self):
+        return self._rebuild_balances()
+
+    @_locked
+    def track_address(self, address, usage="balance"):
+        split = split_unique_address(address)
+        if not split.get("customer_id") or not split.get("account_id"):
+            raise OperationStorageException()
+        if address in self._addresses:
+            raise AddressAlreadyTrackedException
+        self._address_sequence = self._address_sequence + 1
+        self._addresses[address] = (self._address_sequence, usage)
+
+    @_locked
+    def untrack_address(self, address, usage="balance"):
+        if self._addresses.get(address, (None, None))[1] != usage:
+            raise AddressNotTrackedException()
+        del self._addresses[address]
+
+    @_locked
+    def flag_operation_completed(self, operation):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).flag_operation_completed(operation)
+
+        stored = self._find(operation, ["in_progress", "pending"])
+        if stored is None:
+            raise OperationNotFoundException()
+        self._set_status(stored, "completed")
+        stored["block_num"] = operation["block_num"]
+        self._add_to_balances([stored])
+
+    @_locked
+    def flag_operation_pending(self, operation):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).flag_operation_pending(operation)
+
+        stored = self._find(operation, ["in_progress"])
+        if stored is None:
+            raise OperationNotFoundException()
+        self._set_status(stored, "pending")
+        stored["block_num"] = operation["block_num"]
+
+    @_locked
+    def promote_pending_operations(self, start_block, end_block):
+        operations = [self._operations[chain_identifier]
+                      for chain_identifier in self._status_index["pending"]]
+        operations = [operation for operation in operations
+                      if start_block <= operation["block_num"] <= end_block]
+        for operation in operations:
+            self._set_status(operation, "completed")
+        self._add_to_balances(operations)
+        return len(operations)
+
+    @_locked
+    def revert_operation_completed(self, operation):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).revert_operation_completed(operation)
+
+        stored = self._find(operation, [operation["status"]])
+        if stored is None:
+            raise OperationNotFoundException()
+        self._set_status(stored, "in_progress")
+        stored.pop("block_num", None)
+
+        if operation["status"] == "completed":
+            self._rebuild_balances([stored["customer_id"]])
+
+    @_locked
+    def flag_operation_failed(self, operation, message=None):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).flag_operation_failed(operation)
+
+        stored = self._find(operation)
+        if stored is None:
+            raise OperationNotFoundException()
+        self._set_status(stored, "failed")
+        stored["message"] = message
+
+    @_locked
+    def insert_operation(self, operation):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).insert_operation(operation)
+
+        self._insert(operation)
+
+    @_locked
+    def insert_or_update_operation(self, operation):
+        # do basics
+        operation = super(InMemoryOperationsStorage, self).insert_operation(operation)
+
+        if operation.get("block_num"):
+            # could be an update to completed or pending, with the same transitions
+            # as flag_operation_completed and flag_operation_pending
+            if operation["status"] == "pending":
+                stored = self._find(operation, ["in_progress"])
+            else:
+                stored = self._find(operation, ["in_progress", "pending"])
+            if stored is not None:
+                self._set_status(stored, operation["status"])
+                stored["block_num"] = operation["block_num"]
+                if operation["status"] == "completed":
+                    self._add_to_balances([stored])
+                return
+
+        self._insert(operation)
+
+    @_locked
+    def insert_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = []
+        for operation in operations:
+            if operation is None:
+                results.append("invalid")
+                continue
+            try:
+                self._insert(operation)
+                results.append("inserted")
+            except DuplicateOperationException:
+                results.append("duplicate")
+        return results
+
+    @_locked
+    def insert_or_update_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = []
+        for operation in operations:
+            if operation is None:
+                results.append("invalid")
+                continue
+            try:
+                self._insert(operation)
+                results.append("inserted")
+                continue
+            except DuplicateOperationException:
+                pass
+            # could be an update to completed or pending ...
+            stored = None
+            if operation.get("block_num"):
+                stored = self._find(operation, ["in_progress", "pending"])
+            if stored is None or stored["status"] == operation["status"] or\
+                    (operation["status"] == "pending" and stored["status"] != "in_progress"):
+                results.append("duplicate")
+                continue
+            self._set_status(stored, operation["status"])
+            stored["block_num"] = operation["block_num"]
+            if operation["status"] == "completed":
+                self._add_to_balances([stored])
+            results.append("updated")
+        return results
+
+    @_locked
+    def delete_operation(self, operation_or_incident_id):
+        # do basics
+        operation_or_incident_id = super(InMemoryOperationsStorage, self).delete_operation(operation_or_incident_id)
+
+        if type(operation_or_incident_id) == str:
+            stored = self._operations.get(
+                self._incident_index.get(operation_or_incident_id))
+        else:
+            stored = self._find(operation_or_incident_id)
+        if stored is None:
+            raise OperationNotFoundException()
+        self._remove_operation(stored)
+
+        if stored["status"] == "completed":
+            self._rebuild_balances([stored["customer_id"]])
+
+    @_locked
+    def get_operation(self, incident_id):
+        stored = self._operations.get(self._incident_index.get(incident_id))
+        if stored is None:
+            raise OperationNotFoundException()
+        return stored.copy()
+
+    @_locked
+    def get_balances(self, take, continuation=None, addresses=None):
+        address_balances = collections.defaultdict(lambda: collections.defaultdict())
+
+        if not addresses:
+            # the continuation is the sequence of the last address of the previous page
+            after = 0
+            if continuation:
+                try:
+                    after = int(continuation)
+                except (ValueError, TypeError):
+                    raise InputInvalidException()
+                if str(after) != continuation:
+                    raise InputInvalidException()
+            if type(take) != int or take < 1:
+                raise InputInvalidException()
+
+            # tracked addresses are kept in the order of their sequence, one more to
+            # know if there is a next page
+            page = []
+            for address, (sequence, usage) in self._addresses.items():
+                if sequence > after and usage == "balance":
+                    page.append((sequence, address))
+                    if len(page) > take:
+                        break
+
+            addresses = [address for sequence, address in page[:take]]
+            if len(page) > take:
+                address_balances["continuation"] = str(page[take - 1][0])
+            else:
+                address_balances["continuation"] = None
+
+        if type(addresses) == str:
+            addresses = [addresses]
+
+        for address in addresses:
+            addrs = split_unique_address(address)
+            ledger_address = addrs["account_id"] + DELIMITER + addrs["customer_id"]
+            balances = self._balances.get(addrs["customer_id"], {}).get(ledger_address, {})
+            for asset_id, entry in balances.items():
+                address_balances[address][asset_id] = entry["balance"]
+                address_balances[address]["block_num"] = max(
+                    address_balances[address].get("block_num", 0),
+                    entry["block_num"])
+
+        # do not return default dicts
+        for key, value in address_balances.items():
+            if type(value) == collections.defaultdict:
+                address_balances[key] = dict(value)
+        return dict(address_balances)
+
+    def _parse_filter(self, filter_by):
+        if filter_by:
+            if filter_by.get("customer_id"):
+                return {"customer_id": filter_by.pop("customer_id")}
+            if filter_by.get("address"):
+                addrs = split_unique_address(filter_by.pop("address"))
+                return {"customer_id": addrs["customer_id"]}
+            if filter_by:
+                raise Exception("Filter not supported")
+        return {}
+
+    def _iter_operations(self, status, filter_by, projection, batch_size):
+        filter_dict = self._parse_filter(filter_by)
+
+        with self._lock:
+            by_status = self._status_index.get(status, {})
+            if "customer_id" in filter_dict:
+                # walk the smaller of both indexes
+                by_customer = self._customer_index.get(filter_dict["customer_id"], {})
+                if len(by_customer) < len(by_status):
+                    chain_identifiers = [chain_identifier for chain_identifier in by_customer
+                                         if chain_identifier in by_status]
+                else:
+                    chain_identifiers = [chain_identifier for chain_identifier in by_status
+                                         if chain_identifier in by_customer]
+            else:
+                chain_identifiers = list(by_status)
+
+        return self._iter_copies(chain_identifiers, status, projection)
+
+    def _iter_copies(self, chain_identifiers, status, projection):
+        # the copies are made while iterating, operations that are changed in
+        # between are skipped
+        for chain_identifier in chain_identifiers:
+            with self._lock:
+                stored = self._operations.get(chain_identifier)
+                if stored is None or stored["status"] != status:
+                    continue
+                if projection is None:
+                    operation = stored.copy()
+                else:
+                    operation = {key: stored[key] for key in projection if key in stored}
+            yield operation
+
+    def get_operations_in_progress(self, filter_by=None):
+        return list(self._iter_operations("in_progress", filter_by, None, None))
+
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("in_progress", filter_by, projection, batch_size)
+
+    def get_operations_pending(self, filter_by=None):
+        return list(self._iter_operations("pending", filter_by, None, None))
+
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("pending", filter_by, projection, batch_size)
+
+    def get_operations_completed(self, filter_by=None):
+        return list(self._iter_operations("completed", filter_by, None, None))
+
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("completed", filter_by, projection, batch_size)
+
+    def get_operations_failed(self, filter_by=None):
+        return list(self._iter_operations("failed", filter_by, None, None))
+
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("failed", filter_by, projection, batch_size)
+
+    @_locked
+    def get_last_head_block_num(self):
+        return self._last_head_block_num
+
+    @_locked
+    def set_last_head_block_num(self, head_block_num):
+        if head_block_num <= self._last_head_block_num:
+            raise Exception("Marching backwards not supported")
+        self._last_head_block_num = head_block_num
+
+    @_locked
+    def get_last_backfill_block_num(self, shard):
+        return self._backfill_block_nums.get(shard, 0)
+
+    @_locked
+    def set_last_backfill_block_num(self, shard, block_num):
+        # shards are processed again after an interruption, keep the maximum
+        self._backfill_block_nums[shard] = max(
+            self._backfill_block_nums.get(shard, 0),
+            block_num)
@@ -2,13 +2,23 @@ from abc import ABC, abstractmethod
 import time
 
 from .exceptions import OperationStorageLostException,StatusInvalidException,\
-    InvalidOperationException, NoBlockNumException
+    InvalidOperationException, NoBlockNumException, DuplicateOperationException,\
+    OperationNotFoundException
+
+from jsonschema.exceptions import ValidationError
 
 from ..operation_storage import operation_formatter
+from ..addresses import DELIMITER
 from ..utils import date_to_string
 from .. import Config
 
 
+#: Fields of an operation that the balance ledger is computed from, see
+#: :func:`BasicOperationStorage._get_balance_ledger`
+BALANCE_FIELDS = ["from", "to", "customer_id", "amount_value", "amount_asset_id",
+                  "fee_value", "fee_asset_id", "block_num"]
+
+
 class IOperationStorage(ABC):
 
     @abstractmethod
@@ -25,6 +35,47 @@ class IOperationStorage(ABC):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def flag_operation_pending(self, operation):
+        """
+        Marks an operation that is in_progress as pending, which means it is
+        contained in a block that is not irreversible yet.
+
+        :param operation: operations struct as defined in :func:`interface.IOperationStorage.insert_operation`.
+        :type operation: dict
+        :raises: StatusInvalidException: if the operation status is not in_progress
+        :raises: NoBlockNumException: if no block_num was given
+        :raises: OperationNotFoundException: if the given operation cant be found in the storage
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def promote_pending_operations(self, start_block, end_block):
+        """
+        Marks all pending operations within the given blocks as completed,
+        once the blocks are irreversible.
+
+        :param start_block: first block, inclusive
+        :type start_block: int
+        :param end_block: last block, inclusive
+        :type end_block: int
+        :returns: number of promoted operations
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def revert_operation_completed(self, operation):
+        """
+        Marks an operation that is completed (or pending) as in_progress
+        again, e.g. if the block that contained it was forked out.
+
+        :param operation: operations struct as defined in :func:`interface.IOperationStorage.insert_operation`.
+        :type operation: dict
+        :raises: StatusInvalidException: if the operation status is not completed or pending
+        :raises: OperationNotFoundException: if the given operation cant be found in the storage
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
     @abstractmethod
     def flag_operation_failed(self, operation, message=None):
         """
@@ -43,7 +94,7 @@ class IOperationStorage(ABC):
     def insert_operation(self, operation):
         """
         Inserts the operation into the storage. Operation status
-        can be in_progress or completed.
+        can be in_progress, pending or completed.
 
         :param operation: operations struct adhering to the json schema definitions
         :type operation: dict
@@ -56,7 +107,7 @@ class IOperationStorage(ABC):
     def insert_or_update_operation(self, operation):
         """
         Inserts the operation, or updates it into the storage. Operation status
-        can be in_progress or completed
+        can be in_progress, pending or completed
 
         :param operation: operations struct adhering to the json schema definitions
         :type operation: dict
@@ -65,6 +116,37 @@ class IOperationStorage(ABC):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def insert_operations(self, operations):
+        """
+        Inserts all given operations, see
+        :func:`interface.IOperationStorage.insert_operation`, with as few
+        round-trips as the storage allows. An operation that fails does not
+        prevent the others from being written.
+
+        :param operations: list of operations structs adhering to the json schema definitions
+        :type operations: list of dict
+        :returns: one result per operation in the given order, ``inserted``,
+                  ``duplicate`` (already stored or earlier in the list) or
+                  ``invalid`` (not well defined, not written)
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def insert_or_update_operations(self, operations):
+        """
+        Inserts or updates all given operations, see
+        :func:`interface.IOperationStorage.insert_or_update_operation`. An
+        operation that fails does not prevent the others from being written.
+
+        :param operations: list of operations structs adhering to the json schema definitions
+        :type operations: list of dict
+        :returns: one result per operation in the given order, ``inserted``,
+                  ``updated``, ``duplicate`` or ``invalid`` (not well defined,
+                  not written)
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
     @abstractmethod
     def delete_operation(self, operation_or_incident_id):
         """
@@ -99,6 +181,16 @@ class IOperationStorage(ABC):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def get_operations_pending(self, filter_by):
+        """
+        Returns all operations that are pending and follow the filter rules
+
+        :param filter_by: rules to filter the operations
+        :type filter_by: dict
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
     @abstractmethod
     def get_operations_completed(self, filter_by):
         """
@@ -119,6 +211,66 @@ class IOperationStorage(ABC):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        """
+        Like :func:`interface.IOperationStorage.get_operations_in_progress`, but returns an iterator
+        that obtains the operations from the storage in batches while it is consumed
+
+        :param filter_by: rules to filter the operations
+        :type filter_by: dict
+        :param projection: fields of the operations that are returned, default all
+        :type projection: list of str
+        :param batch_size: number of operations obtained per round-trip, default as chosen by the storage
+        :type batch_size: int
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        """
+        Like :func:`interface.IOperationStorage.get_operations_pending`, but returns an iterator
+        that obtains the operations from the storage in batches while it is consumed
+
+        :param filter_by: rules to filter the operations
+        :type filter_by: dict
+        :param projection: fields of the operations that are returned, default all
+        :type projection: list of str
+        :param batch_size: number of operations obtained per round-trip, default as chosen by the storage
+        :type batch_size: int
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        """
+        Like :func:`interface.IOperationStorage.get_operations_completed`, but returns an iterator
+        that obtains the operations from the storage in batches while it is consumed
+
+        :param filter_by: rules to filter the operations
+        :type filter_by: dict
+        :param projection: fields of the operations that are returned, default all
+        :type projection: list of str
+        :param batch_size: number of operations obtained per round-trip, default as chosen by the storage
+        :type batch_size: int
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        """
+        Like :func:`interface.IOperationStorage.get_operations_failed`, but returns an iterator
+        that obtains the operations from the storage in batches while it is consumed
+
+        :param filter_by: rules to filter the operations
+        :type filter_by: dict
+        :param projection: fields of the operations that are returned, default all
+        :type projection: list of str
+        :param batch_size: number of operations obtained per round-trip, default as chosen by the storage
+        :type batch_size: int
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
     @abstractmethod
     def get_last_head_block_num(self):
         """
@@ -135,6 +287,31 @@ class IOperationStorage(ABC):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def get_last_backfill_block_num(self, shard):
+        """
+        Returns the last block num that was processed by the given backfill shard,
+        0 if the shard did not start yet
+
+        :param shard: identifier of the block range of the shard, e.g. "1000-1999"
+        :type shard: str
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
+    @abstractmethod
+    def set_last_backfill_block_num(self, shard, block_num):
+        """
+        Sets the last block num that was processed by the given backfill shard. The
+        progress of a shard is kept next to the last head block num, but never
+        changes it
+
+        :param shard: identifier of the block range of the shard, e.g. "1000-1999"
+        :type shard: str
+        :param block_num: last processed block of the shard
+        :type block_num: int
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
 
 class IAddressOperationStorage(IOperationStorage):
     """
@@ -186,6 +363,17 @@ class IAddressOperationStorage(IOperationStorage):
         :raises: OperationStorageLostException: any technical problems contacting the storage
         """
 
+    @abstractmethod
+    def rebuild_balances(self):
+        """
+        Recomputes the balance ledger that :func:`interface.IAddressOperationStorage.get_balances`
+        reads from all completed operations. The ledger is maintained with every operation that
+        is completed, use this after a migration or if a write was interrupted in between.
+        Returns the number of (address, asset) balances
+
+        :raises: OperationStorageLostException: any technical problems contacting the storage
+        """
+
 
 def retry_auto_reconnect(func):
     """
@@ -234,6 +422,42 @@ class BasicOperationStorage(IOperationStorage):
         """
         return operation_formatter.decode_operation(operation)
 
+    def _get_balance_changes(self, operation):
+        """
+            Returns the changes the given completed operation applies to the balance ledger,
+            as list of (address, asset_id, amount). The address is <account_id>:<customer_id>,
+            the sender pays amount and fee
+
+            :param operation: operations struct adhering to the json schema definitions
+            :type operation: dict
+        """
+        sender = operation["from"] + DELIMITER + operation["customer_id"]
+        changes = [(sender, operation["amount_asset_id"], -operation["amount_value"]),
+                   (sender, operation["fee_asset_id"], -operation["fee_value"])]
+        # a transfer to oneself is counted on the sending side only
+        if operation["to"] != operation["from"]:
+            receiver = operation["to"] + DELIMITER + operation["customer_id"]
+            changes.append((receiver, operation["amount_asset_id"], operation["amount_value"]))
+        return changes
+
+    def _get_balance_ledger(self, operations):
+        """
+            Folds the given completed operations into balance ledger entries, returns a dict
+            (address, asset_id) -> {"balance": .., "block_num": ..}
+
+            :param operations: completed operations structs
+            :type operations: iterable of dict
+        """
+        ledger = {}
+        for operation in operations:
+            for address, asset_id, amount in self._get_balance_changes(operation):
+                entry = ledger.setdefault(
+                    (address, asset_id),
+                    {"balance": 0, "block_num": 0})
+                entry["balance"] = entry["balance"] + amount
+                entry["block_num"] = max(entry["block_num"], operation["block_num"])
+        return ledger
+
     def flag_operation_completed(self, operation):
         """
             Does simply status check and json schema validation
@@ -262,6 +486,58 @@ class BasicOperationStorage(IOperationStorage):
 
         return operation
 
+    def flag_operation_pending(self, operation):
+        """
+            Does simply status check and json schema validation
+
+            :param operation: operations struct adhering to the json schema definitions
+            :type operation: dict
+        """
+
+        # dont mutate input
+        operation = operation.copy()
+
+        try:
+            if operation["status"] != "in_progress":
+                raise StatusInvalidException()
+        except KeyError:
+            operation["status"] = "in_progress"
+            pass
+
+        self._validate_operation(operation)
+
+        if not operation.get("block_num"):
+            raise NoBlockNumException()
+
+        return operation
+
+    def revert_operation_completed(self, operation):
+        """
+            Does simply status check and json schema validation, the returned
+            operation has no block_num anymore
+
+            :param operation: operations struct adhering to the json schema definitions
+            :type operation: dict
+        """
+        # convert format if it comes directly from blockchain monitor
+        if operation.get("op"):
+            operation = self._decode_operation(operation)
+        else:
+            operation = operation.copy()
+
+        try:
+            if operation["status"] not in ["completed", "pending"]:
+                raise StatusInvalidException()
+        except KeyError:
+            operation["status"] = "completed"
+            pass
+
+        self._validate_operation(operation)
+
+        operation.pop("block_num", None)
+
+        return operation
+
     def flag_operation_failed(self, operation, message=None):
         """
             Does simply status check and json schema validation
@@ -306,7 +582,7 @@ class BasicOperationStorage(IOperationStorage):
 
         self._validate_operation(operation)
 
-        if operation["status"] == "completed":
+        if operation["status"] in ["completed", "pending"]:
             if not operation.get("block_num"):
                 raise InvalidOperationException()
         elif operation["status"] == "in_progress":
@@ -320,6 +596,78 @@ class BasicOperationStorage(IOperationStorage):
 
         return operation
 
+    def _prepare_operations(self, operations):
+        """
+            Does the basics of :func:`insert_operation` for all given operations,
+            returns them in the same order, None for the ones that are invalid
+
+            :param operations: list of operations structs adhering to the json schema definitions
+            :type operations: list of dict
+        """
+        prepared = []
+        for operation in operations:
+            try:
+                prepared.append(BasicOperationStorage.insert_operation(self, operation))
+            except (InvalidOperationException, ValidationError):
+                prepared.append(None)
+        return prepared
+
+    def insert_operations(self, operations):
+        """
+            Default implementation that writes one operation after another,
+            storages that support bulk writes override this
+
+            :param operations: list of operations structs adhering to the json schema definitions
+            :type operations: list of dict
+        """
+        results = []
+        for operation, prepared in zip(operations, self._prepare_operations(operations)):
+            if prepared is None:
+                results.append("invalid")
+                continue
+            try:
+                self.insert_operation(operation)
+                results.append("inserted")
+            except DuplicateOperationException:
+                results.append("duplicate")
+        return results
+
+    def insert_or_update_operations(self, operations):
+        """
+            Default implementation that writes one operation after another,
+            storages that support bulk writes override this
+
+            :param operations: list of operations structs adhering to the json schema definitions
+            :type operations: list of dict
+        """
+        results = []
+        for operation, prepared in zip(operations, self._prepare_operations(operations)):
+            if prepared is None:
+                results.append("invalid")
+                continue
+            try:
+                self.insert_operation(operation)
+                results.append("inserted")
+            except DuplicateOperationException:
+                # could be an update to completed ...
+                if not operation.get("block_num"):
+                    results.append("duplicate")
+                    continue
+                if operation.get("op"):
+                    operation = self._decode_operation(operation)
+                else:
+                    operation = operation.copy()
+                status = operation.pop("status", None)
+                try:
+                    if status == "pending":
+                        self.flag_operation_pending(operation)
+                    else:
+                        self.flag_operation_completed(operation)
+                    results.append("updated")
+                except (OperationNotFoundException, DuplicateOperationException):
+                    results.append("duplicate")
+        return results
+
     def delete_operation(self, operation_or_incident_id):
         """
             Does simply status check and json schema validation if an operation dict is given
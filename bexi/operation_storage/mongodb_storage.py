@@ -1,8 +1,11 @@
 import collections
+import logging
 import pymongo
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from pymongo import MongoClient
 
-from ..addresses import split_unique_address
+from ..addresses import split_unique_address, DELIMITER
 from .interface import (
     retry_auto_reconnect,
     BasicOperationStorage)
@@ -16,6 +19,39 @@ from .exceptions import (
     OperationStorageException)
 
 
+#: Indexes per collection (key of the collection name in the configuration), each
+#: one serves the query shapes noted next to it. Reconciled on startup, see
+#: :func:`MongoDBOperationsStorage.reconcile_indexes`
+INDEXES = {
+    "operation_collection": [
+        # inserts, updates and deletes of a single operation
+        {"name": "chain_identifier", "keys": ["chain_identifier"], "unique": True},
+        # get_operation, delete_operation by incident id
+        {"name": "incident_id", "keys": ["incident_id"], "unique": True},
+        # get_operations_* with and without customer, balance ledger aggregation
+        {"name": "status_customer_id_timestamp", "keys": ["status", "customer_id", "timestamp"]},
+        # promotion of pending operations by block range
+        {"name": "status_block_num", "keys": ["status", "block_num"]},
+    ],
+    "status_collection": [
+        # last head block num, backfill progress per shard
+        {"name": "status_shard", "keys": ["status", "shard"], "unique": True},
+    ],
+    "address_collection": [
+        # track_address, untrack_address
+        {"name": "address", "keys": ["address"], "unique": True},
+        # tracked addresses of get_balances in insertion order
+        {"name": "usage_id", "keys": ["usage", "_id"]},
+    ],
+    "balance_collection": [
+        # get_balances, ledger updates
+        {"name": "address_asset_id", "keys": ["address", "asset_id"], "unique": True},
+        # recomputing the balances of customers
+        {"name": "customer_id", "keys": ["customer_id"]},
+    ],
+}
+
+
 class MongoDBOperationsStorage(BasicOperationStorage):
     """
     Implementation of :class:`.interface.IOperationStorage` with MongoDB using the
@@ -60,6 +96,22 @@ class MongoDBOperationsStorage(BasicOperationStorage):
         self._address_storage = self._db[
             self._mongodb_config["address_collection"]
         ]
+        balance_storage_created = False
+        if mongodb_config["balance_collection"] not in\
+                self._db.collection_names(include_system_collections=False):
+            self._create_balance_storage()
+            balance_storage_created = True
+        self._balance_storage = self._db[
+            self._mongodb_config["balance_collection"]
+        ]
+
+        self.reconcile_indexes()
+
+        if balance_storage_created and\
+                self._operations_storage.find_one({"status": "completed"}) is not None:
+            # existing deployment without a ledger yet, get_balances reads only the ledger
+            logging.getLogger(__name__).info("Building the balance ledger from the completed operations")
+            self._rebuild_balances()
 
     def _debug_print(self, operation):
         from pprint import pprint
@@ -81,10 +133,11 @@ class MongoDBOperationsStorage(BasicOperationStorage):
                     }
                 }
             })
-        self._db[self._mongodb_config["address_collection"]].create_index(
-            [('address', pymongo.ASCENDING),
-             ],
-            unique=True)
+
+    def _create_balance_storage(self):
+        self._db.create_collection(
+            self._mongodb_config["balance_collection"]
+        )
 
     def _create_status_storage(self):
         self._db.create_collection(
@@ -94,17 +147,46 @@ class MongoDBOperationsStorage(BasicOperationStorage):
     def _create_operations_storage(self):
         self._db.create_collection(
             self._mongodb_config["operation_collection"])
-        self._db[self._mongodb_config["operation_collection"]].create_index(
-            [('chain_identifier', pymongo.ASCENDING),
-             ],
-            unique=True)
-        self._db[self._mongodb_config["operation_collection"]].create_index(
-            [('incident_id', pymongo.ASCENDING),
-             ('customer_id', pymongo.ASCENDING),
-             ('status', pymongo.ASCENDING),
-             ('block_num', pymongo.ASCENDING),
-             ],
-            unique=False)
+
+    def reconcile_indexes(self):
+        """
+        Creates the indexes of :data:`INDEXES` that are missing and reports the existing
+        indexes that are not declared there, they are not dropped. Called on startup.
+        Returns a dict with the lists ``created`` and ``unused`` of
+        "<collection>.<index name>"
+        """
+        report = {"created": [], "unused": []}
+        for collection_key, indexes in INDEXES.items():
+            collection_name = self._mongodb_config[collection_key]
+            collection = self._db[collection_name]
+            existing = {name: list(info["key"]) for name, info in
+                        collection.index_information().items()}
+
+            for index in indexes:
+                keys = [(field, pymongo.ASCENDING) for field in index["keys"]]
+                if keys in existing.values():
+                    continue
+                try:
+                    collection.create_index(
+                        keys,
+                        name=index["name"],
+                        unique=index.get("unique", False))
+                    report["created"].append(collection_name + "." + index["name"])
+                except pymongo.errors.OperationFailure as e:
+                    # e.g. existing duplicates for a unique index, the storage still works
+                    logging.getLogger(__name__).error("Index " + index["name"] + " on " + collection_name + " could not be created: " + str(e))
+
+            declared = [[(field, pymongo.ASCENDING) for field in index["keys"]]
+                        for index in indexes]
+            for name, keys in existing.items():
+                if name != "_id_" and keys not in declared:
+                    report["unused"].append(collection_name + "." + name)
+
+        if report["created"]:
+            logging.getLogger(__name__).info("Created indexes " + str(report["created"]))
+        if report["unused"]:
+            logging.getLogger(__name__).warning("Indexes not used by the storage " + str(report["unused"]))
+        return report
 
     def _get_unique_filter(self, operation):
         """
@@ -116,6 +198,96 @@ class MongoDBOperationsStorage(BasicOperationStorage):
         """
         return {"chain_identifier": operation["chain_identifier"]}
 
+    def _add_to_balances(self, operations):
+        """
+        Adds the given completed operations to the balance ledger, with one bulk write
+
+        :param operations: completed operations structs
+        :type operations: list of dict
+        """
+        updates = []
+        for operation in operations:
+            for address, asset_id, amount in self._get_balance_changes(operation):
+                updates.append(pymongo.UpdateOne(
+                    {"address": address,
+                     "asset_id": asset_id},
+                    {"$inc": {"balance": amount},
+                     "$max": {"block_num": operation["block_num"]},
+                     "$setOnInsert": {"customer_id": operation["customer_id"]}},
+                    upsert=True))
+        if updates:
+            self._balance_storage.bulk_write(updates, ordered=False)
+
+    def _aggregate_balance_ledger(self, customer_ids=None):
+        """
+        Computes the balance ledger of the completed operations of the given customers,
+        or of all, in one aggregation. MongoDB sums up the operations per customer,
+        direction and assets, the sums are folded like single operations, see
+        :func:`interface.BasicOperationStorage._get_balance_ledger`
+
+        :param customer_ids: customers whose balances are computed, default all
+        :type customer_ids: list of str
+        """
+        operation_filter = {"status": "completed"}
+        if customer_ids is not None:
+            operation_filter["customer_id"] = {"$in": list(customer_ids)}
+
+        sums = []
+        for document in self._operations_storage.aggregate([
+                {"$match": operation_filter},
+                {"$group": {"_id": {"customer_id": "$customer_id",
+                                    "from": "$from",
+                                    "to": "$to",
+                                    "amount_asset_id": "$amount_asset_id",
+                                    "fee_asset_id": "$fee_asset_id"},
+                            "amount_value": {"$sum": "$amount_value"},
+                            "fee_value": {"$sum": "$fee_value"},
+                            "block_num": {"$max": "$block_num"}}}]):
+            operation_sum = document.pop("_id")
+            operation_sum.update(document)
+            sums.append(operation_sum)
+        return self._get_balance_ledger(sums)
+
+    def _rebuild_balances(self, customer_ids=None):
+        """
+        Recomputes the balance ledger from the completed operations, of the given
+        customers or of all. Returns the number of (address, asset) balances
+
+        :param customer_ids: customers whose balances are recomputed, default all
+        :type customer_ids: list of str
+        """
+        balance_filter = {}
+        if customer_ids is not None:
+            balance_filter["customer_id"] = {"$in": list(customer_ids)}
+
+        ledger = self._aggregate_balance_ledger(customer_ids)
+
+        # replaced per (address, asset) and stale balances deleted afterwards, so that
+        # concurrent ledger updates never see a missing balance
+        if ledger:
+            self._balance_storage.bulk_write(
+                [pymongo.ReplaceOne(
+                    {"address": address,
+                     "asset_id": asset_id},
+                    {"address": address,
+                     "asset_id": asset_id,
+                     "customer_id": split_unique_address(address)["customer_id"],
+                     "balance": entry["balance"],
+                     "block_num": entry["block_num"]},
+                    upsert=True)
+                 for (address, asset_id), entry in ledger.items()],
+                ordered=False)
+        stale = [balance["_id"] for balance in self._balance_storage.find(
+                     balance_filter, projection=["address", "asset_id"])
+                 if (balance["address"], balance["asset_id"]) not in ledger]
+        if stale:
+            self._balance_storage.delete_many({"_id": {"$in": stale}})
+        return len(ledger)
+
+    @retry_auto_reconnect
+    def rebuild_balances(self):
+        return self._rebuild_balances()
+
     @retry_auto_reconnect
     def track_address(self, address, usage="balance"):
         split = split_unique_address(address)
@@ -143,13 +315,69 @@ class MongoDBOperationsStorage(BasicOperationStorage):
         # do basics
         operation = super(MongoDBOperationsStorage, self).flag_operation_completed(operation)
 
-        result = self._operations_storage.update_one(
-            self._get_unique_filter(operation),
+        unique_filter = self._get_unique_filter(operation)
+        unique_filter["status"] = {"$in": ["in_progress", "pending"]}
+        document = self._operations_storage.find_one_and_update(
+            unique_filter,
             {"$set": {"status": "completed",
-                      "chain_identifier": operation["chain_identifier"]}})
+                      "block_num": operation["block_num"]}})
+        if document is None:
+            raise OperationNotFoundException()
+
+        document["block_num"] = operation["block_num"]
+        self._add_to_balances([document])
+
+    @retry_auto_reconnect
+    def flag_operation_pending(self, operation):
+        # do basics
+        operation = super(MongoDBOperationsStorage, self).flag_operation_pending(operation)
+
+        unique_filter = self._get_unique_filter(operation)
+        unique_filter["status"] = "in_progress"
+        result = self._operations_storage.update_one(
+            unique_filter,
+            {"$set": {"status": "pending",
+                      "block_num": operation["block_num"]}})
         if result.modified_count == 0:
             raise OperationNotFoundException()
 
+    @retry_auto_reconnect
+    def promote_pending_operations(self, start_block, end_block):
+        operations = list(self._operations_storage.find(
+            {"status": "pending",
+             "block_num": {"$gte": start_block, "$lte": end_block}}))
+        if not operations:
+            return 0
+
+        result = self._operations_storage.update_many(
+            {"_id": {"$in": [operation["_id"] for operation in operations]},
+             "status": "pending"},
+            {"$set": {"status": "completed"}})
+        if result.modified_count == len(operations):
+            self._add_to_balances(operations)
+        else:
+            # some were changed in between, count what is completed now
+            self._rebuild_balances(
+                set(operation["customer_id"] for operation in operations))
+        return result.modified_count
+
+    @retry_auto_reconnect
+    def revert_operation_completed(self, operation):
+        # do basics
+        operation = super(MongoDBOperationsStorage, self).revert_operation_completed(operation)
+
+        unique_filter = self._get_unique_filter(operation)
+        unique_filter["status"] = operation["status"]
+        result = self._operations_storage.update_one(
+            unique_filter,
+            {"$set": {"status": "in_progress"},
+             "$unset": {"block_num": ""}})
+        if result.modified_count == 0:
+            raise OperationNotFoundException()
+
+        if operation["status"] == "completed":
+            self._rebuild_balances([operation["customer_id"]])
+
     @retry_auto_reconnect
     def flag_operation_failed(self, operation, message=None):
         # do basics
@@ -174,25 +402,136 @@ class MongoDBOperationsStorage(BasicOperationStorage):
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateOperationException()
 
+        if operation["status"] == "completed":
+            self._add_to_balances([operation])
+
     @retry_auto_reconnect
     def insert_or_update_operation(self, operation):
         # do basics
         operation = super(MongoDBOperationsStorage, self).insert_operation(operation)
 
+        if not operation.get("block_num"):
+            # nothing it could update
+            try:
+                self._operations_storage.insert_one(
+                    operation.copy()
+                )
+            except pymongo.errors.DuplicateKeyError:
+                raise DuplicateOperationException()
+            return
+
+        # could be an update to completed or pending, with the same transitions
+        # as flag_operation_completed and flag_operation_pending. If the stored
+        # operation has another status, the upsert tries to insert it again and
+        # fails on the unique index
+        unique_filter = self._get_unique_filter(operation)
+        if operation["status"] == "pending":
+            unique_filter["status"] = "in_progress"
+        else:
+            unique_filter["status"] = {"$in": ["in_progress", "pending"]}
         try:
-            self._operations_storage.insert_one(
-                operation.copy()
-            )
+            document = self._operations_storage.find_one_and_update(
+                unique_filter,
+                {"$set": {"status": operation["status"],
+                          "block_num": operation["block_num"]},
+                 "$setOnInsert": {key: value for key, value in operation.items()
+                                  if key not in ["status", "block_num", "chain_identifier"]}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.BEFORE)
         except pymongo.errors.DuplicateKeyError:
-            # could be an update to completed ...
-            if operation.get("block_num"):
-                try:
-                    operation.pop("status")
-                    self.flag_operation_completed(operation)
-                except OperationNotFoundException:
-                    raise DuplicateOperationException()
-            else:
-                raise DuplicateOperationException()
+            raise DuplicateOperationException()
+
+        if operation["status"] == "completed":
+            if document is None:
+                # inserted
+                document = operation
+            document["block_num"] = operation["block_num"]
+            self._add_to_balances([document])
+
+    def _bulk_insert(self, operations):
+        """
+        Inserts the given operations with one unordered bulk write, returns the
+        indices of the ones that exist already
+
+        :param operations: operations as returned by :func:`_prepare_operations`
+        :type operations: list of dict
+        """
+        if not operations:
+            return []
+        try:
+            self._operations_storage.bulk_write(
+                [pymongo.InsertOne(operation.copy()) for operation in operations],
+                ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            duplicates = []
+            for error in e.details["writeErrors"]:
+                if error["code"] != 11000:
+                    raise
+                duplicates.append(error["index"])
+            return duplicates
+        return []
+
+    @retry_auto_reconnect
+    def insert_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = ["invalid" if operation is None else "inserted" for operation in operations]
+        indices = [index for index, operation in enumerate(operations) if operation is not None]
+
+        for index in self._bulk_insert([operations[index] for index in indices]):
+            results[indices[index]] = "duplicate"
+
+        self._add_to_balances(
+            [operation for operation, result in zip(operations, results)
+             if result == "inserted" and operation["status"] == "completed"])
+        return results
+
+    @retry_auto_reconnect
+    def insert_or_update_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = ["invalid" if operation is None else "inserted" for operation in operations]
+        indices = [index for index, operation in enumerate(operations) if operation is not None]
+
+        duplicates = [indices[index] for index in self._bulk_insert(
+            [operations[index] for index in indices])]
+        # chain_identifier -> stored operation before the update
+        updated = {}
+        if duplicates:
+            # could be updates to completed or pending ...
+            candidates = {}
+            for index in duplicates:
+                if operations[index].get("block_num"):
+                    candidates[operations[index]["chain_identifier"]] = operations[index]
+            # ... with the same transitions as insert_or_update_operation. Only an
+            # update that matched counts, another writer might have been first
+            for chain_identifier, operation in candidates.items():
+                unique_filter = self._get_unique_filter(operation)
+                if operation["status"] == "pending":
+                    unique_filter["status"] = "in_progress"
+                else:
+                    unique_filter["status"] = {"$in": ["in_progress", "pending"]}
+                document = self._operations_storage.find_one_and_update(
+                    unique_filter,
+                    {"$set": {"status": operation["status"],
+                              "block_num": operation["block_num"]}},
+                    return_document=pymongo.ReturnDocument.BEFORE)
+                if document is not None:
+                    document["block_num"] = operation["block_num"]
+                    updated[chain_identifier] = document
+
+            for index in duplicates:
+                if operations[index]["chain_identifier"] in updated:
+                    results[index] = "updated"
+                else:
+                    results[index] = "duplicate"
+
+        self._add_to_balances(
+            [operation for operation, result in zip(operations, results)
+             if result == "inserted" and operation["status"] == "completed"] +
+            [document for chain_identifier, document in updated.items()
+             if candidates[chain_identifier]["status"] == "completed"])
+        return results
 
     @retry_auto_reconnect
     def delete_operation(self, operation_or_incident_id):
@@ -201,15 +540,18 @@ class MongoDBOperationsStorage(BasicOperationStorage):
 
         if type(operation_or_incident_id) == str:
             incident_id = operation_or_incident_id
-            result = self._operations_storage.delete_one(
+            document = self._operations_storage.find_one_and_delete(
                 {"incident_id": incident_id}
             )
         else:
-            result = self._operations_storage.delete_one(
+            document = self._operations_storage.find_one_and_delete(
                 self._get_unique_filter(operation_or_incident_id))
-        if result.deleted_count == 0:
+        if document is None:
             raise OperationNotFoundException()
 
+        if document["status"] == "completed":
+            self._rebuild_balances([document["customer_id"]])
+
     @retry_auto_reconnect
     def get_operation(self, incident_id):
         operation = self._operations_storage.find_one(
@@ -224,59 +566,45 @@ class MongoDBOperationsStorage(BasicOperationStorage):
     def get_balances(self, take, continuation=None, addresses=None):
         address_balances = collections.defaultdict(lambda: collections.defaultdict())
 
-        if continuation is None:
-            continuation = 0
-
         if not addresses:
-            addresses = [x["address"] for x in
-                         list(self._address_storage.find({"usage": "balance"}).sort([("_id", pymongo.ASCENDING)]))]
-            lenAddresses = len(addresses)
-            try:
-                end = (min(continuation + take, lenAddresses))
-            except TypeError:
+            # the continuation is the _id of the last address of the previous page
+            address_filter = {"usage": "balance"}
+            if continuation:
+                try:
+                    address_filter["_id"] = {"$gt": ObjectId(continuation)}
+                except (InvalidId, TypeError):
+                    raise InputInvalidException()
+            if type(take) != int or take < 1:
                 raise InputInvalidException()
 
-            addresses = addresses[continuation:end]
-            if end >= lenAddresses:
-                end = None
-            address_balances["continuation"] = end
+            # one more to know if there is a next page
+            documents = list(self._address_storage.find(
+                address_filter,
+                projection=["address"]
+            ).sort([("_id", pymongo.ASCENDING)]).limit(take + 1))
+
+            addresses = [x["address"] for x in documents[:take]]
+            if len(documents) > take:
+                address_balances["continuation"] = str(documents[take - 1]["_id"])
+            else:
+                address_balances["continuation"] = None
 
         if type(addresses) == str:
             addresses = [addresses]
 
+        # the ledger is keyed by account id and customer id
+        ledger_addresses = collections.defaultdict(list)
         for address in addresses:
             addrs = split_unique_address(address)
-            max_block_number = 0
-            for operation in self.get_operations_completed(
-                    filter_by={
-                        "customer_id": addrs["customer_id"]
-                    }):
-                this_block_num = operation["block_num"]
-                asset_id = operation["amount_asset_id"]
-                if addrs["account_id"] == operation["from"]:
-                    # negative
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance - operation["amount_value"]
-
-                    # fee as well
-                    asset_id = operation["fee_asset_id"]
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance - operation["fee_value"]
-                elif addrs["account_id"] == operation["to"]:
-                    # positive
-                    balance = address_balances[address].get(asset_id, 0)
-
-                    address_balances[address][asset_id] =\
-                        balance + operation["amount_value"]
-                else:
-                    raise InvalidOperationException()
-                max_block_number = max(max_block_number, this_block_num)
-            if max_block_number > 0:
-                address_balances[address]["block_num"] = max_block_number
+            ledger_addresses[addrs["account_id"] + DELIMITER + addrs["customer_id"]].append(address)
+
+        for balance in self._balance_storage.find(
+                {"address": {"$in": list(ledger_addresses.keys())}}):
+            for address in ledger_addresses[balance["address"]]:
+                address_balances[address][balance["asset_id"]] = balance["balance"]
+                address_balances[address]["block_num"] = max(
+                    address_balances[address].get("block_num", 0),
+                    balance["block_num"])
 
         # do not return default dicts
         for key, value in address_balances.items():
@@ -295,23 +623,45 @@ class MongoDBOperationsStorage(BasicOperationStorage):
                 raise Exception("Filter not supported")
         return {}
 
+    def _iter_operations(self, status, filter_by, projection, batch_size):
+        filter_dict = {"status": status}
+        filter_dict.update(self._parse_filter(filter_by))
+        return self._operations_storage.find(
+            filter_dict,
+            projection=projection,
+            batch_size=batch_size or 0)
+
     @retry_auto_reconnect
     def get_operations_in_progress(self, filter_by=None):
-        filter_dict = {"status": "in_progress"}
-        filter_dict.update(self._parse_filter(filter_by))
-        return list(self._operations_storage.find(filter_dict))
+        return list(self._iter_operations("in_progress", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("in_progress", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_operations_pending(self, filter_by=None):
+        return list(self._iter_operations("pending", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("pending", filter_by, projection, batch_size)
 
     @retry_auto_reconnect
     def get_operations_completed(self, filter_by=None):
-        filter_dict = {"status": "completed"}
-        filter_dict.update(self._parse_filter(filter_by))
-        return list(self._operations_storage.find(filter_dict))
+        return list(self._iter_operations("completed", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("completed", filter_by, projection, batch_size)
 
     @retry_auto_reconnect
     def get_operations_failed(self, filter_by=None):
-        filter_dict = {"status": "failed"}
-        filter_dict.update(self._parse_filter(filter_by))
-        return list(self._operations_storage.find(filter_dict))
+        return list(self._iter_operations("failed", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("failed", filter_by, projection, batch_size)
 
     @retry_auto_reconnect
     def get_last_head_block_num(self):
@@ -324,10 +674,27 @@ class MongoDBOperationsStorage(BasicOperationStorage):
 
     @retry_auto_reconnect
     def set_last_head_block_num(self, head_block_num):
-        current_last = self.get_last_head_block_num()
-        if current_last >= head_block_num:
+        # single round-trip, $max never lowers the stored value
+        result = self._status_storage.update_one(
+            {"status": "last_head_block_num"},
+            {'$max': {'last_head_block_num': head_block_num}},
+            upsert=True)
+        if result.upserted_id is None and result.modified_count == 0:
             raise Exception("Marching backwards not supported")
+
+    @retry_auto_reconnect
+    def get_last_backfill_block_num(self, shard):
+        document = self._status_storage.find_one(
+            {"status": "backfill", "shard": shard})
+        if document:
+            return document["last_block_num"]
+        else:
+            return 0
+
+    @retry_auto_reconnect
+    def set_last_backfill_block_num(self, shard, block_num):
+        # shards are processed again after an interruption, keep the maximum
         self._status_storage.update_one(
-            {"status": "last_head_block_num"},
-            {'$set': {'last_head_block_num': head_block_num}},
+            {"status": "backfill", "shard": shard},
+            {'$max': {'last_block_num': block_num}},
             upsert=True)
@@ -2,6 +2,7 @@ import datetime
 import json
 import os
 import io
+import itertools
 import jsonschema
 import re
 
@@ -70,6 +71,9 @@ def decode_operation(operation):
     if operation.get("message"):
         new_operation["message"] = operation["message"]
 
+    if operation.get("status"):
+        new_operation["status"] = operation["status"]
+
     chain_identifier = str(
         operation.get("transaction_id")
     ) + ":" + str(
@@ -91,24 +95,97 @@ def decode_operation(operation):
 
 
 OPERATION_SCHEMA = None
+OPERATION_VALIDATOR = None
+OPERATION_SHAPE = None
+
+_JSON_TYPES = {
+    "string": (str,),
+    "number": (int, float),
+    "null": (type(None),)
+}
+
+_validations = itertools.count()
 
 
-def validate_operation(operation):
+def _load_schema():
+    global OPERATION_SCHEMA, OPERATION_VALIDATOR, OPERATION_SHAPE
+    schema_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "operation_schema.json"
+    )
+    OPERATION_SCHEMA = json.loads(io.open(schema_file).read())
+
+    # checked once instead of with every validation
+    validator_class = jsonschema.validators.validator_for(OPERATION_SCHEMA)
+    validator_class.check_schema(OPERATION_SCHEMA)
+    # to validate date format against zulu time, rfc import is needed
+    OPERATION_VALIDATOR = validator_class(
+        OPERATION_SCHEMA,
+        format_checker=jsonschema.FormatChecker())
+
+    # (field, python types, allowed values) of the fast path
+    shape = []
+    for field, definition in OPERATION_SCHEMA["properties"].items():
+        json_types = definition["type"]
+        if type(json_types) == str:
+            json_types = [json_types]
+        python_types = tuple(itertools.chain.from_iterable(
+            _JSON_TYPES[json_type] for json_type in json_types))
+        shape.append((field, python_types, definition.get("enum")))
+    OPERATION_SHAPE = (tuple(OPERATION_SCHEMA["required"]), tuple(shape))
+
+
+def _matches_shape(operation):
+    """
+        Checks the required fields, types and enums of the schema without
+        jsonschema, formats are not checked
+    """
+    required, shape = OPERATION_SHAPE
+    if type(operation) != dict:
+        return False
+    for field in required:
+        if field not in operation:
+            return False
+    for field, python_types, enum in shape:
+        if field not in operation:
+            continue
+        value = operation[field]
+        # bool is an int in python, but not a number in json
+        if type(value) == bool or not isinstance(value, python_types):
+            return False
+        if enum is not None and value not in enum:
+            return False
+    return True
+
+
+def validate_operation(operation, mode=None):
     """
         Validates the given reformatted operation against the json schema given by
         :file:`operation_schema.json`
 
         :param operation: operation formatted as returned by :func:`decode_operation`
         :type operation:
+        :param mode: (optional) ``full`` validates against the json schema,
+            ``fast`` checks required fields, types and enums of the schema
+            without jsonschema and ``sampled`` validates every
+            ``sample_every``-th operation in full and the others fast.
+            Defaults to operation_storage.validation.mode
+        :type mode: str
+        :raises: jsonschema.exceptions.ValidationError: if the operation is
+            invalid, with the same error in all modes
     """
-    global OPERATION_SCHEMA
-    if not OPERATION_SCHEMA:
-        schema_file = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            "operation_schema.json"
-        )
-        OPERATION_SCHEMA = json.loads(io.open(schema_file).read())
-    # to validate date format against zulu time, rfc import is needed
-    jsonschema.validate(operation,
-                        OPERATION_SCHEMA,
-                        format_checker=jsonschema.FormatChecker())
+    if OPERATION_VALIDATOR is None:
+        _load_schema()
+    if mode is None:
+        mode = Config.get("operation_storage", "validation", "mode", default="full")
+
+    if mode == "sampled":
+        sample_every = Config.get("operation_storage", "validation", "sample_every", 100)
+        mode = "full" if next(_validations) % sample_every == 0 else "fast"
+    if mode == "fast" and _matches_shape(operation):
+        return
+
+    # invalid operations are reported by the full validation in all modes
+    error = jsonschema.exceptions.best_match(OPERATION_VALIDATOR.iter_errors(operation))
+    if error is not None:
+        raise error
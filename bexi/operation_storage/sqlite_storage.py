@@ -0,0 +1,624 @@
+import collections
+import contextlib
+import json
+import sqlite3
+import threading
+
+from ..addresses import split_unique_address, DELIMITER
+from .interface import (
+    retry_auto_reconnect,
+    BasicOperationStorage)
+from .exceptions import (
+    AddressNotTrackedException,
+    AddressAlreadyTrackedException,
+    InputInvalidException,
+    OperationNotFoundException,
+    DuplicateOperationException,
+    OperationStorageException)
+
+
+#: Tables and indexes, each index serves the query shapes noted next to it. The
+#: operations are stored as json document, the columns are what is queried or
+#: aggregated
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS operations (
+        chain_identifier TEXT PRIMARY KEY,
+        incident_id TEXT,
+        customer_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        block_num INTEGER,
+        from_account TEXT NOT NULL,
+        to_account TEXT NOT NULL,
+        amount_asset_id TEXT NOT NULL,
+        amount_value NUMERIC NOT NULL,
+        fee_asset_id TEXT NOT NULL,
+        fee_value NUMERIC NOT NULL,
+        document TEXT NOT NULL)""",
+    # get_operation, delete_operation by incident id, NULLs are distinct
+    "CREATE UNIQUE INDEX IF NOT EXISTS operations_incident_id ON operations (incident_id)",
+    # get_operations_* of a customer, rebuilding the balances of customers
+    "CREATE INDEX IF NOT EXISTS operations_customer_id_status ON operations (customer_id, status)",
+    # get_operations_* of all customers, promotion of pending operations by block range
+    "CREATE INDEX IF NOT EXISTS operations_status_block_num ON operations (status, block_num)",
+    # last head block num (empty shard), backfill progress per shard
+    """CREATE TABLE IF NOT EXISTS status (
+        status TEXT NOT NULL,
+        shard TEXT NOT NULL,
+        block_num INTEGER NOT NULL,
+        PRIMARY KEY (status, shard))""",
+    # the id orders the pages of get_balances
+    """CREATE TABLE IF NOT EXISTS addresses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        address TEXT NOT NULL UNIQUE,
+        usage TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS balances (
+        address TEXT NOT NULL,
+        asset_id TEXT NOT NULL,
+        customer_id TEXT NOT NULL,
+        balance NUMERIC NOT NULL,
+        block_num INTEGER NOT NULL,
+        PRIMARY KEY (address, asset_id))""",
+    # recomputing the balances of customers
+    "CREATE INDEX IF NOT EXISTS balances_customer_id ON balances (customer_id)",
+]
+
+TABLES = ["operations", "status", "addresses", "balances"]
+
+# the statements are always the same strings, that is what the statement cache of
+# each connection is keyed by
+INSERT_OPERATION = """INSERT OR IGNORE INTO operations (
+    chain_identifier, incident_id, customer_id, status, block_num, from_account,
+    to_account, amount_asset_id, amount_value, fee_asset_id, fee_value, document)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+SELECT_BY_CHAIN_IDENTIFIER = "SELECT status, block_num, document FROM operations WHERE chain_identifier = ?"
+SELECT_BY_INCIDENT_ID = "SELECT status, block_num, document FROM operations WHERE incident_id = ?"
+UPDATE_STATUS = "UPDATE operations SET status = ?, block_num = ? WHERE chain_identifier = ?"
+UPDATE_DOCUMENT = "UPDATE operations SET status = ?, document = ? WHERE chain_identifier = ?"
+DELETE_OPERATION = "DELETE FROM operations WHERE chain_identifier = ?"
+SELECT_PENDING = """SELECT status, block_num, document FROM operations
+    WHERE status = 'pending' AND block_num BETWEEN ? AND ?"""
+PROMOTE_PENDING = """UPDATE operations SET status = 'completed'
+    WHERE status = 'pending' AND block_num BETWEEN ? AND ?"""
+SELECT_OPERATIONS = "SELECT status, block_num, document FROM operations WHERE status = ? ORDER BY rowid"
+SELECT_CUSTOMER_OPERATIONS = """SELECT status, block_num, document FROM operations
+    WHERE customer_id = ? AND status = ? ORDER BY rowid"""
+ADD_TO_BALANCE = """INSERT INTO balances (address, asset_id, customer_id, balance, block_num)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (address, asset_id) DO UPDATE SET
+        balance = balance + excluded.balance,
+        block_num = max(block_num, excluded.block_num)"""
+AGGREGATE_BALANCES = """SELECT customer_id, from_account, to_account, amount_asset_id,
+    fee_asset_id, SUM(amount_value), SUM(fee_value), MAX(block_num)
+    FROM operations WHERE status = 'completed'{}
+    GROUP BY customer_id, from_account, to_account, amount_asset_id, fee_asset_id"""
+SELECT_STATUS = "SELECT block_num FROM status WHERE status = ? AND shard = ?"
+SET_STATUS = """INSERT INTO status (status, shard, block_num) VALUES (?, ?, ?)
+    ON CONFLICT (status, shard) DO UPDATE SET block_num = max(block_num, excluded.block_num)"""
+SELECT_ADDRESSES = "SELECT id, address FROM addresses WHERE usage = 'balance' AND id > ? ORDER BY id LIMIT ?"
+
+# bound parameters per statement, below the limit of every SQLite version
+MAX_VARIABLES = 500
+
+
+class SQLiteOperationsStorage(BasicOperationStorage):
+    """
+    Implementation of :class:`.interface.IOperationStorage` with SQLite using the
+    default implementation :class:`.interface.BasicOperationStorage`
+
+    All data is kept in one database file in WAL mode, so that readers in other
+    threads and processes do not block the writer. Every thread uses its own
+    connection, each caches its prepared statements. Writes run in one
+    transaction per call, including the bulk inserts.
+    """
+
+    def get_retry_exceptions(self):
+        # e.g. database is locked by the writer of another process
+        return (sqlite3.OperationalError,)
+
+    @retry_auto_reconnect
+    def __init__(self, sqlite_config, purge=False):
+        super(SQLiteOperationsStorage, self).__init__()
+
+        if not sqlite_config:
+            raise Exception("No sqlite configuration provided!")
+        self._sqlite_config = sqlite_config
+        self._local = threading.local()
+
+        connection = self._get_connection()
+        # persistent for the file
+        connection.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as connection:
+            if purge:
+                for table in TABLES:
+                    connection.execute("DROP TABLE IF EXISTS " + table)
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _get_connection(self):
+        """
+        Returns the connection of the current thread, a connection must not be used
+        by several threads
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self._sqlite_config["file"],
+                timeout=self._sqlite_config.get("timeout_in_sec", 5),
+                cached_statements=self._sqlite_config.get("cached_statements", 128),
+                # transactions are begun explicitly, see _transaction
+                isolation_level=None)
+            # durable with WAL up to the last checkpoint, never corrupt
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Runs the block in one write transaction, which is rolled back on any error
+        """
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _to_row(self, operation):
+        document = operation.copy()
+        status = document.pop("status")
+        block_num = document.pop("block_num", None)
+        return (operation["chain_identifier"],
+                operation.get("incident_id"),
+                operation["customer_id"],
+                status,
+                block_num,
+                operation["from"],
+                operation["to"],
+                operation["amount_asset_id"],
+                operation["amount_value"],
+                operation["fee_asset_id"],
+                operation["fee_value"],
+                json.dumps(document))
+
+    def _from_row(self, row, projection=None):
+        status, block_num, document = row
+        operation = json.loads(document)
+        operation["status"] = status
+        if block_num is not None:
+            operation["block_num"] = block_num
+        if projection is not None:
+            operation = {key: operation[key] for key in projection if key in operation}
+        return operation
+
+    def _find(self, connection, operation, status=None):
+        """
+        Returns the stored operation with the chain_identifier of the given operation,
+        if it has one of the given statuses
+
+        :param operation: operations struct as defined in :func:`interface.IOperationStorage.insert_operation`.
+        :type operation: dict
+        :param status: allowed statuses, default all
+        :type status: list of str
+        """
+        row = connection.execute(
+            SELECT_BY_CHAIN_IDENTIFIER,
+            (operation["chain_identifier"],)).fetchone()
+        if row is None:
+            return None
+        stored = self._from_row(row)
+        if status is not None and stored["status"] not in status:
+            return None
+        return stored
+
+    def _insert(self, connection, operation):
+        """
+        Inserts the given operation, returns False if it exists already
+        """
+        if connection.execute(INSERT_OPERATION, self._to_row(operation)).rowcount == 0:
+            return False
+        if operation["status"] == "completed":
+            self._add_to_balances(connection, [operation])
+        return True
+
+    def _set_status(self, connection, stored, status, block_num):
+        connection.execute(UPDATE_STATUS, (status, block_num, stored["chain_identifier"]))
+        stored["status"] = status
+        stored["block_num"] = block_num
+        if status == "completed":
+            self._add_to_balances(connection, [stored])
+
+    def _add_to_balances(self, connection, operations):
+        """
+        Adds the given completed operations to the balance ledger
+
+        :param operations: completed operations structs
+        :type operations: list of dict
+        """
+        connection.executemany(
+            ADD_TO_BALANCE,
+            [(address, asset_id, operation["customer_id"], amount, operation["block_num"])
+             for operation in operations
+             for address, asset_id, amount in self._get_balance_changes(operation)])
+
+    def _rebuild_balances(self, connection, customer_ids=None):
+        """
+        Recomputes the balance ledger from the completed operations, of the given
+        customers or of all. SQLite sums up the operations per customer, direction
+        and assets, the sums are folded like single operations, see
+        :func:`interface.BasicOperationStorage._get_balance_ledger`. Returns the
+        number of (address, asset) balances
+
+        :param customer_ids: customers whose balances are recomputed, default all
+        :type customer_ids: list of str
+        """
+        if customer_ids is None:
+            connection.execute("DELETE FROM balances")
+            rows = connection.execute(AGGREGATE_BALANCES.format("")).fetchall()
+        else:
+            customer_ids = list(set(customer_ids))
+            rows = []
+            for index in range(0, len(customer_ids), MAX_VARIABLES):
+                chunk = customer_ids[index:index + MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                connection.execute(
+                    "DELETE FROM balances WHERE customer_id IN (" + placeholders + ")",
+                    chunk)
+                rows.extend(connection.execute(
+                    AGGREGATE_BALANCES.format(" AND customer_id IN (" + placeholders + ")"),
+                    chunk).fetchall())
+
+        sums = collections.defaultdict(list)
+        for customer_id, from_account, to_account, amount_asset_id, fee_asset_id,\
+                amount_value, fee_value, block_num in rows:
+            sums[customer_id].append({"customer_id": customer_id,
+                                      "from": from_account,
+                                      "to": to_account,
+                                      "amount_asset_id": amount_asset_id,
+                                      "amount_value": amount_value,
+                                      "fee_asset_id": fee_asset_id,
+                                      "fee_value": fee_value,
+                                      "block_num": block_num})
+
+        count = 0
+        for customer_id, operation_sums in sums.items():
+            ledger = self._get_balance_ledger(operation_sums)
+            connection.executemany(
+                ADD_TO_BALANCE,
+                [(address, asset_id, customer_id, entry["balance"], entry["block_num"])
+                 for (address, asset_id), entry in ledger.items()])
+            count = count + len(ledger)
+        return count
+
+    @retry_auto_reconnect
+    def rebuild_balances(self):
+        with self._transaction() as connection:
+            return self._rebuild_balances(connection)
+
+    @retry_auto_reconnect
+    def track_address(self, address, usage="balance"):
+        split = split_unique_address(address)
+        if not split.get("customer_id") or not split.get("account_id"):
+            raise OperationStorageException()
+        try:
+            with self._transaction() as connection:
+                connection.execute(
+                    "INSERT INTO addresses (address, usage) VALUES (?, ?)",
+                    (address, usage))
+        except sqlite3.IntegrityError:
+            raise AddressAlreadyTrackedException
+
+    @retry_auto_reconnect
+    def untrack_address(self, address, usage="balance"):
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "DELETE FROM addresses WHERE address = ? AND usage = ?",
+                (address, usage))
+        if cursor.rowcount == 0:
+            raise AddressNotTrackedException()
+
+    @retry_auto_reconnect
+    def flag_operation_completed(self, operation):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).flag_operation_completed(operation)
+
+        with self._transaction() as connection:
+            stored = self._find(connection, operation, ["in_progress", "pending"])
+            if stored is None:
+                raise OperationNotFoundException()
+            self._set_status(connection, stored, "completed", operation["block_num"])
+
+    @retry_auto_reconnect
+    def flag_operation_pending(self, operation):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).flag_operation_pending(operation)
+
+        with self._transaction() as connection:
+            stored = self._find(connection, operation, ["in_progress"])
+            if stored is None:
+                raise OperationNotFoundException()
+            self._set_status(connection, stored, "pending", operation["block_num"])
+
+    @retry_auto_reconnect
+    def promote_pending_operations(self, start_block, end_block):
+        with self._transaction() as connection:
+            operations = [self._from_row(row) for row in connection.execute(
+                SELECT_PENDING, (start_block, end_block))]
+            connection.execute(PROMOTE_PENDING, (start_block, end_block))
+            self._add_to_balances(connection, operations)
+        return len(operations)
+
+    @retry_auto_reconnect
+    def revert_operation_completed(self, operation):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).revert_operation_completed(operation)
+
+        with self._transaction() as connection:
+            stored = self._find(connection, operation, [operation["status"]])
+            if stored is None:
+                raise OperationNotFoundException()
+            self._set_status(connection, stored, "in_progress", None)
+
+            if operation["status"] == "completed":
+                self._rebuild_balances(connection, [stored["customer_id"]])
+
+    @retry_auto_reconnect
+    def flag_operation_failed(self, operation, message=None):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).flag_operation_failed(operation)
+
+        with self._transaction() as connection:
+            stored = self._find(connection, operation)
+            if stored is None:
+                raise OperationNotFoundException()
+            stored["status"] = "failed"
+            stored["message"] = message
+            row = self._to_row(stored)
+            connection.execute(UPDATE_DOCUMENT, (row[3], row[-1], row[0]))
+
+    @retry_auto_reconnect
+    def insert_operation(self, operation):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).insert_operation(operation)
+
+        with self._transaction() as connection:
+            if not self._insert(connection, operation):
+                raise DuplicateOperationException()
+
+    @retry_auto_reconnect
+    def insert_or_update_operation(self, operation):
+        # do basics
+        operation = super(SQLiteOperationsStorage, self).insert_operation(operation)
+
+        with self._transaction() as connection:
+            if operation.get("block_num"):
+                # could be an update to completed or pending, with the same transitions
+                # as flag_operation_completed and flag_operation_pending
+                if operation["status"] == "pending":
+                    stored = self._find(connection, operation, ["in_progress"])
+                else:
+                    stored = self._find(connection, operation, ["in_progress", "pending"])
+                if stored is not None:
+                    self._set_status(connection, stored, operation["status"], operation["block_num"])
+                    return
+
+            if not self._insert(connection, operation):
+                raise DuplicateOperationException()
+
+    @retry_auto_reconnect
+    def insert_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = []
+        with self._transaction() as connection:
+            for operation in operations:
+                if operation is None:
+                    results.append("invalid")
+                elif self._insert(connection, operation):
+                    results.append("inserted")
+                else:
+                    results.append("duplicate")
+        return results
+
+    @retry_auto_reconnect
+    def insert_or_update_operations(self, operations):
+        # do basics, before anything is written
+        operations = self._prepare_operations(operations)
+        results = []
+        with self._transaction() as connection:
+            for operation in operations:
+                if operation is None:
+                    results.append("invalid")
+                    continue
+                if self._insert(connection, operation):
+                    results.append("inserted")
+                    continue
+                # could be an update to completed or pending ...
+                stored = None
+                if operation.get("block_num"):
+                    stored = self._find(connection, operation, ["in_progress", "pending"])
+                if stored is None or stored["status"] == operation["status"] or\
+                        (operation["status"] == "pending" and stored["status"] != "in_progress"):
+                    results.append("duplicate")
+                    continue
+                self._set_status(connection, stored, operation["status"], operation["block_num"])
+                results.append("updated")
+        return results
+
+    @retry_auto_reconnect
+    def delete_operation(self, operation_or_incident_id):
+        # do basics
+        operation_or_incident_id = super(SQLiteOperationsStorage, self).delete_operation(operation_or_incident_id)
+
+        with self._transaction() as connection:
+            if type(operation_or_incident_id) == str:
+                row = connection.execute(
+                    SELECT_BY_INCIDENT_ID,
+                    (operation_or_incident_id,)).fetchone()
+                stored = self._from_row(row) if row else None
+            else:
+                stored = self._find(connection, operation_or_incident_id)
+            if stored is None:
+                raise OperationNotFoundException()
+            connection.execute(DELETE_OPERATION, (stored["chain_identifier"],))
+
+            if stored["status"] == "completed":
+                self._rebuild_balances(connection, [stored["customer_id"]])
+
+    @retry_auto_reconnect
+    def get_operation(self, incident_id):
+        row = self._get_connection().execute(
+            SELECT_BY_INCIDENT_ID,
+            (incident_id,)).fetchone()
+        if not row:
+            raise OperationNotFoundException()
+        return self._from_row(row)
+
+    @retry_auto_reconnect
+    def get_balances(self, take, continuation=None, addresses=None):
+        address_balances = collections.defaultdict(lambda: collections.defaultdict())
+        connection = self._get_connection()
+
+        if not addresses:
+            # the continuation is the id of the last address of the previous page
+            after = 0
+            if continuation:
+                try:
+                    after = int(continuation)
+                except (ValueError, TypeError):
+                    raise InputInvalidException()
+                if str(after) != continuation:
+                    raise InputInvalidException()
+            if type(take) != int or take < 1:
+                raise InputInvalidException()
+
+            # one more to know if there is a next page
+            rows = connection.execute(SELECT_ADDRESSES, (after, take + 1)).fetchall()
+
+            addresses = [address for _, address in rows[:take]]
+            if len(rows) > take:
+                address_balances["continuation"] = str(rows[take - 1][0])
+            else:
+                address_balances["continuation"] = None
+
+        if type(addresses) == str:
+            addresses = [addresses]
+
+        # the ledger is keyed by account id and customer id
+        ledger_addresses = collections.defaultdict(list)
+        for address in addresses:
+            addrs = split_unique_address(address)
+            ledger_addresses[addrs["account_id"] + DELIMITER + addrs["customer_id"]].append(address)
+
+        keys = list(ledger_addresses.keys())
+        for index in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[index:index + MAX_VARIABLES]
+            for ledger_address, asset_id, balance, block_num in connection.execute(
+                    "SELECT address, asset_id, balance, block_num FROM balances WHERE address IN (" +
+                    ", ".join("?" * len(chunk)) + ")",
+                    chunk):
+                for address in ledger_addresses[ledger_address]:
+                    address_balances[address][asset_id] = balance
+                    address_balances[address]["block_num"] = max(
+                        address_balances[address].get("block_num", 0),
+                        block_num)
+
+        # do not return default dicts
+        for key, value in address_balances.items():
+            if type(value) == collections.defaultdict:
+                address_balances[key] = dict(value)
+        return dict(address_balances)
+
+    def _parse_filter(self, filter_by):
+        if filter_by:
+            if filter_by.get("customer_id"):
+                return {"customer_id": filter_by.pop("customer_id")}
+            if filter_by.get("address"):
+                addrs = split_unique_address(filter_by.pop("address"))
+                return {"customer_id": addrs["customer_id"]}
+            if filter_by:
+                raise Exception("Filter not supported")
+        return {}
+
+    def _iter_operations(self, status, filter_by, projection, batch_size):
+        filter_dict = self._parse_filter(filter_by)
+        if filter_dict.get("customer_id"):
+            cursor = self._get_connection().execute(
+                SELECT_CUSTOMER_OPERATIONS,
+                (filter_dict["customer_id"], status))
+        else:
+            cursor = self._get_connection().execute(SELECT_OPERATIONS, (status,))
+        return self._iter_rows(cursor, projection, batch_size)
+
+    def _iter_rows(self, cursor, projection, batch_size):
+        while True:
+            rows = cursor.fetchmany(batch_size or cursor.arraysize)
+            if not rows:
+                return
+            for row in rows:
+                yield self._from_row(row, projection)
+
+    @retry_auto_reconnect
+    def get_operations_in_progress(self, filter_by=None):
+        return list(self._iter_operations("in_progress", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_in_progress(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("in_progress", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_operations_pending(self, filter_by=None):
+        return list(self._iter_operations("pending", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_pending(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("pending", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_operations_completed(self, filter_by=None):
+        return list(self._iter_operations("completed", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_completed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("completed", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_operations_failed(self, filter_by=None):
+        return list(self._iter_operations("failed", filter_by, None, None))
+
+    @retry_auto_reconnect
+    def iter_operations_failed(self, filter_by=None, projection=None, batch_size=None):
+        return self._iter_operations("failed", filter_by, projection, batch_size)
+
+    @retry_auto_reconnect
+    def get_last_head_block_num(self):
+        row = self._get_connection().execute(
+            SELECT_STATUS, ("last_head_block_num", "")).fetchone()
+        if row:
+            return row[0]
+        else:
+            return 0
+
+    @retry_auto_reconnect
+    def set_last_head_block_num(self, head_block_num):
+        with self._transaction() as connection:
+            if head_block_num <= self.get_last_head_block_num():
+                raise Exception("Marching backwards not supported")
+            connection.execute(SET_STATUS, ("last_head_block_num", "", head_block_num))
+
+    @retry_auto_reconnect
+    def get_last_backfill_block_num(self, shard):
+        row = self._get_connection().execute(
+            SELECT_STATUS, ("backfill", shard)).fetchone()
+        if row:
+            return row[0]
+        else:
+            return 0
+
+    @retry_auto_reconnect
+    def set_last_backfill_block_num(self, shard, block_num):
+        # shards are processed again after an interruption, keep the maximum
+        with self._transaction() as connection:
+            connection.execute(SET_STATUS, ("backfill", shard, block_num))
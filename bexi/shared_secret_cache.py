@@ -0,0 +1,185 @@
+import collections
+import hashlib
+import random
+import threading
+from binascii import hexlify, unhexlify
+
+from bitshares.exceptions import MissingKeyError, KeyNotFound
+from bitsharesbase import memo as BtsMemo
+from bitsharesbase.account import PrivateKey, PublicKey
+
+from . import Config
+
+
+class SharedSecretCache(object):
+    """ Keeps the ECDH shared secrets between our memo keys and the memo keys
+        of our counterparties, so that encrypting and decrypting a memo for a
+        known counterparty only costs the AES part.
+
+        :param int size: maximum number of shared secrets that are kept
+
+        The secrets are keyed by (our public key, their public key).
+        :func:`SharedSecretCache.encode_memo` and
+        :func:`SharedSecretCache.decode_memo` are drop-in replacements for
+        ``bitsharesbase.memo.encode_memo`` and ``decode_memo``.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # (our public key, their public key) -> shared secret, least recently used first
+        self._secrets = collections.OrderedDict()
+        # wif -> PrivateKey, deriving the public key of a wif is costly as well
+        self._private_keys = {}
+
+    def get_private_key(self, wif):
+        """ Returns the ``PrivateKey`` instance for the given wif
+
+            :param str wif: private key in wif format
+        """
+        private_key = self._private_keys.get(wif)
+        if private_key is None:
+            private_key = PrivateKey(wif)
+            self._private_keys[wif] = private_key
+        return private_key
+
+    def get_shared_secret(self, priv, pub):
+        """ Returns the shared secret of ``priv`` and ``pub``, see
+            ``bitsharesbase.memo.get_shared_secret``
+
+            :param PrivateKey priv: our private key
+            :param PublicKey pub: public key of the counterparty
+        """
+        key = (bytes(priv.pubkey), bytes(pub))
+        with self._lock:
+            shared_secret = self._secrets.get(key)
+            if shared_secret is not None:
+                self._secrets.move_to_end(key)
+                self.hits += 1
+                return shared_secret
+            self.misses += 1
+
+        shared_secret = BtsMemo.get_shared_secret(priv, pub)
+
+        with self._lock:
+            self._secrets[key] = shared_secret
+            while len(self._secrets) > self.size:
+                self._secrets.popitem(last=False)
+        return shared_secret
+
+    def encode_memo(self, priv, pub, nonce, message):
+        """ Encrypts the message, see ``bitsharesbase.memo.encode_memo``
+        """
+        aes = BtsMemo.init_aes(self.get_shared_secret(priv, pub), nonce)
+        raw = bytes(message, 'utf8')
+        checksum = hashlib.sha256(raw).digest()
+        raw = (checksum[0:4] + raw)
+        if len(raw) % 16:
+            raw = BtsMemo._pad(raw, 16)
+        return hexlify(aes.encrypt(raw)).decode('ascii')
+
+    def decode_memo(self, priv, pub, nonce, message):
+        """ Decrypts the message, see ``bitsharesbase.memo.decode_memo``
+
+            :raise ValueError: if message cannot be decoded as valid UTF-8
+                string
+        """
+        aes = BtsMemo.init_aes(self.get_shared_secret(priv, pub), nonce)
+        cleartext = aes.decrypt(unhexlify(bytes(message, 'ascii')))
+        message = cleartext[4:]
+        try:
+            return BtsMemo._unpad(message.decode('utf8'), 16)
+        except Exception:
+            raise ValueError(message)
+
+    def get_statistics(self):
+        """ Returns hit and miss counters and the number of cached secrets
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._secrets)
+        }
+
+
+shared_secret_cache = None
+
+
+def get_shared_secret_cache():
+    """ Returns the shared secret cache of this process, its size is
+        configured by ``bitshares.shared_secret_cache_size``
+    """
+    global shared_secret_cache
+    if not shared_secret_cache:
+        shared_secret_cache = SharedSecretCache(
+            size=Config.get("bitshares", "shared_secret_cache_size", 1000))
+    return shared_secret_cache
+
+
+def encrypt_memo(wallet, prefix, from_memo_key, to_memo_key, message):
+    """ Encrypts the message like ``bitshares.memo.Memo.encrypt``, using the
+        shared secret cache
+
+        :param bitshares.wallet.Wallet wallet: wallet that holds the private
+            key of ``from_memo_key``
+        :param str prefix: public key prefix of the network
+        :param str from_memo_key: memo public key of the sender
+        :param str to_memo_key: memo public key of the receiver
+        :param str message: clear text memo message
+    """
+    if not message:
+        return None
+
+    nonce = str(random.getrandbits(64))
+    memo_wif = wallet.getPrivateKeyForPublicKey(from_memo_key)
+    if not memo_wif:
+        raise MissingKeyError("Memo key for %s missing!" % from_memo_key)
+
+    cache = get_shared_secret_cache()
+    return {
+        "message": cache.encode_memo(
+            cache.get_private_key(memo_wif),
+            PublicKey(to_memo_key, prefix=prefix),
+            nonce,
+            message),
+        "nonce": nonce,
+        "from": from_memo_key,
+        "to": to_memo_key
+    }
+
+
+def decrypt_memo(wallet, prefix, memo):
+    """ Decrypts the memo like ``bitshares.memo.Memo.decrypt``, using the
+        shared secret cache
+
+        :param bitshares.wallet.Wallet wallet: wallet that holds our memo key
+        :param str prefix: public key prefix of the network
+        :param dict memo: encrypted memo as contained in the operation
+    """
+    if not memo:
+        return None
+
+    # We first try to decode assuming we received the memo
+    try:
+        memo_wif = wallet.getPrivateKeyForPublicKey(memo["to"])
+        pubkey = memo["from"]
+    except KeyNotFound:
+        try:
+            # if that failed, we assume that we have sent the memo
+            memo_wif = wallet.getPrivateKeyForPublicKey(memo["from"])
+            pubkey = memo["to"]
+        except KeyNotFound:
+            raise MissingKeyError(
+                "None of the required memo keys are installed! "
+                "Need any of {}".format([memo["to"], memo["from"]]))
+
+    cache = get_shared_secret_cache()
+    return cache.decode_memo(
+        cache.get_private_key(memo_wif),
+        PublicKey(pubkey, prefix=prefix),
+        memo.get("nonce"),
+        memo.get("message"))
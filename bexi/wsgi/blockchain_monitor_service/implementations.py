@@ -2,6 +2,7 @@
     in :mod:`.views`.
 """
 from ...connection import requires_blockchain
+from ...account_resolver import get_account_resolver
 from ... import Config, factory, __VERSION__
 from ...wsgi import flask_setup
 import json
@@ -47,7 +48,8 @@ def isalive(bitshares_instance):
         "contractVersion": "1.1.3",
         "status": {
             "last_processed": last_block_stored,
-            "last_irreversible_block_num": last_block}
+            "last_irreversible_block_num": last_block,
+            "account_resolver": get_account_resolver().get_statistics()}
     }
 
     return info
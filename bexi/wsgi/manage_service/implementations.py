@@ -2,12 +2,12 @@
     in :mod:`.views`.
 """
 
+import itertools
 from datetime import datetime
 from flask import json
 
 from bitshares.account import Account
 from bitshares.amount import Amount
-from bitshares.memo import Memo
 from bitsharesbase import operations
 from bitshares.transactionbuilder import TransactionBuilder
 from bitshares.exceptions import AccountDoesNotExistsException,\
@@ -15,11 +15,14 @@ from bitshares.exceptions import AccountDoesNotExistsException,\
 
 from ...addresses import (
     split_unique_address,
+    ensure_account_name,
+    prefetch_accounts,
     get_from_address_from_operation,
     create_memo,
     get_to_address_from_operation)
 
 from ...connection import requires_blockchain
+from ...shared_secret_cache import encrypt_memo
 from ... import Config, factory
 from ... import utils
 from ...operation_storage import operation_formatter
@@ -106,14 +109,14 @@ def validate_address(address):
     return {"isValid": is_valid_address(address)}
 
 
-@requires_blockchain
-def is_valid_address(address, bitshares_instance=None):
+def is_valid_address(address):
     try:
         split = split_unique_address(address)
         if split.get("customer_id") is None:
             return False
         else:
-            Account(split["account_id"], bitshares_instance=bitshares_instance)
+            # raises if the account does not exist
+            ensure_account_name(split["account_id"])
             return True
     except Exception:
         return False
@@ -166,6 +169,26 @@ def get_address_history_from(address, take, after_hash=None):
     return _get_from_history(address, take, "from", after_hash)
 
 
+# fields of the operations that the history is built from
+HISTORY_FIELDS = ["timestamp", "from", "to", "customer_id", "amount_asset_id",
+                  "amount_value", "chain_identifier"]
+
+
+def _resolve_accounts_in_batches(operations, batch_size):
+    """ Yields the given operations, resolving the involved accounts of each
+        batch at once before
+    """
+    operations = iter(operations)
+    while True:
+        batch = list(itertools.islice(operations, batch_size))
+        if not batch:
+            return
+        prefetch_accounts(
+            [operation[key] for operation in batch for key in ("from", "to")])
+        for operation in batch:
+            yield operation
+
+
 def _get_from_history(address, take, to_or_from, after_hash=None):
     if not is_valid_address(address):
         raise AccountDoesNotExistsException()
@@ -176,8 +199,12 @@ def _get_from_history(address, take, to_or_from, after_hash=None):
 
     address_split = split_unique_address(address)
     afterTimestamp = datetime.fromtimestamp(0)
-    for operation in _get_os().get_operations_completed(
-            filter_by={"customer_id": address_split["customer_id"]}):
+    batch_size = Config.get("operation_storage", "batch_size", 1000)
+    operations_completed = _get_os().iter_operations_completed(
+        filter_by={"customer_id": address_split["customer_id"]},
+        projection=HISTORY_FIELDS,
+        batch_size=batch_size)
+    for operation in _resolve_accounts_in_batches(operations_completed, batch_size):
         # deposit, thus from
         add_op = {
             "timestamp": operation.get("timestamp", None),
@@ -225,7 +252,12 @@ def build_transaction(incidentId, fromAddress, fromMemoWif, toAddress, asset_id,
 
     def obtain_raw_tx():
 #         if old_operation is None:
-        _memo = memo.encrypt(memo_plain)
+        _memo = encrypt_memo(
+            bitshares_instance.wallet,
+            bitshares_instance.prefix,
+            from_account["options"]["memo_key"],
+            to_account["options"]["memo_key"],
+            memo_plain)
         _expiration = Config.get("bitshares", "transaction_expiration_in_sec", 60 * 60 * 24)  # 24 hours
 #         else:
 #             memo_encrypted = memo.encrypt(memo_plain)
@@ -316,12 +348,6 @@ def build_transaction(incidentId, fromAddress, fromMemoWif, toAddress, asset_id,
     if not from_account["options"]["memo_key"] in Wallet.keys:
             raise MemoMatchingFailedException()
 
-    memo = Memo(
-        from_account=from_account,
-        to_account=to_account,
-        bitshares_instance=bitshares_instance
-    )
-
     try:
         tx = obtain_raw_tx()
     except MissingKeyError:
@@ -438,7 +464,7 @@ def get_broadcasted_transaction(operationId):
         "fee": str(operation["fee_value"]),
         "hash": operation["chain_identifier"]
     }
-    if r_op["state"] == "in_progress":
+    if r_op["state"] in ["in_progress", "pending"]:
         r_op["state"] = "inProgress"
 
     if r_op["state"] == "failed":
@@ -64,6 +64,15 @@ def _get_continuation():
         return 0
 
 
+def _get_continuation_token():
+    # continuation is optional and opaque, as given by the operation storage
+    continuation = request.args.get("continuation", None)
+    if continuation:
+        return continuation
+    else:
+        return None
+
+
 def _body(parameter_name, default_value=None):
     try:
         lookup = request.get_json()
@@ -215,7 +224,7 @@ def get_balances():
     """
     try:
         return jsonify(
-            implementations.get_balances(_get_take(), _get_continuation())
+            implementations.get_balances(_get_take(), _get_continuation_token())
         )
     except BadArgumentException:
         custom_abort(400)
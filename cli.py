@@ -8,6 +8,8 @@ from bexi.wsgi.app import (
 from bexi import Config
 from bexi.connection import requires_blockchain
 from bexi.blockchain_monitor import BlockchainMonitor
+from bexi.blockchain_monitor.backfill import backfill as run_backfill, get_backfill_progress
+from bexi.factory import get_operation_storage
 import logging
 import threading
 
@@ -95,6 +97,73 @@ def only_blockchain_monitor_service(host, port):
     app.run(host=host, port=port)
 
 
+@main.command()
+@click.option("--start", type=int, required=True, help="First block to process")
+@click.option("--stop", type=int, required=True, help="Last block to process, must be irreversible")
+@click.option("--workers", type=int, default=1, help="Number of worker processes, one shard each")
+def backfill(start, stop, workers):
+    Config.load(["config_bitshares_connection.yaml",
+                 "config_bitshares_memo_keys.yaml",
+                 "config_bitshares.yaml",
+                 "config_operation_storage.yaml"])
+    storage = get_operation_storage(Config.get("operation_storage", "use"))
+
+    for shard in get_backfill_progress(storage, start, stop, workers):
+        if shard["last_block_num"] >= shard["start_block"]:
+            click.echo("Resuming shard " + shard["shard"] + " after block " + str(shard["last_block_num"]))
+
+    logging.getLogger(__name__).info("Starting backfill from block " + str(start) + " to " + str(stop) + " with " + str(workers) + " workers ...")
+    failed = run_backfill(start, stop, workers)
+
+    for shard in get_backfill_progress(storage, start, stop, workers):
+        click.echo("Shard " + shard["shard"] + ": last block " + str(shard["last_block_num"]))
+    if failed:
+        raise click.ClickException("Shards failed, run the backfill again to resume: " + ", ".join(failed))
+
+
+@main.command()
+def rebuild_balances():
+    Config.load(["config_bitshares_connection.yaml",
+                 "config_bitshares.yaml",
+                 "config_operation_storage.yaml"])
+    storage = get_operation_storage(Config.get("operation_storage", "use"))
+
+    logging.getLogger(__name__).info("Rebuilding the balance ledger from the completed operations ...")
+    click.echo("Rebuilt " + str(storage.rebuild_balances()) + " balances")
+
+
+@main.command()
+@click.option("--batch-size", type=int, help="Entities per page and checkpoint")
+def migrate_partitions(batch_size):
+    Config.load(["config_bitshares_connection.yaml",
+                 "config_bitshares.yaml",
+                 "config_operation_storage.yaml"])
+    storage = get_operation_storage(Config.get("operation_storage", "use"))
+    if not hasattr(storage, "migrate_partitions"):
+        raise click.ClickException("The configured operation storage is not partitioned by hash")
+
+    def on_progress(tablename, moved):
+        click.echo("Table " + tablename + ": moved " + str(moved) + " entities")
+
+    logging.getLogger(__name__).info("Moving all entities to the partitions of the current partition scheme ...")
+    for tablename, moved in storage.migrate_partitions(batch_size, on_progress).items():
+        click.echo("Table " + tablename + " done, moved " + str(moved) + " entities")
+
+
+@main.command()
+@click.option("--batch-size", type=int, help="Operations per page")
+def build_customer_index(batch_size):
+    Config.load(["config_bitshares_connection.yaml",
+                 "config_bitshares.yaml",
+                 "config_operation_storage.yaml"])
+    storage = get_operation_storage(Config.get("operation_storage", "use"))
+    if not hasattr(storage, "build_customer_index"):
+        raise click.ClickException("The configured operation storage has no customer index")
+
+    logging.getLogger(__name__).info("Adding the stored operations to the customer index ...")
+    click.echo("Added " + str(storage.build_customer_index(batch_size)) + " operations")
+
+
 @requires_blockchain
 def start_block_monitor():
     monitor = BlockchainMonitor()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from bitshares.exceptions import AccountDoesNotExistsException
+
+from bexi import account_resolver
+from bexi.account_resolver import AccountResolver
+
+
+ACCOUNTS = {
+    "1.2.1": "alice",
+    "1.2.2": "bob",
+    "1.2.3": "charlie",
+}
+
+
+class FakeChain(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_objects(self, account_ids):
+        self.calls += 1
+        return [{"id": x, "name": ACCOUNTS[x]} if x in ACCOUNTS else None
+                for x in account_ids]
+
+    def lookup_account_names(self, account_names):
+        self.calls += 1
+        ids = {name: account_id for account_id, name in ACCOUNTS.items()}
+        return [{"id": ids[x], "name": x} if x in ids else None
+                for x in account_names]
+
+
+class TestAccountResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = FakeChain()
+        patcher_ids = mock.patch.object(account_resolver, "_get_accounts_by_id", self.chain.get_objects)
+        patcher_names = mock.patch.object(account_resolver, "_get_accounts_by_name", self.chain.lookup_account_names)
+        patcher_ids.start()
+        patcher_names.start()
+        self.addCleanup(patcher_ids.stop)
+        self.addCleanup(patcher_names.stop)
+
+    def test_batch_and_hits(self):
+        resolver = AccountResolver()
+
+        assert resolver.get_names(["1.2.1", "1.2.2"]) == {"1.2.1": "alice", "1.2.2": "bob"}
+        assert self.chain.calls == 1
+
+        assert resolver.get_name("1.2.1") == "alice"
+        assert resolver.get_id("bob") == "1.2.2"
+        assert self.chain.calls == 1
+
+        assert resolver.get_statistics() == {"hits": 2, "misses": 2, "size": 2}
+
+    def test_not_existing(self):
+        resolver = AccountResolver()
+
+        assert resolver.get_names(["1.2.1", "1.2.99"]) == {"1.2.1": "alice", "1.2.99": None}
+        self.assertRaises(AccountDoesNotExistsException,
+                          resolver.get_id,
+                          "nobody")
+
+    def test_size_bound(self):
+        resolver = AccountResolver(size=2)
+
+        resolver.get_names(["1.2.1", "1.2.2"])
+        resolver.get_name("1.2.1")
+        resolver.get_name("1.2.3")
+
+        # bob was least recently used
+        assert resolver.get_statistics()["size"] == 2
+        calls = self.chain.calls
+        resolver.get_name("1.2.1")
+        assert self.chain.calls == calls
+        resolver.get_id("bob")
+        assert self.chain.calls == calls + 1
+
+    def test_ttl(self):
+        resolver = AccountResolver(ttl_in_sec=0.05)
+
+        resolver.get_name("1.2.1")
+        time.sleep(0.1)
+        resolver.get_name("1.2.1")
+
+        assert self.chain.calls == 2
+
+    def test_snapshot(self):
+        snapshot_file = os.path.join(tempfile.mkdtemp(), "accounts.json")
+
+        resolver = AccountResolver(snapshot_file=snapshot_file)
+        resolver.get_names(["1.2.1", "1.2.2"])
+        resolver.save_snapshot()
+
+        warm = AccountResolver(snapshot_file=snapshot_file)
+        assert warm.get_id("alice") == "1.2.1"
+        assert warm.get_name("1.2.2") == "bob"
+        assert self.chain.calls == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
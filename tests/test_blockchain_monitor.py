@@ -1,6 +1,21 @@
+import random
+import threading
+import time
+import unittest
+from unittest import mock
+
+import bexi.blockchain_monitor
 from bexi.blockchain_monitor import BlockchainMonitor
+from bexi.blockchain_monitor import notification, prefetch
+from bexi.blockchain_monitor.backfill import BackfillMonitor, split_range
+from bexi.blockchain_monitor.prefetch import BlockPrefetcher, get_block
+from bexi.blockchain_monitor.memo_decryption import MemoDecryptionPool
+from bitsharesbase import memo as BtsMemo
+from bitsharesbase.account import PrivateKey
+from bitshares.blockchain import Blockchain
 from bexi.connection import requires_blockchain
-from bexi import Config, connection
+from bexi import Config, connection, account_resolver
+from bexi.operation_storage.operation_formatter import decode_operation
 from tests.abstract_tests import ATestnetTest
 
 
@@ -28,3 +43,624 @@ class TestBlockchainMonitor(ATestnetTest):
         monitor.start_block = 14972965
         monitor.stop_block = 14972975
         monitor.listen()
+
+
+class FakeBlockRPC(object):
+    """ Answers get_block with random latency, so that requests return out of order
+    """
+
+    def get_block(self, block_num):
+        time.sleep(random.random() / 100)
+        return {"previous": str(block_num - 1), "transactions": []}
+
+
+class TestBlockPrefetcher(unittest.TestCase):
+
+    def test_blocks_in_order(self):
+        prefetcher = BlockPrefetcher(8, rpc_factory=FakeBlockRPC)
+        try:
+            block_nums = [block["block_num"] for block in prefetcher.blocks(100, 199)]
+        finally:
+            prefetcher.close()
+
+        assert block_nums == list(range(100, 200))
+
+    def test_stop_early(self):
+        prefetcher = BlockPrefetcher(8, rpc_factory=FakeBlockRPC)
+        try:
+            for block in prefetcher.blocks(1, 1000):
+                if block["block_num"] == 10:
+                    break
+        finally:
+            prefetcher.close()
+
+        assert block["block_num"] == 10
+
+    def test_retry_missing_block(self):
+        rpc = mock.Mock()
+        rpc.get_block.side_effect = [None, None, {"previous": "9", "transactions": []}]
+        with mock.patch.object(prefetch.time, "sleep") as sleep:
+            assert get_block(rpc, 10, max_retries=2)["block_num"] == 10
+            assert sleep.call_count == 2
+
+            rpc.get_block.side_effect = [None, None, None]
+            self.assertRaises(Exception, get_block, rpc, 10, max_retries=2)
+
+
+class TestMemoDecryptionPool(unittest.TestCase):
+
+    EXCHANGE_MEMO_KEY = "5JCHqyxngCFX98wiexo6JPVwikBrWJ4toin9tSWcRws2YfbYQ6i"
+    CUSTOMER_MEMO_KEY = "5HuuC1pbw5fsJFbTvR9VXbnv1qp9KSb3LpwUrhRLsUVgukGFu1G"
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+
+    def tearDown(self):
+        Config.reset()
+
+    def _encrypt(self, message, nonce):
+        sender = PrivateKey(self.CUSTOMER_MEMO_KEY)
+        receiver = PrivateKey(self.EXCHANGE_MEMO_KEY)
+        return {
+            "from": format(sender.pubkey, "TEST"),
+            "to": format(receiver.pubkey, "TEST"),
+            "nonce": str(nonce),
+            "message": BtsMemo.encode_memo(sender, receiver.pubkey, str(nonce), message)
+        }
+
+    def test_decrypt_in_order(self):
+        pool = MemoDecryptionPool(2, [self.EXCHANGE_MEMO_KEY], "TEST")
+        try:
+            payloads = [{"memo": self._encrypt("customer_" + str(i), 1000 + i)} for i in range(20)]
+            broken = self._encrypt("broken", 1)
+            broken["nonce"] = "2"
+            payloads.append({"memo": broken})
+            payloads.append({})
+
+            decoded = pool.decrypt(payloads)
+        finally:
+            pool.close()
+
+        assert decoded[0:20] == ["customer_" + str(i) for i in range(20)]
+        assert decoded[20] == "decoding_not_possible"
+        assert decoded[21] == ""
+
+    def test_closed_by_monitor(self):
+        Config.data["bitshares"]["memo_decryption_workers"] = 2
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        node = FakeForkingNode(exchange_account_id)
+        node.set_branch("a", 0, 105)
+        storage = FakeOperationStorage()
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]):
+            monitor = BackfillMonitor(
+                101,
+                105,
+                bitshares_instance=FakeBitShares(node),
+                storage=storage)
+            memo_pool = monitor.memo_pool
+            with mock.patch.object(memo_pool, "close", wraps=memo_pool.close) as close:
+                monitor.listen()
+
+        close.assert_called_once_with()
+        assert monitor.memo_pool is None
+        assert len(storage.operations) == 5
+
+
+class FakeNode(object):
+    """ Produces blocks on request, each containing a deposit to the exchange
+        account, and pushes the new dynamic global properties to its
+        subscribers. Counts the polls of the dynamic global properties
+    """
+
+    def __init__(self, block_interval, exchange_account_id):
+        self.block_interval = block_interval
+        self.exchange_account_id = exchange_account_id
+        self.head_block_num = 100
+        self.polls = 0
+        self.subscribers = []
+        self.subscribed = threading.Event()
+
+    def _get_properties(self):
+        return {"head_block_number": self.head_block_num,
+                "last_irreversible_block_num": self.head_block_num}
+
+    def get_dynamic_global_properties(self):
+        self.polls += 1
+        return self._get_properties()
+
+    def get_object(self, object_id):
+        return {"parameters": {"block_interval": self.block_interval}}
+
+    def get_block(self, block_num):
+        if block_num > self.head_block_num:
+            return None
+        return {
+            "previous": str(block_num - 1),
+            "timestamp": "2018-01-12T08:25:29",
+            "transactions": [{
+                "ref_block_num": block_num % 0xffff,
+                "ref_block_prefix": 1,
+                "expiration": "2018-01-12T08:25:29",
+                "operations": [[0, {
+                    "fee": {"amount": 100, "asset_id": "1.3.0"},
+                    "from": "1.2.1",
+                    "to": self.exchange_account_id,
+                    "amount": {"amount": block_num, "asset_id": "1.3.0"},
+                    "extensions": []
+                }]],
+                "extensions": [],
+                "signatures": []
+            }]
+        }
+
+    def subscribe(self, on_global_properties):
+        self.subscribers.append(on_global_properties)
+        self.subscribed.set()
+        return self
+
+    def produce(self, blocks):
+        """ Produces the given number of blocks once somebody subscribed
+        """
+        self.subscribed.wait()
+        for index in range(blocks):
+            self.head_block_num += 1
+            for subscriber in self.subscribers:
+                subscriber(self._get_properties())
+
+    def close(self):
+        self.subscribers = []
+
+
+class FakeBitShares(object):
+
+    prefix = "TEST"
+
+    def __init__(self, node):
+        self.rpc = node
+        self.wallet = mock.MagicMock()
+        self.wallet.created.return_value = False
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.inserted_block_nums = []
+
+    def get_last_head_block_num(self):
+        return 0
+
+    def set_last_head_block_num(self, head_block_num):
+        pass
+
+    def insert_or_update_operations(self, operations):
+        for operation in operations:
+            self.inserted_block_nums.append(operation["block_num"])
+        return ["inserted"] * len(operations)
+
+
+class FakeForkingNode(FakeNode):
+    """ Serves the blocks of the current branch, block ids are the branch
+        name followed by the block number
+    """
+
+    def __init__(self, exchange_account_id):
+        super(FakeForkingNode, self).__init__(1, exchange_account_id)
+        self.branches = {}
+
+    def set_branch(self, name, first_block_num, head_block_num):
+        """ Blocks from ``first_block_num`` on are taken from the branch
+            ``name``
+        """
+        self.branches[first_block_num] = name
+        self.head_block_num = head_block_num
+
+    def _get_branch(self, block_num):
+        return self.branches[max(x for x in self.branches if x <= block_num)]
+
+    def get_block(self, block_num):
+        block = super(FakeForkingNode, self).get_block(block_num)
+        if block is None:
+            return None
+        branch = self._get_branch(block_num)
+        block["block_id"] = branch + str(block_num)
+        block["previous"] = self._get_branch(block_num - 1) + str(block_num - 1)
+        # the deposits differ between the branches
+        amount = block["transactions"][0]["operations"][0][1]["amount"]
+        amount["amount"] = amount["amount"] * 10 + len(branch)
+        return block
+
+
+class FakeOperationStorage(FakeStorage):
+
+    def __init__(self):
+        super(FakeOperationStorage, self).__init__()
+        self.last_head_block_num = 0
+        self.operations = {}
+        self.backfill_block_nums = {}
+
+    def get_last_head_block_num(self):
+        return self.last_head_block_num
+
+    def set_last_head_block_num(self, head_block_num):
+        assert head_block_num > self.last_head_block_num
+        self.last_head_block_num = head_block_num
+
+    def insert_or_update_operations(self, operations):
+        results = []
+        for operation in operations:
+            operation = decode_operation(operation)
+            if operation["chain_identifier"] in self.operations:
+                results.append("duplicate")
+            else:
+                self.operations[operation["chain_identifier"]] = operation
+                results.append("inserted")
+        return results
+
+    def get_last_backfill_block_num(self, shard):
+        return self.backfill_block_nums.get(shard, 0)
+
+    def set_last_backfill_block_num(self, shard, block_num):
+        self.backfill_block_nums[shard] = max(
+            block_num, self.get_last_backfill_block_num(shard))
+
+    def delete_operation(self, operation):
+        self.operations.pop(operation["chain_identifier"])
+
+    def promote_pending_operations(self, start_block, end_block):
+        promoted = 0
+        for operation in self.operations.values():
+            if operation["status"] == "pending" and\
+                    start_block <= operation["block_num"] <= end_block:
+                operation["status"] = "completed"
+                promoted += 1
+        return promoted
+
+
+class TestOperationMatching(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+        self.exchange_account_id = Config.get("bitshares", "exchange_account_id")
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": self.exchange_account_id}):
+            self.monitor = BlockchainMonitor(
+                bitshares_instance=FakeBitShares(FakeNode(1, self.exchange_account_id)),
+                storage=FakeStorage())
+
+    def tearDown(self):
+        Config.reset()
+
+    def get_transaction(self, *operations):
+        return {"block_num": 101,
+                "timestamp": "2018-01-12T08:25:29",
+                "expiration": "2018-01-12T08:25:29",
+                "operations": list(operations)}
+
+    def get_transfer(self, to):
+        return [0, {"fee": {"amount": 100, "asset_id": "1.3.0"},
+                    "from": "1.2.1",
+                    "to": to,
+                    "amount": {"amount": 1000, "asset_id": "1.3.0"},
+                    "extensions": []}]
+
+    def get_limit_order(self, seller):
+        return [1, {"fee": {"amount": 100, "asset_id": "1.3.0"},
+                    "seller": seller,
+                    "amount_to_sell": {"amount": 1000, "asset_id": "1.3.0"},
+                    "min_to_receive": {"amount": 1, "asset_id": "1.3.121"},
+                    "expiration": "2018-01-12T08:25:29",
+                    "fill_or_kill": False,
+                    "extensions": []}]
+
+    def process_transaction(self, transaction):
+        """ Returns the operations that were sent to processing and the
+            number of operation names that were looked up
+        """
+        with mock.patch.object(self.monitor, "process_operation") as process_operation,\
+                mock.patch.object(bexi.blockchain_monitor, "getOperationNameForId",
+                                  wraps=bexi.blockchain_monitor.getOperationNameForId) as get_name:
+            self.monitor.process_transaction(transaction)
+        return ([call[0][0] for call in process_operation.call_args_list],
+                get_name.call_count)
+
+    def test_drop_without_decoding(self):
+        processed, names = self.process_transaction(self.get_transaction(
+            self.get_limit_order(self.exchange_account_id),
+            self.get_transfer("1.2.2")))
+
+        assert processed == []
+        assert names == 0
+
+    def test_matching_transfer(self):
+        processed, names = self.process_transaction(self.get_transaction(
+            self.get_transfer("1.2.2"),
+            self.get_transfer(self.exchange_account_id)))
+
+        assert [(x["op_in_tx"], x["op"][0]) for x in processed] == [(1, "transfer")]
+        assert processed[0]["op"][1]["to"] == self.exchange_account_id
+        assert names == 1
+
+    def test_registered_matcher(self):
+        self.monitor.operation_matchers[1] =\
+            lambda payload: payload["seller"] == self.exchange_account_id
+
+        processed, names = self.process_transaction(self.get_transaction(
+            self.get_limit_order("1.2.2"),
+            self.get_limit_order(self.exchange_account_id)))
+
+        assert [(x["op_in_tx"], x["op"][0]) for x in processed] == [(1, "limit_order_create")]
+        assert names == 1
+
+
+class TestHeadModeRollback(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+        Config.data["bitshares"]["watch_mode"] = "head"
+        Config.data["bitshares"]["block_notification"] = "polling"
+
+    def tearDown(self):
+        Config.reset()
+
+    def test_fork(self):
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        node = FakeForkingNode(exchange_account_id)
+        node.set_branch("a", 0, 103)
+        storage = FakeOperationStorage()
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]):
+            monitor = BlockchainMonitor(
+                bitshares_instance=FakeBitShares(node),
+                storage=storage,
+                start_block=101,
+                stop_block=103)
+            monitor.listen()
+
+            assert sorted(x["amount_value"] for x in storage.operations.values()) == [1011, 1021, 1031]
+            assert storage.last_head_block_num == 103
+
+            # block 103 is forked out
+            node.set_branch("bb", 103, 104)
+            monitor.start_block = 104
+            monitor.stop_block = 104
+            monitor.listen()
+
+        assert sorted(x["amount_value"] for x in storage.operations.values()) == [1011, 1021, 1032, 1042]
+        assert storage.last_head_block_num == 104
+
+
+class TestDualMode(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+        Config.data["bitshares"]["watch_mode"] = "dual"
+        Config.data["bitshares"]["block_notification"] = "polling"
+
+    def tearDown(self):
+        Config.reset()
+
+    def test_promote(self):
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        node = FakeForkingNode(exchange_account_id)
+        node.set_branch("a", 0, 103)
+        node.get_dynamic_global_properties = lambda: {
+            "head_block_number": node.head_block_num,
+            "last_irreversible_block_num": node.head_block_num - 2}
+        storage = FakeOperationStorage()
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]):
+            monitor = BlockchainMonitor(
+                bitshares_instance=FakeBitShares(node),
+                storage=storage,
+                start_block=101,
+                stop_block=103)
+            monitor.listen()
+
+        statuses = {x["block_num"]: x["status"] for x in storage.operations.values()}
+        assert statuses == {101: "completed", 102: "pending", 103: "pending"}
+
+
+class TestCommitBatch(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+        Config.data["bitshares"]["watch_mode"] = "irreversible"
+        Config.data["bitshares"]["block_notification"] = "polling"
+        Config.data["bitshares"]["prefetch_window"] = 1
+        Config.data["bitshares"]["commit_batch"] = {"blocks": 5, "interval_in_ms": 60000}
+
+        self.exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        self.node = FakeForkingNode(self.exchange_account_id)
+        self.node.set_branch("a", 0, 110)
+        self.storage = FakeOperationStorage()
+
+    def tearDown(self):
+        Config.reset()
+
+    def listen(self, stop_block, start_block=None, crash=False):
+        """ Runs a new monitor and keeps the results of all its bulk writes and
+            all its checkpoints. With ``crash`` the monitor stops before the
+            first checkpoint is stored
+        """
+        writes = []
+        checkpoints = []
+
+        def insert_or_update_operations(operations):
+            results = FakeOperationStorage.insert_or_update_operations(self.storage, operations)
+            writes.append(results)
+            return results
+
+        def set_last_head_block_num(head_block_num):
+            if crash:
+                raise RuntimeError("crash")
+            checkpoints.append(head_block_num)
+            FakeOperationStorage.set_last_head_block_num(self.storage, head_block_num)
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": self.exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]),\
+                mock.patch.object(self.storage, "insert_or_update_operations",
+                                  side_effect=insert_or_update_operations),\
+                mock.patch.object(self.storage, "set_last_head_block_num",
+                                  side_effect=set_last_head_block_num):
+            monitor = BlockchainMonitor(
+                bitshares_instance=FakeBitShares(self.node),
+                storage=self.storage,
+                start_block=start_block,
+                stop_block=stop_block)
+            try:
+                monitor.listen()
+            finally:
+                self.writes = writes
+                self.checkpoints = checkpoints
+
+    def test_one_write_per_batch(self):
+        self.listen(105, start_block=101)
+
+        assert self.writes == [["inserted"] * 5]
+        assert self.checkpoints == [105]
+
+        # continues with the next block, the checkpoint only moves forward
+        self.listen(110)
+
+        assert self.writes == [["inserted"] * 5]
+        assert self.checkpoints == [110]
+        assert sorted(x["block_num"] for x in self.storage.operations.values()) ==\
+            list(range(101, 111))
+
+    def test_replay_after_crash(self):
+        self.listen(105, start_block=101)
+
+        # the operations of the batch are written, the checkpoint is not
+        self.assertRaises(RuntimeError, self.listen, 110, crash=True)
+        assert self.writes == [["inserted"] * 5]
+        assert self.storage.last_head_block_num == 105
+
+        self.listen(110)
+
+        # starts over with the first uncommitted block
+        assert self.writes == [["duplicate"] * 5]
+        assert self.checkpoints == [110]
+        assert len(self.storage.operations) == 10
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+        Config.data["bitshares"]["watch_mode"] = "head"
+
+    def tearDown(self):
+        Config.reset()
+
+    def test_split_range(self):
+        assert split_range(1, 10, 3) == [(1, 4), (5, 7), (8, 10)]
+        assert split_range(1, 2, 4) == [(1, 1), (2, 2)]
+        assert split_range(5, 5, 1) == [(5, 5)]
+
+    def test_resume_shards(self):
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        node = FakeForkingNode(exchange_account_id)
+        node.set_branch("a", 0, 110)
+        storage = FakeOperationStorage()
+        # an interrupted run committed block 101 of the first shard
+        storage.set_last_backfill_block_num("101-105", 101)
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]):
+            for start_block, stop_block in split_range(101, 110, 2):
+                monitor = BackfillMonitor(
+                    start_block,
+                    stop_block,
+                    bitshares_instance=FakeBitShares(node),
+                    storage=storage)
+                if start_block == 101:
+                    assert monitor.start_block == 102
+                monitor.listen()
+                assert monitor.is_done()
+
+        assert sorted(x["block_num"] for x in storage.operations.values()) == list(range(102, 111))
+        assert storage.backfill_block_nums == {"101-105": 105, "106-110": 110}
+        # the checkpoint of the monitor is untouched
+        assert storage.last_head_block_num == 0
+
+
+class TestBlockNotification(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+        Config.data["network_type"] = "Test"
+
+    def tearDown(self):
+        Config.reset()
+
+    def test_wake_up_on_pushed_block(self):
+        Config.data["bitshares"]["block_notification"] = "subscription"
+        Config.data["bitshares"]["prefetch_window"] = 1
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+
+        # the fallback to polling would only start after two block intervals
+        node = FakeNode(60, exchange_account_id)
+        storage = FakeStorage()
+
+        with mock.patch.object(bexi.blockchain_monitor, "Account",
+                               return_value={"id": exchange_account_id}),\
+                mock.patch.object(account_resolver, "_get_accounts_by_id",
+                                  lambda ids: [{"id": x, "name": x} for x in ids]),\
+                mock.patch.object(notification, "subscribe_to_global_properties",
+                                  node.subscribe):
+            monitor = BlockchainMonitor(
+                bitshares_instance=FakeBitShares(node),
+                storage=storage,
+                start_block=101,
+                stop_block=103)
+
+            producer = threading.Thread(target=node.produce, args=(3,))
+            producer.start()
+            try:
+                monitor.listen()
+            finally:
+                producer.join()
+
+        assert storage.inserted_block_nums == [101, 102, 103]
+        # woken up by the pushed blocks only, the node was never polled
+        assert node.polls == 0
+
+    def test_fallback_to_polling(self):
+        exchange_account_id = Config.get("bitshares", "exchange_account_id")
+        node = FakeNode(60, exchange_account_id)
+        node.head_block_num = 101
+        blockchain = Blockchain(
+            mode="irreversible",
+            bitshares_instance=FakeBitShares(node))
+
+        # the subscription never delivers
+        notifier = notification.SubscriptionBlockNotifier(
+            blockchain,
+            subscribe=lambda callback: mock.MagicMock(),
+            fallback_after_in_sec=0.01)
+        try:
+            assert notifier.wait_for_block(101) == 101
+        finally:
+            notifier.close()
+        assert node.polls == 1
@@ -0,0 +1,136 @@
+import pymongo
+
+from tests.abstract_tests import ATestOperationStorage
+
+from bexi.addresses import create_unique_address, split_unique_address
+from bexi.factory import get_operation_storage
+from bexi.operation_storage.mongodb_storage import INDEXES
+
+
+class QueryRecorder(object):
+    """ Passes all calls to the collection and records the filter of every
+        query, so that the queries of a storage can be explained afterwards
+    """
+
+    FILTERED = ["find", "find_one", "update_one", "update_many", "delete_one",
+                "delete_many", "find_one_and_update", "find_one_and_delete"]
+
+    def __init__(self, collection, queries):
+        self._collection = collection
+        self._queries = queries
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in self.FILTERED:
+            def recorded(query_filter=None, *args, **kwargs):
+                self._queries.append((self._collection, name, query_filter or {}))
+                return attribute(query_filter, *args, **kwargs)
+            return recorded
+        if name == "aggregate":
+            def recorded(pipeline, *args, **kwargs):
+                self._queries.append((self._collection, name, pipeline[0]["$match"]))
+                return attribute(pipeline, *args, **kwargs)
+            return recorded
+        if name == "bulk_write":
+            def recorded(requests, *args, **kwargs):
+                for request in requests:
+                    # inserts have no filter
+                    if hasattr(request, "_filter"):
+                        self._queries.append((self._collection, name, request._filter))
+                return attribute(requests, *args, **kwargs)
+            return recorded
+        return attribute
+
+
+def get_stages(plan):
+    """ Returns the names of all stages of the given query plan
+    """
+    stages = [plan["stage"]]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(get_stages(child))
+    return stages
+
+
+class TestMongoIndexes(ATestOperationStorage):
+
+    def setUp(self):
+        super(TestMongoIndexes, self).setUp()
+        self.storage = get_operation_storage("mongodbtest")
+
+    def test_reconcile(self):
+        collection = self.storage._operations_storage
+        collection.drop_index("incident_id")
+        collection.create_index([("memo", pymongo.ASCENDING)], name="memo")
+
+        report = self.storage.reconcile_indexes()
+
+        assert report["created"] == [collection.name + ".incident_id"]
+        assert report["unused"] == [collection.name + ".memo"]
+        assert "incident_id" in collection.index_information()
+
+        report = self.storage.reconcile_indexes()
+        assert report["created"] == []
+
+    def test_declared_indexes(self):
+        for collection_key, indexes in INDEXES.items():
+            information = self.storage._db[
+                self.storage._mongodb_config[collection_key]].index_information()
+            for index in indexes:
+                assert index["name"] in information
+
+    def test_no_collection_scan(self):
+        queries = []
+        for attribute in ["_operations_storage", "_status_storage",
+                          "_address_storage", "_balance_storage"]:
+            setattr(self.storage, attribute,
+                    QueryRecorder(getattr(self.storage, attribute), queries))
+
+        # run every storage query at least once
+        address = create_unique_address("lykke-customer")
+        addrs = split_unique_address(address)
+        self.storage.track_address(address)
+
+        in_progress = self.get_in_progress_op()
+        in_progress["customer_id"] = addrs["customer_id"]
+        self.storage.insert_operation(in_progress)
+        in_progress["block_num"] = 100
+        self.storage.flag_operation_completed(in_progress)
+        in_progress["status"] = "completed"
+        self.storage.revert_operation_completed(in_progress)
+
+        pending = self.get_completed_op()
+        pending["customer_id"] = addrs["customer_id"]
+        pending["chain_identifier"] = "24:1"
+        pending["incident_id"] = "some_other_incident_id"
+        pending["status"] = "pending"
+        self.storage.insert_or_update_operations([pending, in_progress])
+        self.storage.insert_operations([pending])
+        self.storage.promote_pending_operations(1, 200)
+
+        self.storage.get_operation(pending["incident_id"])
+        self.storage.get_balances(10)
+        self.storage.get_balances(10, addresses=[address])
+        for status in ["in_progress", "pending", "completed", "failed"]:
+            getattr(self.storage, "get_operations_" + status)()
+            getattr(self.storage, "get_operations_" + status)(
+                filter_by={"customer_id": addrs["customer_id"]})
+        self.storage.rebuild_balances()
+        self.storage.delete_operation(pending["incident_id"])
+
+        self.storage.set_last_head_block_num(1)
+        self.storage.get_last_head_block_num()
+        self.storage.set_last_backfill_block_num("1-10", 1)
+        self.storage.get_last_backfill_block_num("1-10")
+        self.storage.untrack_address(address)
+
+        assert queries
+        for collection, method, query_filter in queries:
+            if not query_filter:
+                # deliberately all documents, e.g. a full rebuild
+                continue
+            plan = collection.find(query_filter).explain()["queryPlanner"]["winningPlan"]
+            # slot based execution nests the classic plan
+            plan = plan.get("queryPlan", plan)
+            assert "COLLSCAN" not in get_stages(plan),\
+                "{}.{}({}) scans the collection".format(collection.name, method, query_filter)
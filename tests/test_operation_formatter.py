@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+from jsonschema.exceptions import ValidationError
+
+from bexi import Config
+from bexi.operation_storage import operation_formatter
+from bexi.operation_storage.operation_formatter import decode_operation, validate_operation
+from bexi.utils import date_to_string
+
+from tests.abstract_tests import ATestOperationStorage
+
+
+class TestValidateOperation(unittest.TestCase):
+
+    def setUp(self):
+        Config.load()
+
+    def get_operation(self):
+        operation = decode_operation(ATestOperationStorage.TEST_OP.copy())
+        operation["status"] = "completed"
+        operation["timestamp"] = date_to_string()
+        return operation
+
+    def get_invalid_operations(self):
+        missing = self.get_operation()
+        missing.pop("customer_id")
+        wrong_type = self.get_operation()
+        wrong_type["amount_value"] = "1000"
+        boolean = self.get_operation()
+        boolean["fee_value"] = True
+        wrong_status = self.get_operation()
+        wrong_status["status"] = "done"
+        return [missing, wrong_type, boolean, wrong_status]
+
+    def test_modes(self):
+        for mode in ["full", "fast", "sampled"]:
+            validate_operation(self.get_operation(), mode=mode)
+            none_block_num = self.get_operation()
+            none_block_num["block_num"] = None
+            validate_operation(none_block_num, mode=mode)
+
+            for operation in self.get_invalid_operations():
+                self.assertRaises(ValidationError,
+                                  validate_operation,
+                                  operation,
+                                  mode=mode)
+
+    def test_same_error(self):
+        for operation in self.get_invalid_operations():
+            with self.assertRaises(ValidationError) as full:
+                validate_operation(operation, mode="full")
+            with self.assertRaises(ValidationError) as fast:
+                validate_operation(operation, mode="fast")
+            assert full.exception.message == fast.exception.message
+
+    def test_configured_mode(self):
+        validation = Config.data["operation_storage"]["validation"]
+        with mock.patch.object(operation_formatter.jsonschema.exceptions,
+                               "best_match",
+                               return_value=None) as full:
+            validation["mode"] = "fast"
+            validate_operation(self.get_operation())
+            assert full.call_count == 0
+
+            # changes of the configuration are picked up by the next call
+            validation["mode"] = "full"
+            validate_operation(self.get_operation())
+            assert full.call_count == 1
+
+            validation["mode"] = "sampled"
+            validation["sample_every"] = 1
+            validate_operation(self.get_operation())
+            validate_operation(self.get_operation())
+            assert full.call_count == 3
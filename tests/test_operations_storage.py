@@ -1,3 +1,7 @@
+import os
+import tempfile
+import unittest
+
 from tests.abstract_tests import ATestOperationStorage
 
 from bexi.operation_storage.exceptions import AddressAlreadyTrackedException,\
@@ -5,8 +9,11 @@ from bexi.operation_storage.exceptions import AddressAlreadyTrackedException,\
     InvalidOperationException, OperationNotFoundException,\
     DuplicateOperationException, OperationStorageException, InputInvalidException
 
-from bexi.addresses import create_unique_address, split_unique_address
+from bexi.addresses import create_unique_address, split_unique_address, DELIMITER
+from bexi import Config
 from bexi.factory import get_operation_storage
+from bexi.operation_storage.azure_storage import get_partition_key
+from bexi.operation_storage.caching_storage import CachingOperationStorage
 from jsonschema.exceptions import ValidationError
 
 
@@ -45,6 +52,55 @@ class TestMongoOperationStorage(ATestOperationStorage):
         for document in self.storage.get_operations_completed():
             assert document["chain_identifier"] == self.get_completed_op()["chain_identifier"]
 
+    def test_revert_completed(self):
+        self.storage.insert_operation(self.get_in_progress_op())
+        self.storage.flag_operation_completed(self.get_completed_op())
+
+        self.storage.revert_operation_completed(self.get_completed_op())
+
+        assert len(self.storage.get_operations_completed()) == 0
+        assert len(self.storage.get_operations_in_progress()) == 1
+
+        self.assertRaises(OperationNotFoundException,
+                          self.storage.revert_operation_completed,
+                          self.get_completed_op())
+
+        filled_operation = self.get_completed_op()
+        filled_operation["status"] = "in_progress"
+        self.assertRaises(StatusInvalidException,
+                          self.storage.revert_operation_completed,
+                          filled_operation)
+
+    def test_pending(self):
+        self.storage.insert_operation(self.get_in_progress_op())
+
+        pending_operation = self.get_completed_op()
+        pending_operation["status"] = "pending"
+        self.storage.insert_or_update_operation(pending_operation)
+
+        other_operation = self.get_completed_op()
+        other_operation["chain_identifier"] = "some_other_chain_identifier_1"
+        other_operation["incident_id"] = "some_other_incident_id"
+        other_operation["block_num"] = other_operation["block_num"] + 10
+        other_operation["status"] = "pending"
+        self.storage.insert_operation(other_operation)
+
+        assert len(self.storage.get_operations_in_progress()) == 0
+        assert len(self.storage.get_operations_pending()) == 2
+        assert len(self.storage.get_operations_completed()) == 0
+
+        block_num = self.get_completed_op()["block_num"]
+        assert self.storage.promote_pending_operations(block_num, block_num + 9) == 1
+
+        assert len(self.storage.get_operations_pending()) == 1
+        assert len(self.storage.get_operations_completed()) == 1
+
+        no_block_num = self.get_in_progress_op()
+        no_block_num["status"] = "pending"
+        self.assertRaises(InvalidOperationException,
+                          self.storage.insert_operation,
+                          no_block_num)
+
     def test_insert(self):
         filled_operation = self.get_in_progress_op()
         self.storage.insert_operation(filled_operation)
@@ -173,6 +229,74 @@ class TestMongoOperationStorage(ATestOperationStorage):
                           2,
                           "069548")
 
+    def test_balance_ledger(self):
+        address = create_unique_address("lykke-customer")
+        addrs = split_unique_address(address)
+
+        deposit = self.get_completed_op()
+        deposit["to"] = addrs["account_id"]
+        deposit["customer_id"] = addrs["customer_id"]
+        deposit["amount_value"] = 10
+        self.storage.insert_operation(deposit)
+
+        withdrawal = self.get_in_progress_op()
+        withdrawal["from"] = addrs["account_id"]
+        withdrawal["customer_id"] = addrs["customer_id"]
+        withdrawal["incident_id"] = "some_operation_id_2"
+        withdrawal["chain_identifier"] = "some_chain_identifier_2"
+        withdrawal["amount_value"] = 3
+        self.storage.insert_operation(withdrawal)
+
+        balances = self.storage.get_balances(1, addresses=[address])
+        assert balances[address] == {"1.3.121": 10,
+                                     "block_num": deposit["block_num"]}
+
+        withdrawal["block_num"] = deposit["block_num"] + 1
+        self.storage.flag_operation_completed(withdrawal)
+
+        balances = self.storage.get_balances(1, addresses=[address])
+        assert balances[address] == {"1.3.121": 7,
+                                     "1.3.0": -withdrawal["fee_value"],
+                                     "block_num": deposit["block_num"] + 1}
+
+        # customer and counterparties, amount and fee assets
+        assert self.storage.rebuild_balances() == 5
+        assert self.storage.get_balances(1, addresses=[address]) == balances
+
+        withdrawal["status"] = "completed"
+        self.storage.revert_operation_completed(withdrawal)
+        self.storage.delete_operation(self.storage.get_operation(deposit["incident_id"]))
+
+        assert self.storage.get_balances(1, addresses=[address]) == {}
+
+    def test_balances_pagination(self):
+        addresses = []
+        for i in range(5):
+            address = "1.2.20477" + DELIMITER + "customer_" + str(i)
+            filled_operation = self.get_completed_op()
+            filled_operation["to"] = "1.2.20477"
+            filled_operation["customer_id"] = "customer_" + str(i)
+            filled_operation["incident_id"] = "some_operation_id_" + str(i)
+            filled_operation["chain_identifier"] = "some_chain_identifier_" + str(i)
+            self.storage.insert_operation(filled_operation)
+            self.storage.track_address(address)
+            addresses.append(address)
+
+        seen = []
+        continuation = None
+        while True:
+            balances = self.storage.get_balances(2, continuation)
+            continuation = balances.pop("continuation")
+            if not seen:
+                # addresses removed in between don't shift the following pages
+                self.storage.untrack_address(list(balances.keys())[0])
+            seen.extend(balances.keys())
+            if continuation is None:
+                break
+
+        assert len(seen) == len(set(seen))
+        assert set(addresses) == set(seen)
+
     def test_tracking(self):
         address1 = create_unique_address("lykke-customer")
         address2 = create_unique_address("lykke-test")
@@ -205,6 +329,105 @@ class TestMongoOperationStorage(ATestOperationStorage):
                           self.storage.untrack_address,
                           address1)
 
+    def test_insert_or_update_operation(self):
+        in_progress = self.get_in_progress_op()
+        self.storage.insert_operation(in_progress)
+        timestamp = self.storage.get_operation(in_progress["incident_id"])["timestamp"]
+
+        # our own broadcast is confirmed
+        self.storage.insert_or_update_operation(self.get_completed_op())
+        operation = self.storage.get_operation(in_progress["incident_id"])
+        assert operation["status"] == "completed"
+        assert operation["block_num"] == self.get_completed_op()["block_num"]
+        assert operation["timestamp"] == timestamp
+
+        self.assertRaises(DuplicateOperationException,
+                          self.storage.insert_or_update_operation,
+                          self.get_completed_op())
+        pending_operation = self.get_completed_op()
+        pending_operation["status"] = "pending"
+        self.assertRaises(DuplicateOperationException,
+                          self.storage.insert_or_update_operation,
+                          pending_operation)
+
+        # same incident, other chain identifier
+        other_operation = self.get_completed_op()
+        other_operation["chain_identifier"] = "some_other_chain_identifier_1"
+        self.assertRaises(DuplicateOperationException,
+                          self.storage.insert_or_update_operation,
+                          other_operation)
+
+        other_operation["incident_id"] = "some_other_incident_id"
+        self.storage.insert_or_update_operation(other_operation)
+        assert len(self.storage.get_operations_completed()) == 2
+
+    def test_failed_not_completed(self):
+        self.storage.insert_operation(self.get_in_progress_op())
+        self.storage.flag_operation_failed(self.get_in_progress_op(), "expired")
+
+        self.assertRaises(DuplicateOperationException,
+                          self.storage.insert_or_update_operation,
+                          self.get_completed_op())
+        self.assertRaises(OperationNotFoundException,
+                          self.storage.flag_operation_completed,
+                          self.get_completed_op())
+        assert self.storage.insert_or_update_operations([self.get_completed_op()]) == ["duplicate"]
+
+        assert len(self.storage.get_operations_failed()) == 1
+        assert self.storage.get_operations_completed() == []
+
+    def test_insert_or_update_operations(self):
+        self.storage.insert_operation(self.get_in_progress_op())
+
+        other_operation = self.get_completed_op()
+        other_operation["chain_identifier"] = "some_other_chain_identifier_1"
+        other_operation["incident_id"] = "some_other_incident_id"
+
+        results = self.storage.insert_or_update_operations([
+            self.get_completed_op(),
+            other_operation,
+            other_operation
+        ])
+
+        assert results == ["updated", "inserted", "duplicate"]
+        assert len(self.storage.get_operations_in_progress()) == 0
+        assert len(self.storage.get_operations_completed()) == 2
+
+        assert self.storage.insert_or_update_operations([self.get_completed_op()]) == ["duplicate"]
+
+        invalid_operation = self.get_completed_op()
+        invalid_operation["chain_identifier"] = "some_other_chain_identifier_2"
+        invalid_operation["status"] = "in_progress"
+        valid_operation = self.get_completed_op()
+        valid_operation["chain_identifier"] = "some_other_chain_identifier_3"
+        valid_operation["incident_id"] = "some_other_incident_id_3"
+        assert self.storage.insert_or_update_operations(
+            [invalid_operation, valid_operation]) == ["invalid", "inserted"]
+        assert len(self.storage.get_operations_completed()) == 3
+
+    def test_insert_operations(self):
+        self.storage.insert_operation(self.get_in_progress_op())
+
+        operations = []
+        for i in range(3):
+            operation = self.get_completed_op()
+            operation["chain_identifier"] = "some_other_chain_identifier_" + str(i)
+            operation["incident_id"] = "some_other_incident_id_" + str(i)
+            operations.append(operation)
+        invalid_operation = self.get_completed_op()
+        invalid_operation["status"] = "in_progress"
+
+        results = self.storage.insert_operations(
+            [self.get_completed_op()] + operations + [operations[0], invalid_operation])
+
+        # unlike insert_or_update_operations, existing operations are not updated
+        assert results == ["duplicate", "inserted", "inserted", "inserted", "duplicate", "invalid"]
+        assert len(self.storage.get_operations_in_progress()) == 1
+        assert len(self.storage.get_operations_completed()) == 3
+
+        assert self.storage.insert_operations(operations) == ["duplicate"] * 3
+        assert self.storage.insert_operations([]) == []
+
     def test_last_head_blockincrement(self):
         self.storage.set_last_head_block_num(1)
         self.storage.set_last_head_block_num(2)
@@ -222,6 +445,120 @@ class TestMongoOperationStorage(ATestOperationStorage):
     def test_default(self):
         assert self.storage.get_last_head_block_num() == 0
 
+    def test_iter_operations(self):
+        filled_operation = self.get_completed_op()
+        for i in range(5):
+            filled_operation["incident_id"] = "some_operation_id_" + str(i)
+            filled_operation["chain_identifier"] = "some_chain_identifier_" + str(i)
+            self.storage.insert_operation(filled_operation)
+
+        operations = self.storage.iter_operations_completed(
+            filter_by={"customer_id": filled_operation["customer_id"]},
+            projection=["chain_identifier", "amount_value"],
+            batch_size=2)
+        assert not isinstance(operations, list)
+
+        operations = list(operations)
+        assert sorted(x["chain_identifier"] for x in operations) ==\
+            ["some_chain_identifier_" + str(i) for i in range(5)]
+        assert all(x["amount_value"] == filled_operation["amount_value"] for x in operations)
+        assert all("memo" not in x for x in operations)
+
+        assert list(self.storage.iter_operations_in_progress()) == []
+
+    def test_backfill_progress(self):
+        assert self.storage.get_last_backfill_block_num("1-10") == 0
+
+        self.storage.set_last_backfill_block_num("1-10", 5)
+        self.storage.set_last_backfill_block_num("11-20", 12)
+        # a resumed shard might commit a block again
+        self.storage.set_last_backfill_block_num("1-10", 4)
+
+        assert self.storage.get_last_backfill_block_num("1-10") == 5
+        assert self.storage.get_last_backfill_block_num("11-20") == 12
+        assert self.storage.get_last_head_block_num() == 0
+
+
+class TestMongoBalanceLedgerUpgrade(ATestOperationStorage):
+
+    def get_deposit(self, address):
+        addrs = split_unique_address(address)
+        deposit = self.get_completed_op()
+        deposit["to"] = addrs["account_id"]
+        deposit["customer_id"] = addrs["customer_id"]
+        deposit["amount_value"] = 10
+        return deposit
+
+    def test_build_ledger(self):
+        address = create_unique_address("lykke-customer")
+        storage = get_operation_storage("mongodbtest")
+        deposit = self.get_deposit(address)
+        storage.insert_operation(deposit)
+
+        # as stored before the balance collection existed
+        storage._db[storage._mongodb_config["balance_collection"]].drop()
+
+        storage = get_operation_storage("mongodbtest", purge=False)
+        assert storage.get_balances(1, addresses=[address])[address] == {
+            "1.3.121": 10,
+            "block_num": deposit["block_num"]}
+
+
+class OtherWriterFirst(object):
+    """ Collection that lets another writer go first, right before the storage reads the
+        operations it updates
+    """
+
+    def __init__(self, collection, other_writer):
+        self._collection = collection
+        self._other_writer = other_writer
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _go_first(self):
+        if self._other_writer:
+            other_writer, self._other_writer = self._other_writer, None
+            other_writer()
+
+    def find(self, *args, **kwargs):
+        documents = list(self._collection.find(*args, **kwargs))
+        self._go_first()
+        return documents
+
+    def find_one_and_update(self, *args, **kwargs):
+        self._go_first()
+        return self._collection.find_one_and_update(*args, **kwargs)
+
+
+class TestMongoConcurrentWriters(ATestOperationStorage):
+
+    def test_update_completed_in_between(self):
+        address = create_unique_address("lykke-customer")
+        addrs = split_unique_address(address)
+        storage = get_operation_storage("mongodbtest")
+        # e.g. an overlapping backfill shard
+        other_storage = get_operation_storage("mongodbtest", purge=False)
+
+        operation = self.get_in_progress_op()
+        operation["to"] = addrs["account_id"]
+        operation["customer_id"] = addrs["customer_id"]
+        operation["amount_value"] = 10
+        storage.insert_operation(operation)
+        operation["block_num"] = 10
+        completed = operation.copy()
+        completed["status"] = "completed"
+
+        storage._operations_storage = OtherWriterFirst(
+            storage._operations_storage,
+            lambda: other_storage.flag_operation_completed(operation))
+        assert storage.insert_or_update_operations([completed]) == ["duplicate"]
+
+        # counted once
+        assert storage.get_balances(1, addresses=[address])[address] == {
+            "1.3.121": 10,
+            "block_num": operation["block_num"]}
+
 
 class TestAzureOperationStorageFactory(TestMongoOperationStorage):
 
@@ -229,3 +566,168 @@ class TestAzureOperationStorageFactory(TestMongoOperationStorage):
         super(TestAzureOperationStorageFactory, self).setUp()
         self.storage = get_operation_storage("azuretest")
 
+    def test_migrate_partitions(self):
+        operation = self.get_completed_op()
+        self.storage.insert_operation(operation)
+
+        # as stored before with another partition scheme
+        tablename = self.storage._operation_tables["incident"]
+        stored = self.storage._service.get_entity(
+            tablename,
+            self.storage._short_digit_hash(operation["incident_id"]),
+            operation["incident_id"])
+        self.storage._service.delete_entity(tablename, stored.pop("PartitionKey"), stored["RowKey"])
+        stored.pop("Timestamp")
+        stored.pop("etag")
+        stored["PartitionKey"] = "legacy"
+        self.storage._service.insert_entity(tablename, stored)
+        self.assertRaises(OperationNotFoundException,
+                          self.storage.get_operation,
+                          operation["incident_id"])
+
+        moved = self.storage.migrate_partitions(batch_size=10)
+
+        assert moved[tablename] == 1
+        assert self.storage.get_operation(operation["incident_id"])["chain_identifier"] ==\
+            operation["chain_identifier"]
+
+        # done, nothing to move anymore
+        assert self.storage.migrate_partitions(batch_size=10)[tablename] == 1
+
+    def test_build_balance_ledger(self):
+        address = create_unique_address("lykke-customer")
+        addrs = split_unique_address(address)
+        deposit = self.get_completed_op()
+        deposit["to"] = addrs["account_id"]
+        deposit["customer_id"] = addrs["customer_id"]
+        deposit["amount_value"] = 10
+        self.storage.insert_operation(deposit)
+
+        # as stored before the balance table existed
+        self.storage._service.delete_table(self.storage._azure_config["balance_table"])
+
+        storage = get_operation_storage("azuretest", purge=False)
+        assert storage.get_balances(1, addresses=[address])[address] == {
+            "1.3.121": 10,
+            "block_num": deposit["block_num"]}
+
+    def test_build_customer_index(self):
+        operation = self.get_completed_op()
+        self.storage.insert_operation(operation)
+
+        # as stored before the customer table existed
+        self.storage._service.delete_entity(
+            self.storage._operation_tables["customer"],
+            operation["customer_id"],
+            operation["chain_identifier"])
+        assert self.storage.get_operations_completed(
+            filter_by={"customer_id": operation["customer_id"]}) == []
+
+        assert self.storage.build_customer_index(batch_size=10) == 1
+        assert self.storage.build_customer_index(batch_size=10) == 0
+
+        operations = self.storage.get_operations_completed(
+            filter_by={"customer_id": operation["customer_id"]})
+        assert [x["chain_identifier"] for x in operations] == [operation["chain_identifier"]]
+
+
+class TestInMemoryOperationStorage(TestMongoOperationStorage):
+
+    def setUp(self):
+        super(TestInMemoryOperationStorage, self).setUp()
+        self.storage = get_operation_storage("inmemory")
+
+    def test_snapshot(self):
+        address = create_unique_address("lykke-customer")
+        addrs = split_unique_address(address)
+
+        with tempfile.TemporaryDirectory() as directory:
+            Config.data["operation_storage"]["inmemory"]["snapshot_file"] =\
+                os.path.join(directory, "snapshot.json")
+            storage = get_operation_storage("inmemory")
+
+            deposit = self.get_completed_op()
+            deposit["to"] = addrs["account_id"]
+            deposit["customer_id"] = addrs["customer_id"]
+            storage.insert_operation(deposit)
+            withdrawal = self.get_in_progress_op()
+            withdrawal["incident_id"] = "some_operation_id_2"
+            withdrawal["chain_identifier"] = "some_chain_identifier_2"
+            storage.insert_operation(withdrawal)
+            storage.track_address(address)
+            storage.set_last_head_block_num(10)
+            storage.close()
+
+            storage = get_operation_storage("inmemory")
+            assert storage.get_operation(deposit["incident_id"])["status"] == "completed"
+            assert len(storage.get_operations_in_progress()) == 1
+            assert storage.get_balances(1)[address]["1.3.121"] == deposit["amount_value"]
+            assert storage.get_last_head_block_num() == 10
+            storage.close()
+
+            storage = get_operation_storage("inmemory", purge=True)
+            assert storage.get_operations_completed() == []
+            storage.close()
+
+
+class TestSQLiteOperationStorage(TestMongoOperationStorage):
+
+    def setUp(self):
+        super(TestSQLiteOperationStorage, self).setUp()
+        self.storage = get_operation_storage("sqlitetest")
+
+
+class TestCachingOperationStorage(TestMongoOperationStorage):
+
+    def setUp(self):
+        super(TestCachingOperationStorage, self).setUp()
+        self.storage = CachingOperationStorage(
+            get_operation_storage("inmemory"),
+            cache_config={"operation_size": 2,
+                          "operation_ttl_in_sec": 60,
+                          "head_block_ttl_in_sec": 60})
+
+    def test_cache(self):
+        in_progress = self.get_in_progress_op()
+        self.storage.insert_operation(in_progress)
+
+        assert self.storage.get_operation(in_progress["incident_id"])["status"] == "in_progress"
+        assert self.storage.get_operation(in_progress["incident_id"])["status"] == "in_progress"
+        assert self.storage.get_statistics()["operation"] == {
+            "hits": 1, "misses": 1, "evictions": 0, "size": 1}
+
+        # invalidated by the chain identifier, the monitor knows no incident id
+        completed = self.get_completed_op()
+        completed.pop("incident_id")
+        self.storage.flag_operation_completed(completed)
+        assert self.storage.get_operation(in_progress["incident_id"])["status"] == "completed"
+        assert self.storage.get_statistics()["operation"]["misses"] == 2
+
+        for i in range(3):
+            operation = self.get_in_progress_op()
+            operation["incident_id"] = "some_other_incident_id_" + str(i)
+            operation["chain_identifier"] = "some_other_chain_identifier_" + str(i)
+            self.storage.insert_operation(operation)
+            self.storage.get_operation(operation["incident_id"])
+        assert self.storage.get_statistics()["operation"]["evictions"] == 2
+        assert self.storage.get_statistics()["operation"]["size"] == 2
+
+        self.storage.set_last_head_block_num(10)
+        assert self.storage.get_last_head_block_num() == 10
+        # written by another process, seen after the ttl
+        self.storage._storage.set_last_head_block_num(11)
+        assert self.storage.get_last_head_block_num() == 10
+        assert self.storage.get_statistics()["head_block_num"] == {"hits": 2, "misses": 0}
+        self.storage.clear()
+        assert self.storage.get_last_head_block_num() == 11
+
+
+class TestPartitionKey(unittest.TestCase):
+
+    def test_stable(self):
+        assert get_partition_key("some_incident_id", 1000) == "474"
+        assert get_partition_key("some_incident_id", 10) == "4"
+
+    def test_spread(self):
+        keys = set(get_partition_key("incident_" + str(i), 16) for i in range(1000))
+        assert keys == set(str(i) for i in range(16))
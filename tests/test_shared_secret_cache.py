@@ -0,0 +1,39 @@
+import unittest
+
+from bitsharesbase import memo as BtsMemo
+from bitsharesbase.account import PrivateKey
+
+from bexi.shared_secret_cache import SharedSecretCache
+
+
+class TestSharedSecretCache(unittest.TestCase):
+
+    EXCHANGE_MEMO_KEY = "5JCHqyxngCFX98wiexo6JPVwikBrWJ4toin9tSWcRws2YfbYQ6i"
+    CUSTOMER_MEMO_KEY = "5HuuC1pbw5fsJFbTvR9VXbnv1qp9KSb3LpwUrhRLsUVgukGFu1G"
+
+    def test_same_as_bitsharesbase(self):
+        cache = SharedSecretCache()
+        exchange = cache.get_private_key(self.EXCHANGE_MEMO_KEY)
+        customer = cache.get_private_key(self.CUSTOMER_MEMO_KEY)
+
+        for nonce in range(5):
+            message = "customer_" + str(nonce)
+            encrypted = cache.encode_memo(customer, exchange.pubkey, str(nonce), message)
+            assert encrypted == BtsMemo.encode_memo(customer, exchange.pubkey, str(nonce), message)
+            assert cache.decode_memo(exchange, customer.pubkey, str(nonce), encrypted) == message
+
+        self.assertRaises(ValueError,
+                          cache.decode_memo,
+                          exchange, customer.pubkey, "1", encrypted)
+
+        # one secret each for both directions
+        assert cache.get_statistics() == {"hits": 9, "misses": 2, "size": 2}
+
+    def test_size(self):
+        cache = SharedSecretCache(size=2)
+        exchange = cache.get_private_key(self.EXCHANGE_MEMO_KEY)
+
+        for i in range(4):
+            cache.get_shared_secret(exchange, PrivateKey().pubkey)
+
+        assert cache.get_statistics() == {"hits": 0, "misses": 4, "size": 2}